@@ -1,8 +1,10 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
 from django.http import HttpResponse
 from django.core.cache import cache
 import bleach
 import re
 from datetime import datetime, timedelta
+from core.threads import in_worker_thread
 class SecurityMiddleware:
     """
     A comprehensive security middleware that handles:
@@ -11,8 +13,14 @@ class SecurityMiddleware:
     - Security headers
     - File upload validation
     """
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
         self.email_pattern = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
         self.username_pattern = re.compile(r'^[a-zA-Z0-9_]+$')
         
@@ -23,6 +31,33 @@ class SecurityMiddleware:
             'default': (200, 60)           # 200 requests per minute for other endpoints
         }
     def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        error = self.sanitize_request(request)
+        if error is not None:
+            return error
+
+        response = self.get_response(request)
+        
+        # Add security headers
+        self.add_security_headers(response)
+        
+        return response
+    async def __acall__(self, request):
+        # Parsing a multipart body reads and encrypts the upload (and
+        # authenticates it against the database), so keep it off the event loop
+        error = await in_worker_thread(self.sanitize_request)(request)
+        if error is not None:
+            return error
+
+        response = await self.get_response(request)
+        
+        # Add security headers
+        self.add_security_headers(response)
+        
+        return response
+    def sanitize_request(self, request):
+        """Sanitize text input of POST/PUT requests; returns an error response or None"""
         # Input sanitization for POST/PUT requests
         if request.method in ['POST', 'PUT']:
             # Check content type
@@ -49,13 +84,7 @@ class SecurityMiddleware:
                             request.POST[key] = bleach.clean(value, strip=True)
                 except Exception:
                     return HttpResponse("Invalid request data", status=400)
-
-        response = self.get_response(request)
-        
-        # Add security headers
-        self.add_security_headers(response)
-        
-        return response
+        return None
     def get_client_ip(self, request):
         x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
         return x_forwarded_for.split(',')[0] if x_forwarded_for else request.META.get('REMOTE_ADDR')
@@ -89,9 +118,12 @@ class SecurityMiddleware:
             'X-XSS-Protection': '1; mode=block',
             'Referrer-Policy': 'strict-origin-when-cross-origin',
             'Permissions-Policy': 'geolocation=(), microphone=()',
-            'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0',
-            'Pragma': 'no-cache'
         }
         
         for header, value in security_headers.items():
-            response[header] = value
\ No newline at end of file
+            response[header] = value
+        # Responses are never stored unless the view chose a cache policy
+        # (e.g. private revalidation of content with an ETag)
+        if not response.has_header('Cache-Control'):
+            response['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
+            response['Pragma'] = 'no-cache'
\ No newline at end of file
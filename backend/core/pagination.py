@@ -0,0 +1,136 @@
+"""
+Keyset (cursor) pagination for the list endpoints.
+
+Rows are ordered on a unique key, ``('-created_at', '-id')`` by default or a
+view's ``cursor_ordering``, and the cursor holds the key of the last row sent.
+The next page is found by seeking past that key rather than by OFFSET, so page
+N costs the same as page 1 given an index on the key, and rows added or
+removed meanwhile never shift pages. Responses look like::
+
+    {"next": "https://.../files/?cursor=...", "results": [...]}
+"""
+import base64
+import binascii
+import datetime
+import json
+import uuid
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+def _encode_value(value):
+    # JSON-encode key values at full precision (DjangoJSONEncoder drops
+    # microseconds, which would skip or repeat rows)
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    return value
+
+
+class KeysetPagination(BasePagination):
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+    cursor_query_param = 'cursor'
+    # Must end in a unique field, so every row has a distinct position
+    ordering = ('-created_at', '-id')
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+        self.ordering = tuple(getattr(view, 'cursor_ordering', self.ordering))
+
+        queryset = queryset.order_by(*self.ordering)
+        position = self.decode_cursor(request)
+        if position is not None:
+            try:
+                queryset = queryset.filter(self.seek(position))
+            except (TypeError, ValueError, ValidationError):
+                # Values that don't fit the key's fields
+                raise NotFound(self.invalid_cursor_message)
+
+        # One extra row tells whether there is a next page, without a COUNT
+        rows = list(queryset[:self.page_size + 1])
+        self.has_next = len(rows) > self.page_size
+        self.page = rows[:self.page_size]
+        return self.page
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def seek(self, position):
+        """
+        The rows after ``position`` in ``self.ordering``: for a key (a, b),
+        ``a after A OR (a = A AND b after B)``.
+        """
+        condition = Q()
+        for i, field in enumerate(self.ordering):
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            ties = {
+                earlier.lstrip('-'): value
+                for earlier, value in zip(self.ordering[:i], position)
+            }
+            condition |= Q(**ties, **{f"{field.lstrip('-')}__{lookup}": position[i]})
+        return condition
+
+    def decode_cursor(self, request):
+        """The position in the request's cursor, or ``None`` for the first page."""
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            position = json.loads(
+                base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4))
+            )
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(position, list) or len(position) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return position
+
+    def encode_cursor(self, row):
+        position = [_encode_value(getattr(row, field.lstrip('-'))) for field in self.ordering]
+        encoded = base64.urlsafe_b64encode(json.dumps(position).encode())
+        return encoded.decode().rstrip('=')
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[-1]))
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {
+                    'type': 'string',
+                    'nullable': True,
+                    'format': 'uri',
+                },
+                'results': schema,
+            },
+        }
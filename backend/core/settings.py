@@ -86,6 +86,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'files.middleware.DiscardFailedUploadsMiddleware',
     'core.middlewares.SecurityMiddleware',
 ]
 
@@ -108,6 +109,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'core.wsgi.application'
+ASGI_APPLICATION = 'core.asgi.application'
 
 
 # Database
@@ -186,9 +188,14 @@ CORS_ALLOW_METHODS = [
 ]
 
 CORS_EXPOSE_HEADERS = [
+    'accept-ranges',
     'content-disposition',
+    'content-length',
+    'content-range',
     'content-type',
     'x-client-key',
+    'x-blob-format',
+    'x-preview-variant',
 ]
 
 REST_FRAMEWORK = {
@@ -198,6 +205,8 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
     ),
+    'DEFAULT_PAGINATION_CLASS': 'core.pagination.KeysetPagination',
+    'PAGE_SIZE': 100,
 }
 
 SIMPLE_JWT = {
@@ -222,11 +231,168 @@ ENCRYPTED_FILES_DIR = os.path.join(MEDIA_ROOT, 'encrypted_files')
 # Create the directory if it doesn't exist
 os.makedirs(ENCRYPTED_FILES_DIR, exist_ok=True)
 
+# Encrypted blobs are fanned out into FILE_BLOB_SHARD_LEVELS levels of 256
+# hashed subdirectories; blobs left in the flat layout are still found and can
+# be moved with `manage.py migrate_blob_layout`
+FILE_BLOB_SHARD_LEVELS = int(os.getenv('FILE_BLOB_SHARD_LEVELS', 2))
+
+# Optionally append blobs of small uploads (up to 64 KiB) to large pack files,
+# reclaimed with `manage.py compact_packs`
+FILE_BLOB_PACKING = os.getenv('FILE_BLOB_PACKING', 'False').lower() in ('true', '1', 'yes')
+
+# Spread blobs over several volumes (os.pathsep-separated roots), keeping each
+# on FILE_BLOB_REPLICAS of them (two by default, or one with a single volume);
+# repair with `manage.py repair_blob_replicas`
+FILE_BLOB_VOLUMES = [root for root in os.getenv('FILE_BLOB_VOLUMES', '').split(os.pathsep) if root]
+FILE_BLOB_REPLICAS = int(os.getenv('FILE_BLOB_REPLICAS', 2))
+
+# Or keep blobs in an S3-compatible bucket (AWS S3, MinIO, ...), uploaded as
+# FILE_BLOB_S3_PART_SIZE-byte multipart parts, FILE_BLOB_S3_CONCURRENCY at a time.
+# Credentials are read by boto3 from the usual AWS_* variables or config files
+FILE_BLOB_S3_BUCKET = os.getenv('FILE_BLOB_S3_BUCKET', '')
+FILE_BLOB_S3_PART_SIZE = int(os.getenv('FILE_BLOB_S3_PART_SIZE', 8 * 1024 * 1024))
+FILE_BLOB_S3_CONCURRENCY = int(os.getenv('FILE_BLOB_S3_CONCURRENCY', 4))
+FILE_BLOB_S3_MAX_CONNECTIONS = int(os.getenv('FILE_BLOB_S3_MAX_CONNECTIONS', 10))
+
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+    'blobs': {
+        'BACKEND': 'files.storage.ShardedStorage',
+        'OPTIONS': {
+            'location': ENCRYPTED_FILES_DIR,
+            'levels': FILE_BLOB_SHARD_LEVELS,
+        },
+    },
+}
+if FILE_BLOB_S3_BUCKET:
+    STORAGES['blobs'] = {
+        'BACKEND': 'files.storage.S3Storage',
+        'OPTIONS': {
+            'bucket': FILE_BLOB_S3_BUCKET,
+            'prefix': os.getenv('FILE_BLOB_S3_PREFIX', 'encrypted_files/'),
+            'endpoint_url': os.getenv('FILE_BLOB_S3_ENDPOINT_URL') or None,
+            'region_name': os.getenv('FILE_BLOB_S3_REGION') or None,
+            'part_size': FILE_BLOB_S3_PART_SIZE,
+            'concurrency': FILE_BLOB_S3_CONCURRENCY,
+            'max_pool_connections': FILE_BLOB_S3_MAX_CONNECTIONS,
+        },
+    }
+elif FILE_BLOB_VOLUMES:
+    STORAGES['blobs'] = {
+        'BACKEND': 'files.storage.MultiVolumeStorage',
+        'OPTIONS': {
+            'volumes': FILE_BLOB_VOLUMES,
+            'replicas': FILE_BLOB_REPLICAS,
+            'levels': FILE_BLOB_SHARD_LEVELS,
+        },
+    }
+elif FILE_BLOB_PACKING:
+    STORAGES['blobs'] = {
+        'BACKEND': 'files.storage.PackedStorage',
+        'OPTIONS': {
+            'location': ENCRYPTED_FILES_DIR,
+            'levels': FILE_BLOB_SHARD_LEVELS,
+            'pack_location': os.path.join(MEDIA_ROOT, 'blob_packs'),
+            'max_packed_size': 64 * 1024 + 1024,
+            'pack_size': 256 * 1024 * 1024,
+        },
+    }
+
+# Raw ciphertext downloads (?raw=1 on client-encrypted files) are handed to the
+# web server instead of being read by the worker: 'x-accel-redirect' (nginx, with
+# an internal location at FILE_SENDFILE_URL aliasing FILE_SENDFILE_ROOT) or
+# 'x-sendfile' (Apache, lighttpd). Empty serves them with FileResponse, which
+# WSGI servers send with os.sendfile()
+FILE_SENDFILE_BACKEND = os.getenv('FILE_SENDFILE_BACKEND', '').lower()
+FILE_SENDFILE_ROOT = os.getenv('FILE_SENDFILE_ROOT', MEDIA_ROOT)
+FILE_SENDFILE_URL = os.getenv('FILE_SENDFILE_URL', '/protected/')
+
+# Preview derivatives (?variant=thumb): image thumbnails and text/PDF excerpts,
+# made on upload (in a background thread) or first preview and kept encrypted
+# in an LRU cache of at most FILE_DERIVATIVE_CACHE_SIZE bytes. Images and PDFs
+# larger than FILE_DERIVATIVE_MAX_SOURCE_SIZE get no derivative
+FILE_DERIVATIVE_CACHE_SIZE = int(os.getenv('FILE_DERIVATIVE_CACHE_SIZE', 1024 * 1024 * 1024))
+FILE_DERIVATIVE_MAX_SOURCE_SIZE = 50 * 1024 * 1024
+FILE_DERIVATIVES_ON_UPLOAD = os.getenv('FILE_DERIVATIVES_ON_UPLOAD', 'True').lower() in ('true', '1', 'yes')
+
+# Optional per-process cache of decrypted content of small, hot files: at most
+# FILE_PLAINTEXT_CACHE_SIZE bytes (0 disables it), LRU evicted, entries expiring
+# after FILE_PLAINTEXT_CACHE_TTL seconds; larger files are never cached.
+# Invalidations reach other processes through CACHES['default'] when it is shared
+FILE_PLAINTEXT_CACHE_SIZE = int(os.getenv('FILE_PLAINTEXT_CACHE_SIZE', 0))
+FILE_PLAINTEXT_CACHE_MAX_ITEM_SIZE = int(os.getenv('FILE_PLAINTEXT_CACHE_MAX_ITEM_SIZE', 256 * 1024))
+FILE_PLAINTEXT_CACHE_TTL = int(os.getenv('FILE_PLAINTEXT_CACHE_TTL', 60))
+
 # Set secure file upload configurations
+# File uploads are encrypted as they stream in; other uploads use Django's defaults
+FILE_UPLOAD_HANDLERS = [
+    'files.uploadhandler.EncryptingUploadHandler',
+    'django.core.files.uploadhandler.MemoryFileUploadHandler',
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+]
 FILE_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10MB
 FILE_UPLOAD_PERMISSIONS = 0o644
 ALLOWED_UPLOAD_EXTENSIONS = ['pdf', 'jpg', 'jpeg', 'png', 'txt']
 
+# Per-file data keys are stored wrapped by a key-encryption key (KEK) from this
+# keyfile, or from FILE_KEY_PROVIDER; unwrapped keys are cached in an LRU
+FILE_KEK_FILE = os.getenv('FILE_KEK_FILE', os.path.join(BASE_DIR, 'kek.json'))
+FILE_KEY_PROVIDER = os.getenv('FILE_KEY_PROVIDER', 'files.keys.load_keyfile')
+FILE_DATA_KEY_CACHE_SIZE = 1024
+# Create a keyfile with a fresh KEK when none exists (never in production,
+# where losing the keyfile makes every file unreadable)
+FILE_KEK_AUTOCREATE = DEBUG
+
+# Plaintext bytes per independently authenticated segment of an encrypted blob
+FILE_ENCRYPTION_SEGMENT_SIZE = 64 * 1024
+
+# Segments are sealed and opened in parallel on a shared pool of this many
+# workers ('thread' or 'process'); 1 keeps all crypto on the request thread
+FILE_CRYPTO_EXECUTOR = os.getenv('FILE_CRYPTO_EXECUTOR', 'thread')
+FILE_CRYPTO_WORKERS = int(os.getenv('FILE_CRYPTO_WORKERS', os.cpu_count() or 1))
+
+# Compress uploads before encryption ('zstd', 'zlib' or 'none'); zstd falls back
+# to zlib without the zstandard package. A file is only compressed if a trial
+# over its first chunk shrinks it to at most FILE_COMPRESSION_MAX_RATIO. Files
+# larger than FILE_COMPRESSION_MAX_SIZE are not compressed, since ranges of a
+# compressed file are only readable by decompressing it from the start.
+FILE_COMPRESSION_ALGORITHM = os.getenv('FILE_COMPRESSION_ALGORITHM', 'zstd')
+FILE_COMPRESSION_MAX_RATIO = 0.9
+FILE_COMPRESSION_MAX_SIZE = int(os.getenv('FILE_COMPRESSION_MAX_SIZE', 16 * 1024 * 1024))
+
+# Resumable uploads: plaintext bytes per chunk and how long a session stays open
+FILE_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+FILE_UPLOAD_SESSION_LIFETIME = timedelta(days=1)
+
+# Serve file upload, download and preview from async views (run under an ASGI
+# server such as uvicorn); the DRF viewset actions are used otherwise. Off by
+# default: under ASGI, request bodies larger than FILE_UPLOAD_MAX_MEMORY_SIZE
+# are spooled to a temporary file as plaintext before EncryptingUploadHandler
+# sees them, which the WSGI deployment never does
+FILES_ASYNC_VIEWS = os.getenv('FILES_ASYNC_VIEWS', 'False').lower() in ('true', '1', 'yes')
+
+# Report per-file encryption throughput from the files app
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'files': {
+            'handlers': ['console'],
+            'level': os.getenv('FILES_LOG_LEVEL', 'INFO'),
+        },
+    },
+}
+
 # Rate limiting settings
 RATELIMIT_ENABLE = True
 RATELIMIT_USE_CACHE = 'default'
@@ -0,0 +1,29 @@
+"""
+Running blocking work that may use the database off the event loop.
+
+``sync_to_async(..., thread_sensitive=False)`` runs a function in an executor
+thread so that slow I/O doesn't hold up other requests, but Django only
+closes the database connections of its own request threads. Work handed to
+other threads goes through these helpers, which close whatever connections
+the work opened in that thread once it returns.
+"""
+import functools
+
+from asgiref.sync import sync_to_async
+from django.db import connections
+
+
+def closing_connections(func):
+    """Wrap ``func`` to close the calling thread's database connections after it."""
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            connections.close_all()
+    return run
+
+
+def in_worker_thread(func):
+    """``sync_to_async(func, thread_sensitive=False)`` that closes connections after."""
+    return sync_to_async(closing_connections(func), thread_sensitive=False)
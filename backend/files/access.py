@@ -0,0 +1,81 @@
+"""
+Resolution of a user's access to files.
+
+A file and the caller's effective permission on it (``ADMIN``, ``OWNER``, or
+the ``VIEW``/``DOWNLOAD`` permission of their active share) come back from a
+single query, with the share permission annotated on the file. The file is
+memoized on the request, so the permission class, the view and the serializer
+all read the same row instead of querying the shares again.
+"""
+from django.core.exceptions import ValidationError
+from django.db.models import OuterRef, Q, Subquery
+from django.utils import timezone
+
+from .models import File, FileShare
+
+ADMIN = 'ADMIN'
+OWNER = 'OWNER'
+
+# Effective permissions that allow downloading (and changing) a file
+DOWNLOAD_PERMISSIONS = frozenset((ADMIN, OWNER, FileShare.Permissions.DOWNLOAD))
+
+
+def annotate_share_permission(queryset, user):
+    """
+    Annotate each file of ``queryset`` with the permission of ``user``'s
+    active share of it, as ``active_share_permission`` (``None`` if none).
+    """
+    active_share = FileShare.objects.filter(
+        file=OuterRef('pk'),
+        shared_with=user,
+        expires_at__gt=timezone.now()
+    ).order_by('-created_at').values('permission')[:1]
+    return queryset.annotate(active_share_permission=Subquery(active_share))
+
+
+def accessible_files(user):
+    """The files ``user`` may access, annotated with their share permission."""
+    queryset = annotate_share_permission(File.objects.select_related('owner'), user)
+    if user.is_admin():
+        return queryset
+    return queryset.filter(Q(owner=user) | Q(active_share_permission__isnull=False))
+
+
+def get_file(request, pk):
+    """
+    The file ``pk`` if the request's user may access it, else ``None``.
+    Looked up once per request.
+    """
+    user = request.user
+    # Keep the memo on the Django request, shared by DRF's wrapper of it
+    memo = getattr(request, '_request', request).__dict__.setdefault('_file_access', {})
+    key = str(pk)
+    if key not in memo:
+        try:
+            memo[key] = accessible_files(user).filter(pk=pk).first()
+        except (TypeError, ValueError, ValidationError):
+            memo[key] = None
+    return memo[key]
+
+
+def effective_permission(user, file_obj):
+    """
+    ``user``'s permission on ``file_obj``: ``ADMIN``, ``OWNER``, their share's
+    ``VIEW`` or ``DOWNLOAD``, or ``None``. Costs no query for files from
+    ``accessible_files()``.
+    """
+    if user.is_admin():
+        return ADMIN
+    if file_obj.owner_id == user.pk:
+        return OWNER
+    if hasattr(file_obj, 'active_share_permission'):
+        return file_obj.active_share_permission
+    return FileShare.objects.filter(
+        file=file_obj,
+        shared_with=user,
+        expires_at__gt=timezone.now()
+    ).values_list('permission', flat=True).first()
+
+
+def can_download(permission):
+    return permission in DOWNLOAD_PERMISSIONS
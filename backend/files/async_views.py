@@ -0,0 +1,188 @@
+"""
+Async versions of the file upload, download and preview endpoints.
+
+These are plain Django async views, routed in place of the ``FileViewSet``
+actions when ``FILES_ASYNC_VIEWS`` is enabled and the project is served by an
+ASGI server. Database access goes through the async ORM, and blocking storage
+I/O runs in worker threads, with the CPU-bound crypto itself already handed
+to the crypto pool. Work in worker threads may still query the database (to
+authenticate an upload, or read pack indexes and derivatives), so it goes
+through ``core.threads``, which closes the connections it opens. Response
+bodies are pulled from the decrypting iterators one chunk at a time off the
+event loop, so a slow client only costs a pending coroutine rather than a
+worker.
+"""
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from rest_framework.exceptions import APIException, ValidationError
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+from core.threads import closing_connections, in_worker_thread
+
+from . import access, derivatives, streaming
+from .models import File
+from .serializers import FileSerializer
+from .uploadhandler import is_client_encrypted
+from .views import FileViewSet, save_upload
+
+_sync_file_list = FileViewSet.as_view({'get': 'list', 'post': 'create'})
+
+
+async def _authenticate(request):
+    """
+    Authenticate the request's JWT and set ``request.user``.
+
+    Returns an error response, or ``None`` once the user is set.
+    """
+    try:
+        result = await sync_to_async(JWTAuthentication().authenticate)(request)
+    except APIException as e:
+        return JsonResponse({'detail': str(e.detail)}, status=e.status_code)
+    if result is None:
+        return JsonResponse(
+            {'detail': 'Authentication credentials were not provided.'},
+            status=401
+        )
+    request.user = result[0]
+    return None
+
+
+async def _get_file(request, pk, download=False):
+    """
+    Fetch a file the user may read, mirroring ``FileViewSet.get_object`` and
+    the download permission check in one query. Returns
+    ``(file, error_response)``.
+    """
+    user = request.user
+    file_obj = await access.accessible_files(user).filter(pk=pk).afirst()
+    if file_obj is None:
+        return None, JsonResponse({'detail': 'Not found.'}, status=404)
+    if download and not access.can_download(access.effective_permission(user, file_obj)):
+        return None, JsonResponse(
+            {'detail': 'Download permission denied'}, status=403
+        )
+    return file_obj, None
+
+
+_next = closing_connections(next)
+
+
+async def _iterate_in_thread(iterator):
+    """Drive a blocking iterator from a worker thread, one item at a time."""
+    loop = asyncio.get_running_loop()
+    done = object()
+    try:
+        while True:
+            chunk = await loop.run_in_executor(None, _next, iterator, done)
+            if chunk is done:
+                break
+            yield chunk
+    finally:
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            await loop.run_in_executor(None, closing_connections(close))
+
+
+async def _file_response(request, pk, as_attachment, error_detail, download=False,
+                         variant=None):
+    error = await _authenticate(request)
+    if error is not None:
+        return error
+    file_obj, error = await _get_file(request, pk, download=download)
+    if error is not None:
+        return error
+
+    raw = download and request.GET.get('raw')
+    if raw and file_obj.storage_format != File.StorageFormat.CLIENT_ENCRYPTED:
+        return JsonResponse(
+            {'detail': 'Raw download is only available for client-encrypted files'},
+            status=400
+        )
+
+    try:
+        # Opening the blob and validating its header touches storage
+        if raw:
+            response = await in_worker_thread(streaming.ciphertext_response)(
+                request, file_obj, as_attachment=as_attachment
+            )
+        elif not as_attachment:
+            # Making a missing derivative decrypts the original, off the loop
+            response = await in_worker_thread(streaming.preview_response)(
+                request, file_obj, variant
+            )
+        else:
+            response = await in_worker_thread(streaming.file_response)(
+                request, file_obj, as_attachment=as_attachment
+            )
+    except Exception as e:
+        print(f"Async file response error: {str(e)}")
+        return JsonResponse({'detail': error_detail}, status=500)
+
+    if response.streaming:
+        response.streaming_content = _iterate_in_thread(
+            iter(response.streaming_content)
+        )
+    return response
+
+
+async def download(request, pk):
+    """Stream a decrypted file (or with ``?raw=1`` its ciphertext) as an attachment."""
+    return await _file_response(
+        request, pk, True, 'Failed to download file.', download=True
+    )
+
+
+async def preview(request, pk):
+    """Stream a decrypted file, or with ``?variant=`` its derivative, for inline display."""
+    variant = request.GET.get('variant')
+    if variant and variant not in derivatives.VARIANTS:
+        return JsonResponse({'detail': 'Unknown preview variant'}, status=400)
+    return await _file_response(
+        request, pk, False, 'Failed to load preview', variant=variant
+    )
+
+
+def _receive_upload(request):
+    # Parsing the body runs EncryptingUploadHandler, which writes the blob
+    return request.POST, request.FILES
+
+
+def _create_file(request, data, files):
+    # A blob written for a rejected upload is deleted by
+    # DiscardFailedUploadsMiddleware
+    serializer = FileSerializer(
+        data={**data.dict(), 'file': files.get('file')},
+        context={'request': request}
+    )
+    if not serializer.is_valid():
+        return JsonResponse(serializer.errors, status=400)
+    try:
+        save_upload(
+            serializer, files.get('file'), data.get('client_key'),
+            client_encrypted=is_client_encrypted(request)
+        )
+    except ValidationError as e:
+        return JsonResponse(e.detail, status=400)
+    return JsonResponse(serializer.data, status=201)
+
+
+async def file_list(request):
+    """
+    Upload a file without tying up a worker while its body is encrypted and
+    written to storage. Listing is handed to the synchronous viewset.
+    """
+    if request.method != 'POST':
+        return await sync_to_async(_sync_file_list)(request)
+
+    error = await _authenticate(request)
+    if error is not None:
+        return error
+    data, files = await in_worker_thread(_receive_upload)(request)
+    return await sync_to_async(_create_file)(request, data, files)
+
+
+# Authenticated with bearer tokens only, like the DRF views they replace
+for _view in (download, preview, file_list):
+    _view.csrf_exempt = True
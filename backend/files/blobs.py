@@ -0,0 +1,563 @@
+"""
+Reading and writing the encrypted blobs behind ``File`` rows.
+
+Views go through these helpers instead of touching storage or ciphers
+directly, so every on-disk format recorded in ``File.storage_format`` is
+handled in one place.
+"""
+import hashlib
+import io
+import logging
+import os
+import uuid
+
+from cryptography.fernet import Fernet
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage, storages
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from . import compression, conditional, crypto, keys, plaintext_cache
+from .models import Blob, File, FileShare
+
+UPLOAD_PARTS_DIR = 'upload_parts'
+READ_SIZE = 64 * 1024
+
+# Framing of client-encrypted uploads: a 12-byte AES-GCM IV, then the
+# ciphertext ending in its 16-byte tag
+CLIENT_IV_SIZE = 12
+CLIENT_TAG_SIZE = 16
+
+logger = logging.getLogger(__name__)
+
+
+def blob_storage():
+    """The storage holding encrypted blobs, ``STORAGES['blobs']``."""
+    return storages['blobs']
+
+
+def new_blob_name():
+    """
+    Generate a unique, opaque storage name. Storage names are exposed as the
+    ``name`` and ETag of files, so they carry nothing of the original name.
+    """
+    return str(uuid.uuid4())
+
+
+def _abort_write(out):
+    """
+    Stop writing a blob without storing it. Writers that can discard a
+    partial blob (an S3 multipart upload, a pending pack entry or replica)
+    do so; plain files are just closed, for ``delete_blob`` to remove.
+    """
+    abort = getattr(out.file, 'abort', None)
+    if abort is not None:
+        abort()
+    else:
+        out.close()
+
+
+class BlobWriter:
+    """
+    Encrypts plaintext pushed into it straight into a new blob.
+
+    Call ``write()`` with each piece of plaintext as it becomes available and
+    ``close()`` once done, or ``abort()`` to discard the partial blob. The
+    plaintext digest used for deduplication is computed on the way through.
+
+    Unless ``compress`` is false, the first ``compression.TRIAL_SIZE`` bytes
+    are held back to decide (from ``mime_type``, the expected plaintext
+    ``size`` if given, and a trial run) whether the plaintext is compressed
+    before encryption; the choice is exposed as ``compression`` once the
+    writer is closed.
+    """
+
+    def __init__(self, name, key, mime_type=None, compress=True,
+                 segment_size=None, algorithm=crypto.ALGORITHM_AES_256_GCM, size=None):
+        self.name = name
+        self.size = 0
+        self.mime_type = mime_type
+        self._expected_size = size
+        self.compression = compression.NONE
+        self._compressor = None
+        self._pending = bytearray() if compress else None
+        self._hash = hashlib.sha256()
+        self._encryptor = crypto.SegmentEncryptor(key, segment_size, algorithm)
+        self._out = blob_storage().open(name, 'wb')
+
+    @property
+    def digest(self):
+        return self._hash.hexdigest()
+
+    def write(self, data):
+        self.size += len(data)
+        self._hash.update(data)
+        if self._pending is None:
+            self._encrypt(data)
+            return
+        self._pending += data
+        if len(self._pending) >= compression.TRIAL_SIZE:
+            self._choose_compression()
+
+    def _choose_compression(self):
+        pending, self._pending = bytes(self._pending), None
+        self.compression = compression.choose(
+            self.mime_type, pending[:compression.TRIAL_SIZE], self._expected_size
+        )
+        if self.compression != compression.NONE:
+            self._compressor = compression.get_compressor(self.compression)
+        self._encrypt(pending)
+
+    def _encrypt(self, data):
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        if data:
+            self._out.write(self._encryptor.update(data))
+
+    def close(self):
+        try:
+            if self._pending is not None:
+                self._choose_compression()
+            if self._compressor is not None:
+                self._out.write(self._encryptor.update(self._compressor.flush()))
+            self._out.write(self._encryptor.finalize())
+        finally:
+            self._out.close()
+        self._report()
+
+    def _report(self):
+        elapsed = self._encryptor.elapsed
+        throughput = self.size / elapsed / 2 ** 20 if elapsed else 0.0
+        logger.info(
+            'Encrypted %s: %d bytes (%d stored, %s) in %.3fs (%.1f MiB/s)',
+            self.name, self.size, self._encryptor.bytes_processed,
+            self.compression, elapsed, throughput
+        )
+
+    def abort(self):
+        _abort_write(self._out)
+        delete_blob(self.name)
+
+
+class RawBlobWriter:
+    """
+    Stores content the client encrypted itself into a new blob as it is.
+
+    Has the interface of ``BlobWriter``, but there is no plaintext to
+    digest or compress. Check the result with ``check_client_framing()``.
+    """
+    digest = None
+    compression = compression.NONE
+
+    def __init__(self, name):
+        self.name = name
+        self.size = 0
+        self._out = blob_storage().open(name, 'wb')
+
+    def write(self, data):
+        self.size += len(data)
+        self._out.write(data)
+
+    def close(self):
+        self._out.close()
+
+    def abort(self):
+        _abort_write(self._out)
+        delete_blob(self.name)
+
+
+def check_client_framing(size):
+    """
+    Raise ``ValueError`` unless ``size`` bytes can hold client ciphertext.
+
+    Without the key only the framing can be checked: the IV and the
+    authentication tag must both be present.
+    """
+    if size < CLIENT_IV_SIZE + CLIENT_TAG_SIZE:
+        raise ValueError(
+            f'Client-encrypted content must hold a {CLIENT_IV_SIZE}-byte IV and '
+            f'a {CLIENT_TAG_SIZE}-byte tag'
+        )
+
+
+def write_blob(name, chunks, key, mime_type=None, size=None):
+    """
+    Encrypt an iterable of plaintext chunks, of ``size`` bytes in total if
+    known, into a new segmented blob.
+
+    Returns the closed ``BlobWriter``, which holds the size, digest and
+    chosen compression.
+    """
+    writer = BlobWriter(name, key, mime_type, size=size)
+    try:
+        for chunk in chunks:
+            writer.write(chunk)
+    except Exception:
+        writer.abort()
+        raise
+    writer.close()
+    return writer
+
+
+def delete_blob(name):
+    blob_storage().delete(name)
+
+
+def digest_blob(name, key):
+    """Decrypt a stored blob and return the hex SHA-256 of its plaintext."""
+    digest = hashlib.sha256()
+    with blob_storage().open(name, 'rb') as f:
+        for chunk in crypto.iter_decrypt(f, key):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def attach_blob(file_instance, name, key, digest, size,
+                compression_algorithm=compression.NONE, retry=True):
+    """
+    Point ``file_instance`` at its owner's content-addressed blob for ``digest``.
+
+    If the owner already stores an identical blob, the file shares it (taking
+    over its data key, format and compression) and the freshly written copy
+    ``name`` is deleted once the transaction commits. Otherwise ``name`` is
+    registered as a new blob and ``key``, the plaintext data key, is stored
+    wrapped. The blob's refcount is incremented either way; the caller saves
+    ``file_instance`` and must run this inside the same transaction.
+
+    Blobs are never shared between owners: a shared blob would hand one
+    user's storage name, and so the proof that they hold the content, to
+    anyone uploading the same bytes.
+    """
+    existing = Blob.objects.select_for_update().filter(
+        owner_id=file_instance.owner_id, digest=digest
+    ).first()
+    if existing is not None:
+        source = existing.files.first()
+        if source is not None:
+            reference_blob(file_instance, source)
+            transaction.on_commit(lambda: delete_blob(name))
+            return
+        # Registered but no longer referenced by any file: replace it
+        stale_name = existing.name
+        existing.delete()
+        transaction.on_commit(lambda: delete_blob(stale_name))
+
+    try:
+        # Savepoint, so losing a race with an identical upload doesn't
+        # break the caller's transaction
+        with transaction.atomic():
+            blob = Blob.objects.create(
+                name=name, owner_id=file_instance.owner_id, digest=digest,
+                size=size, refcount=1
+            )
+    except IntegrityError:
+        if not retry:
+            raise
+        # A concurrent upload of the same content registered it first
+        return attach_blob(
+            file_instance, name, key, digest, size, compression_algorithm, retry=False
+        )
+    file_instance.blob = blob
+    file_instance.name = name
+    file_instance.encryption_key_id = keys.wrap(key)
+    file_instance.storage_format = File.StorageFormat.SEGMENTED_AEAD
+    file_instance.compression = compression_algorithm
+
+
+def attach_client_blob(file_instance, name, size):
+    """
+    Register ``name``, holding content the client encrypted itself, as a new
+    blob of ``file_instance``.
+
+    Its random IV makes the ciphertext unique, so it has no digest and is
+    never shared. The caller saves ``file_instance`` and must run this inside
+    the same transaction.
+    """
+    blob = Blob.objects.create(
+        name=name, owner_id=file_instance.owner_id, size=size, refcount=1
+    )
+    file_instance.blob = blob
+    file_instance.name = name
+    file_instance.encryption_key_id = ''
+    file_instance.storage_format = File.StorageFormat.CLIENT_ENCRYPTED
+    file_instance.compression = compression.NONE
+
+
+def reference_blob(file_instance, source):
+    """
+    Make ``file_instance`` share the blob of ``source``, taking a new
+    reference to it. Must run inside the transaction that saves the file.
+    """
+    Blob.objects.select_for_update().get(pk=source.blob_id)
+    # The blob may have been rewritten since ``source`` was loaded
+    source.refresh_from_db(fields=['name', 'encryption_key_id', 'storage_format', 'compression'])
+    Blob.objects.filter(pk=source.blob_id).update(refcount=F('refcount') + 1)
+    file_instance.blob_id = source.blob_id
+    file_instance.name = source.name
+    file_instance.encryption_key_id = source.encryption_key_id
+    file_instance.storage_format = source.storage_format
+    file_instance.compression = source.compression
+
+
+def release_blob(blob_id):
+    """
+    Drop one reference to a blob, deleting it once nothing points at it.
+    """
+    with transaction.atomic():
+        blob = Blob.objects.select_for_update().filter(pk=blob_id).first()
+        if blob is None:
+            return
+        if blob.refcount > 1:
+            Blob.objects.filter(pk=blob_id).update(refcount=F('refcount') - 1)
+            return
+        name = blob.name
+        blob.delete()
+        transaction.on_commit(lambda: delete_blob(name))
+
+
+def rewrite_blob(file_obj, key, verify=False, throttle=None, **writer_options):
+    """
+    Re-encrypt the content of ``file_obj``'s blob into a new blob under
+    ``key`` in the current storage format.
+
+    With ``verify``, the new blob is read back and its plaintext digest
+    checked. ``throttle``, if given, is called with the size of each
+    plaintext chunk before it is written. Returns the closed ``BlobWriter``;
+    the new blob is deleted if anything fails. Nothing points at it until ``swap_blob`` is called.
+    """
+    writer_options.setdefault('size', file_obj.size)
+    writer = BlobWriter(new_blob_name(), key, file_obj.mime_type, **writer_options)
+    try:
+        for chunk in open_plaintext(file_obj):
+            if throttle is not None:
+                throttle(len(chunk))
+            writer.write(chunk)
+    except Exception:
+        writer.abort()
+        raise
+    writer.close()
+
+    try:
+        blob_digest = file_obj.blob.digest if file_obj.blob_id else None
+        if blob_digest and blob_digest != writer.digest:
+            raise crypto.DecryptionError(f'{file_obj.name} does not match its recorded digest')
+        if verify:
+            copy = File(
+                name=writer.name,
+                size=writer.size,
+                encryption_key_id=key,
+                storage_format=File.StorageFormat.SEGMENTED_AEAD,
+                compression=writer.compression
+            )
+            digest = hashlib.sha256()
+            for chunk in open_plaintext(copy):
+                digest.update(chunk)
+            if digest.hexdigest() != writer.digest:
+                raise crypto.DecryptionError(f'Rewritten copy of {file_obj.name} does not verify')
+    except Exception:
+        delete_blob(writer.name)
+        raise
+    return writer
+
+
+def swap_blob(file_obj, writer, key):
+    """
+    Point ``file_obj`` (and every file sharing its blob) at the blob written
+    by ``rewrite_blob`` and delete the old one once committed.
+
+    Returns ``False``, deleting the new blob, if the file or its blob changed
+    or went away in the meantime.
+    """
+    with transaction.atomic():
+        if file_obj.blob_id is None:
+            current = File.objects.select_for_update().filter(pk=file_obj.pk).first()
+            stale = current is None or current.name != file_obj.name
+            if not stale:
+                attach_blob(
+                    current, writer.name, key, writer.digest, writer.size, writer.compression
+                )
+                current.save()
+        else:
+            blob = Blob.objects.select_for_update().filter(pk=file_obj.blob_id).first()
+            stale = blob is None or blob.name != file_obj.name
+            if not stale:
+                blob.name = writer.name
+                blob.size = writer.size
+                blob.save(update_fields=['name', 'size'])
+                File.objects.filter(blob=blob).update(
+                    name=writer.name,
+                    encryption_key_id=keys.wrap(key),
+                    storage_format=File.StorageFormat.SEGMENTED_AEAD,
+                    compression=writer.compression
+                )
+                # Bulk updates send no signals; the listings show the new name
+                users = set(File.objects.filter(blob=blob).values_list('owner_id', flat=True))
+                users.update(FileShare.objects.filter(
+                    file__blob=blob, shared_with__isnull=False
+                ).values_list('shared_with_id', flat=True))
+                conditional.bump(conditional.ALL, *[conditional.user_scope(u) for u in users])
+        old_name = writer.name if stale else file_obj.name
+        transaction.on_commit(lambda: delete_blob(old_name))
+    return not stale
+
+
+def write_part(session, index, stream):
+    """
+    Encrypt one chunk of a resumable upload read from ``stream``.
+
+    The chunk is sealed as the run of segments it occupies in the final blob,
+    so finalizing only has to concatenate parts. Raises ``ValueError`` if the
+    stream does not hold exactly the expected number of bytes. Returns the
+    storage path of the encrypted part.
+    """
+    header = bytes(session.header)
+    segment_size = crypto.parse_header(header).segment_size
+    expected = session.chunk_length(index)
+    encryptor = crypto.SegmentEncryptor(
+        keys.unwrap(session.encryption_key),
+        header=header,
+        first_index=index * session.chunk_size // segment_size
+    )
+
+    out = io.BytesIO()
+    received = 0
+    while received <= expected:
+        data = stream.read(min(READ_SIZE, expected + 1 - received))
+        if not data:
+            break
+        received += len(data)
+        if received > expected:
+            break
+        out.write(encryptor.update(data))
+    if received != expected:
+        raise ValueError(f'Chunk {index} must be exactly {expected} bytes')
+    out.write(encryptor.finalize(final=index == session.total_chunks - 1))
+
+    part_path = os.path.join(UPLOAD_PARTS_DIR, str(session.id), f'{index:08d}')
+    return default_storage.save(part_path, ContentFile(out.getvalue()))
+
+
+def assemble_parts(name, header, part_names):
+    """Write a blob from its header and encrypted parts, in order."""
+    with blob_storage().open(name, 'wb') as out:
+        out.write(bytes(header))
+        for part_name in part_names:
+            with default_storage.open(part_name, 'rb') as part:
+                for chunk in part.chunks():
+                    out.write(chunk)
+
+
+def delete_parts(part_names):
+    for part_name in part_names:
+        default_storage.delete(part_name)
+
+
+class PlaintextReader:
+    """
+    Random access to the decrypted content of a file's blob.
+
+    The blob is opened and its header validated on construction, so a missing
+    or malformed blob raises before any response is started. Compressed blobs
+    can't be entered mid-stream, so ranges of them are decompressed from the
+    start and skipped up to the first requested byte; only files up to
+    ``FILE_COMPRESSION_MAX_SIZE`` are compressed, which bounds that work.
+
+    Files small enough for the plaintext cache are decrypted whole on a miss
+    and served from memory while the entry lasts.
+    """
+
+    def __init__(self, file_obj):
+        if file_obj.storage_format == File.StorageFormat.CLIENT_ENCRYPTED:
+            raise ValueError(f'{file_obj.name} is client-encrypted and cannot be decrypted here')
+        self.file_obj = file_obj
+        self.size = file_obj.size
+        self._legacy = file_obj.storage_format == File.StorageFormat.FERNET
+        self._content = None
+        self._file = None
+        cache = plaintext_cache.get_cache()
+        cacheable = cache is not None and cache.accepts(file_obj.size)
+        if cacheable:
+            generation = plaintext_cache.generation(file_obj.name)
+            self._content = cache.get(file_obj.name, generation)
+            if self._content is not None:
+                self.size = len(self._content)
+                return
+
+        self._key = keys.unwrap(file_obj.encryption_key_id)
+        self._file = blob_storage().open(file_obj.name, 'rb')
+        try:
+            if self._legacy:
+                # Legacy blobs are a single token and can only be decrypted whole
+                self._content = Fernet(
+                    self._key.encode()
+                ).decrypt(bytes(self._file.read()))
+                self.size = len(self._content)
+            else:
+                self._header = crypto.read_header(self._file)
+                if cacheable:
+                    self._content = b''.join(self.iter_range())
+            if cacheable:
+                cache.put(file_obj.name, self._content, generation)
+        except Exception:
+            self.close()
+            raise
+
+    def iter_range(self, start=0, stop=None):
+        """Yield decrypted bytes ``[start, stop)``."""
+        stop = self.size if stop is None else min(stop, self.size)
+        if self._content is not None:
+            yield self._content[start:stop]
+        elif self.file_obj.compression != compression.NONE:
+            yield from _slice(self._iter_decompressed(), start, stop)
+        elif start == 0 and stop == self.size:
+            yield from self._iter_decrypted()
+        else:
+            yield from crypto.iter_decrypt_range(
+                self._file, self._key, self._header,
+                self.size, start, stop
+            )
+
+    def _iter_decrypted(self):
+        self._file.seek(crypto.HEADER.size)
+        return crypto.iter_decrypt(
+            self._file, self._key, header=self._header
+        )
+
+    def _iter_decompressed(self):
+        return compression.iter_decompress(
+            self.file_obj.compression, self._iter_decrypted()
+        )
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+def _slice(chunks, start, stop):
+    """Yield bytes ``[start, stop)`` of a stream of chunks."""
+    position = 0
+    for chunk in chunks:
+        end = position + len(chunk)
+        if end > start:
+            yield chunk[max(start - position, 0):stop - position]
+        position = end
+        if position >= stop:
+            return
+
+
+def iter_closing(chunks, reader):
+    """Yield from ``chunks`` and close ``reader`` once done or abandoned."""
+    try:
+        yield from chunks
+    finally:
+        reader.close()
+
+
+def open_plaintext(file_obj, start=0, stop=None):
+    """
+    Open a file's blob and return an iterator over its decrypted content.
+
+    The underlying file is closed when the iterator is exhausted or closed.
+    """
+    reader = PlaintextReader(file_obj)
+    return iter_closing(reader.iter_range(start, stop), reader)
@@ -0,0 +1,141 @@
+"""
+Optional compression stage applied to plaintext before it is encrypted.
+
+Whether a file is compressed is decided per upload: content types that are
+already compressed are skipped outright, and everything else is compressed
+only if a trial run over the first chunk saves enough space. zstd is used when
+the ``zstandard`` package is installed, zlib otherwise.
+
+A range of a compressed file can only be read by decompressing it from the
+start, so files known to be larger than ``FILE_COMPRESSION_MAX_SIZE`` are
+stored uncompressed, keeping their ranges as cheap as any other file's.
+"""
+import zlib
+
+from django.conf import settings
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    zstandard = None
+
+NONE = 'none'
+ZLIB = 'zlib'
+ZSTD = 'zstd'
+
+# Bytes of plaintext used for the trial compression
+TRIAL_SIZE = 64 * 1024
+READ_SIZE = 64 * 1024
+
+ALREADY_COMPRESSED_TYPES = {
+    'application/gzip',
+    'application/pdf',
+    'application/vnd.rar',
+    'application/x-7z-compressed',
+    'application/x-bzip2',
+    'application/x-rar-compressed',
+    'application/x-xz',
+    'application/zip',
+    'application/zstd',
+    'image/avif',
+    'image/gif',
+    'image/heic',
+    'image/jpeg',
+    'image/png',
+    'image/webp',
+}
+ALREADY_COMPRESSED_PREFIXES = ('audio/', 'video/')
+
+
+def configured_algorithm():
+    """The algorithm new uploads may use, or ``NONE`` if disabled."""
+    algorithm = getattr(settings, 'FILE_COMPRESSION_ALGORITHM', ZSTD)
+    if algorithm == ZSTD and zstandard is None:
+        return ZLIB
+    return algorithm if algorithm in (ZLIB, ZSTD) else NONE
+
+
+def is_already_compressed(mime_type):
+    mime_type = (mime_type or '').split(';')[0].strip().lower()
+    return (
+        mime_type in ALREADY_COMPRESSED_TYPES
+        or mime_type.startswith(ALREADY_COMPRESSED_PREFIXES)
+    )
+
+
+def choose(mime_type, sample, size=None):
+    """
+    Pick the compression for a file from its MIME type and a plaintext
+    sample, and its total ``size`` if known.
+    """
+    algorithm = configured_algorithm()
+    if algorithm == NONE or not sample or is_already_compressed(mime_type):
+        return NONE
+    max_size = getattr(settings, 'FILE_COMPRESSION_MAX_SIZE', 16 * 1024 * 1024)
+    if size is not None and size > max_size:
+        return NONE
+    compressor = get_compressor(algorithm)
+    trial = compressor.compress(sample) + compressor.flush()
+    max_ratio = getattr(settings, 'FILE_COMPRESSION_MAX_RATIO', 0.9)
+    return algorithm if len(trial) <= len(sample) * max_ratio else NONE
+
+
+def get_compressor(algorithm):
+    """Return a streaming compressor with ``compress()`` and ``flush()``."""
+    if algorithm == ZSTD:
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    if algorithm == ZLIB:
+        return zlib.compressobj(6)
+    raise ValueError(f'Unknown compression algorithm: {algorithm}')
+
+
+class _ChunkReader:
+    """File-like view over an iterator of byte strings."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def iter_decompress(algorithm, chunks):
+    """
+    Decompress an iterator of compressed chunks.
+
+    Output is produced in pieces of at most ``READ_SIZE`` bytes, so a highly
+    compressible segment never expands into one large buffer.
+    """
+    if algorithm == NONE:
+        yield from chunks
+    elif algorithm == ZLIB:
+        decompressor = zlib.decompressobj()
+        for chunk in chunks:
+            while chunk:
+                data = decompressor.decompress(chunk, READ_SIZE)
+                if data:
+                    yield data
+                chunk = decompressor.unconsumed_tail
+        data = decompressor.flush()
+        if data:
+            yield data
+    elif algorithm == ZSTD:
+        if zstandard is None:
+            raise RuntimeError('zstandard is required to read zstd-compressed files')
+        reader = zstandard.ZstdDecompressor().stream_reader(_ChunkReader(chunks))
+        while True:
+            data = reader.read(READ_SIZE)
+            if not data:
+                break
+            yield data
+    else:
+        raise ValueError(f'Unknown compression algorithm: {algorithm}')
@@ -0,0 +1,82 @@
+"""
+Validators and cache policy for file content and file listings.
+
+Content responses carry a strong ETag naming exactly the bytes sent: blobs
+are never rewritten in place, so their storage name identifies their content.
+Listings carry a weak ETag built from a change counter (``ListVersion``) per
+user, or for all files, bumped by the signals in ``files.signals``. Both are
+sent with ``Cache-Control: private, no-cache``, so browsers may keep them but
+must revalidate each time and shared caches never store them; everything
+else stays ``no-store``.
+"""
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils.cache import (
+    get_conditional_response, patch_cache_control, patch_vary_headers
+)
+
+from .models import ListVersion
+
+ALL = 'all'
+
+
+def user_scope(user_id):
+    """Scope of the listings of one user."""
+    return f'user:{user_id}'
+
+
+def content_etag(file_obj, raw=False):
+    """Strong ETag of ``file_obj``'s content, decrypted or (``raw``) as stored."""
+    return f'"{file_obj.name}{".raw" if raw else ""}"'
+
+
+def list_etag(scope, *extra):
+    """Weak ETag of a listing in ``scope``, qualified by ``extra`` values."""
+    version = ListVersion.objects.filter(scope=scope).values_list('version', flat=True).first()
+    return 'W/"{}"'.format('.'.join(str(part) for part in (scope, version or 0, *extra)))
+
+
+def bump(*scopes):
+    """Mark the listings in ``scopes`` as changed."""
+    for scope in set(scopes):
+        if ListVersion.objects.filter(scope=scope).update(version=F('version') + 1):
+            continue
+        try:
+            with transaction.atomic():
+                ListVersion.objects.create(scope=scope, version=1)
+        except IntegrityError:
+            # Created concurrently
+            ListVersion.objects.filter(scope=scope).update(version=F('version') + 1)
+
+
+def page_key(request):
+    """Extra ``list_etag`` parts naming the page of a listing ``request`` asks for."""
+    query = request.GET.urlencode()
+    return (query,) if query else ()
+
+
+def set_validators(response, etag):
+    """Send ``etag`` and allow private caching with revalidation."""
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ('Authorization',))
+    return response
+
+
+def not_modified(request, etag):
+    """
+    The ``304 Not Modified`` (or ``412``) response to send if ``request``'s
+    preconditions settle it for ``etag``, or ``None`` to send the content.
+    """
+    response = get_conditional_response(request, etag=etag)
+    return set_validators(response, etag) if response is not None else None
+
+
+def conditional_list(request, etag, build):
+    """Answer a listing request from ``etag``, calling ``build`` only if needed."""
+    response = not_modified(request, etag)
+    if response is None:
+        response = build()
+        if response.status_code == 200:
+            set_validators(response, etag)
+    return response
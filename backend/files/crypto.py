@@ -0,0 +1,363 @@
+"""
+Segmented authenticated encryption for stored file blobs.
+
+Blobs are written as a small header followed by fixed-size segments, each
+sealed independently with an AEAD cipher:
+
+    header  = MAGIC (4) | version (1) | algorithm (1) | segment_size (4) | nonce_prefix (7)
+    segment = AEAD(plaintext[i * segment_size:(i + 1) * segment_size]) + tag (16)
+
+The nonce of segment ``i`` is ``nonce_prefix | i (4 bytes) | final flag (1 byte)``
+and the header is passed as associated data, so segments cannot be reordered,
+dropped, truncated or spliced between files without failing authentication.
+Only one segment is held in memory at a time and the stored blob is the
+plaintext size plus 16 bytes per segment.
+"""
+import atexit
+import base64
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from django.conf import settings
+
+MAGIC = b'SFSE'
+FORMAT_VERSION = 1
+
+ALGORITHM_AES_256_GCM = 1
+ALGORITHM_CHACHA20_POLY1305 = 2
+
+_CIPHERS = {
+    ALGORITHM_AES_256_GCM: AESGCM,
+    ALGORITHM_CHACHA20_POLY1305: ChaCha20Poly1305,
+}
+
+HEADER = struct.Struct('>4sBBI7s')
+NONCE_PREFIX_SIZE = 7
+TAG_SIZE = 16
+KEY_SIZE = 32
+DEFAULT_SEGMENT_SIZE = 64 * 1024
+MAX_SEGMENT_SIZE = 16 * 1024 * 1024
+
+Header = namedtuple('Header', ['version', 'algorithm', 'segment_size', 'nonce_prefix', 'raw'])
+
+
+class DecryptionError(Exception):
+    """Raised when a blob is malformed or fails authentication."""
+
+
+def generate_key():
+    """Return a new random data key, urlsafe base64 encoded for storage."""
+    return base64.urlsafe_b64encode(os.urandom(KEY_SIZE)).decode()
+
+
+def _decode_key(key):
+    if isinstance(key, str):
+        key = key.encode()
+    raw = base64.urlsafe_b64decode(key)
+    if len(raw) != KEY_SIZE:
+        raise ValueError('Data keys must be 32 bytes')
+    return raw
+
+
+def default_segment_size():
+    return getattr(settings, 'FILE_ENCRYPTION_SEGMENT_SIZE', DEFAULT_SEGMENT_SIZE)
+
+
+def segment_nonce(nonce_prefix, index, final):
+    """Build the 12-byte nonce for a segment from its position in the blob."""
+    return nonce_prefix + struct.pack('>IB', index, 1 if final else 0)
+
+
+def segment_count(plaintext_size, segment_size):
+    """Number of segments in a blob; an empty blob still has one."""
+    return max(1, -(-plaintext_size // segment_size))
+
+
+def segment_offset(index, segment_size):
+    """Byte offset of segment ``index`` within a stored blob."""
+    return HEADER.size + index * (segment_size + TAG_SIZE)
+
+
+def ciphertext_size(plaintext_size, segment_size):
+    """Return the stored size of a blob holding ``plaintext_size`` bytes."""
+    return HEADER.size + plaintext_size + segment_count(plaintext_size, segment_size) * TAG_SIZE
+
+
+def new_header(segment_size=None, algorithm=ALGORITHM_AES_256_GCM):
+    """Build a header with a fresh random nonce prefix."""
+    segment_size = segment_size or default_segment_size()
+    if not 0 < segment_size <= MAX_SEGMENT_SIZE:
+        raise ValueError('Invalid segment size')
+    return HEADER.pack(
+        MAGIC, FORMAT_VERSION, algorithm, segment_size, os.urandom(NONCE_PREFIX_SIZE)
+    )
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Return the shared pool used to seal and open segments in parallel, or
+    ``None`` when ``FILE_CRYPTO_WORKERS`` is 1 or less.
+
+    The ``cryptography`` AEAD primitives release the GIL, so a thread pool
+    scales across cores; ``FILE_CRYPTO_EXECUTOR = 'process'`` selects a
+    process pool instead.
+    """
+    global _executor
+    workers = getattr(settings, 'FILE_CRYPTO_WORKERS', 1)
+    if workers <= 1:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            if getattr(settings, 'FILE_CRYPTO_EXECUTOR', 'thread') == 'process':
+                _executor = ProcessPoolExecutor(max_workers=workers)
+            else:
+                _executor = ThreadPoolExecutor(
+                    max_workers=workers, thread_name_prefix='file-crypto'
+                )
+            atexit.register(_executor.shutdown)
+        return _executor
+
+
+def _seal_segment(algorithm, key, nonce, data, aad):
+    return _CIPHERS[algorithm](key).encrypt(nonce, data, aad)
+
+
+def _open_segment(algorithm, key, nonce, data, aad):
+    return _CIPHERS[algorithm](key).decrypt(nonce, data, aad)
+
+
+class _SegmentCipher:
+    """
+    Seals or opens batches of ``(nonce, data)`` segments, fanning them out
+    over the crypto pool when one is configured. Results keep input order.
+    """
+
+    def __init__(self, algorithm, key, aad):
+        self.algorithm = algorithm
+        self.key = key
+        self.aad = aad
+        self._cipher = _CIPHERS[algorithm](key)
+        self._executor = get_executor()
+        # Enough segments per batch to keep every worker busy
+        self.batch_size = settings.FILE_CRYPTO_WORKERS * 2 if self._executor else 1
+
+    def _map(self, method, func, items):
+        if self._executor is None or len(items) < 2:
+            return [method(nonce, data, self.aad) for nonce, data in items]
+        nonces = [nonce for nonce, _ in items]
+        datas = [data for _, data in items]
+        if isinstance(self._executor, ThreadPoolExecutor):
+            return list(self._executor.map(method, nonces, datas, repeat(self.aad)))
+        # Cipher objects and memory views cannot be pickled, so process
+        # workers rebuild the cipher and get copies of the data
+        datas = [bytes(data) for data in datas]
+        return list(self._executor.map(
+            func, repeat(self.algorithm), repeat(self.key), nonces, datas, repeat(self.aad)
+        ))
+
+    def seal(self, items):
+        return self._map(self._cipher.encrypt, _seal_segment, items)
+
+    def open(self, items):
+        return self._map(self._cipher.decrypt, _open_segment, items)
+
+
+class SegmentEncryptor:
+    """
+    Incrementally encrypts a plaintext stream into the segmented format.
+
+    Feed plaintext with ``update()`` and write out whatever it returns, then
+    write the result of ``finalize()``. The header is emitted with the first
+    output so callers never have to handle it separately. When a crypto pool
+    is configured, full segments are buffered into batches and sealed in
+    parallel; output order is unchanged.
+
+    Passing an existing ``header`` and ``first_index`` instead encrypts a run
+    of segments in the middle of a blob (for example one chunk of a resumable
+    upload); no header is emitted and the run is ended with
+    ``finalize(final=False)`` unless it holds the blob's last segment.
+    """
+
+    def __init__(self, key, segment_size=None, algorithm=ALGORITHM_AES_256_GCM,
+                 header=None, first_index=0):
+        if header is None:
+            self.header = new_header(segment_size, algorithm)
+            self._header_written = False
+        else:
+            self.header = header
+            self._header_written = True
+        parsed = parse_header(self.header)
+        self.segment_size = parsed.segment_size
+        self.algorithm = parsed.algorithm
+        self._nonce_prefix = parsed.nonce_prefix
+        self._cipher = _SegmentCipher(self.algorithm, _decode_key(key), self.header)
+        self._buffer = bytearray()
+        self._index = first_index
+        self._finalized = False
+        # Plaintext bytes sealed and time spent sealing them, for reporting
+        self.bytes_processed = 0
+        self.elapsed = 0.0
+
+    def _seal(self, segments, final):
+        """Seal full ``segments`` and, if ``final``, the remaining buffer."""
+        items = []
+        for data in segments:
+            is_last = final and len(items) == len(segments) - 1
+            items.append((segment_nonce(self._nonce_prefix, self._index, is_last), data))
+            self._index += 1
+        started = time.perf_counter()
+        sealed = self._cipher.seal(items)
+        self.elapsed += time.perf_counter() - started
+        self.bytes_processed += sum(len(data) for _, data in items)
+        return sealed
+
+    def _start(self):
+        if self._header_written:
+            return []
+        self._header_written = True
+        return [self.header]
+
+    def _take_segments(self, count):
+        segments = [
+            bytes(self._buffer[i * self.segment_size:(i + 1) * self.segment_size])
+            for i in range(count)
+        ]
+        del self._buffer[:count * self.segment_size]
+        return segments
+
+    def update(self, data):
+        if self._finalized:
+            raise ValueError('Encryptor already finalized')
+        self._buffer += data
+        out = self._start()
+        # Always keep the last (possibly full) segment back: only finalize()
+        # knows whether it is the final one.
+        full = (len(self._buffer) - 1) // self.segment_size
+        if full >= self._cipher.batch_size:
+            out.extend(self._seal(self._take_segments(full), final=False))
+        return b''.join(out)
+
+    def finalize(self, final=True):
+        if self._finalized:
+            raise ValueError('Encryptor already finalized')
+        if not final and len(self._buffer) % self.segment_size:
+            raise ValueError('A non-final run must end on a segment boundary')
+        out = self._start()
+        segments = self._take_segments(len(self._buffer) // self.segment_size)
+        if final and (self._buffer or not segments):
+            segments.append(bytes(self._buffer))
+        out.extend(self._seal(segments, final=final))
+        self._buffer = bytearray()
+        self._finalized = True
+        return b''.join(out)
+
+
+def parse_header(raw):
+    """Validate and unpack a blob header."""
+    if len(raw) != HEADER.size:
+        raise DecryptionError('Truncated header')
+    magic, version, algorithm, segment_size, nonce_prefix = HEADER.unpack(raw)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise DecryptionError('Unrecognised blob format')
+    if algorithm not in _CIPHERS or not 0 < segment_size <= MAX_SEGMENT_SIZE:
+        raise DecryptionError('Unsupported blob parameters')
+    return Header(version, algorithm, segment_size, nonce_prefix, raw)
+
+
+def read_header(fileobj):
+    return parse_header(bytes(fileobj.read(HEADER.size)))
+
+
+def _read_exact(fileobj, size):
+    chunk = fileobj.read(size)
+    if len(chunk) == size or not chunk:
+        # Memory-mapped blobs return views; pass them on without copying
+        return chunk
+    chunks = [chunk]
+    size -= len(chunk)
+    while size:
+        chunk = fileobj.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def _open_batch(cipher, batch):
+    try:
+        return cipher.open(batch)
+    except InvalidTag:
+        raise DecryptionError('A segment failed authentication')
+
+
+def iter_decrypt(fileobj, key, header=None):
+    """
+    Yield the plaintext of a segmented blob in order.
+
+    The file object must be positioned at the start of the blob, or just past
+    the header if an already parsed ``header`` is given. Segments are read in
+    batches the size of the crypto pool (one at a time without a pool) and a
+    segment of read-ahead is used to detect the final segment, so truncating
+    the blob at a segment boundary is detected as well.
+    """
+    if header is None:
+        header = read_header(fileobj)
+    cipher = _SegmentCipher(header.algorithm, _decode_key(key), header.raw)
+    stored_segment_size = header.segment_size + TAG_SIZE
+
+    index = 0
+    batch = []
+    current = _read_exact(fileobj, stored_segment_size)
+    while True:
+        following = _read_exact(fileobj, stored_segment_size)
+        final = not following
+        batch.append((segment_nonce(header.nonce_prefix, index, final), current))
+        if final or len(batch) >= cipher.batch_size:
+            yield from _open_batch(cipher, batch)
+            batch = []
+        if final:
+            return
+        current = following
+        index += 1
+
+
+def iter_decrypt_range(fileobj, key, header, plaintext_size, start, stop):
+    """
+    Yield plaintext bytes ``[start, stop)`` of a segmented blob.
+
+    Seeks straight to the segments covering the range, so the cost depends on
+    the length of the range rather than its position. ``plaintext_size`` must
+    be the size the blob was written with; it identifies the final segment,
+    and a wrong value fails authentication.
+    """
+    if start >= stop:
+        return
+    segment_size = header.segment_size
+    cipher = _SegmentCipher(header.algorithm, _decode_key(key), header.raw)
+    last_index = segment_count(plaintext_size, segment_size) - 1
+    first = start // segment_size
+    last = (stop - 1) // segment_size
+
+    fileobj.seek(segment_offset(first, segment_size))
+    for batch_start in range(first, last + 1, cipher.batch_size):
+        indexes = range(batch_start, min(batch_start + cipher.batch_size, last + 1))
+        batch = [
+            (segment_nonce(header.nonce_prefix, index, index == last_index),
+             _read_exact(fileobj, segment_size + TAG_SIZE))
+            for index in indexes
+        ]
+        for index, plaintext in zip(indexes, _open_batch(cipher, batch)):
+            base = index * segment_size
+            yield plaintext[max(start - base, 0):stop - base]
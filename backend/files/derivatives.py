@@ -0,0 +1,230 @@
+"""
+Preview derivatives: downscaled thumbnails of images and excerpts of the first
+page of text and PDF files, served by ``preview?variant=thumb``.
+
+A derivative is made from the decrypted original when a file is uploaded or
+first previewed, encrypted under a data key of its own into blob storage, and
+shared by every file of the blob. Their total size is bounded by
+``FILE_DERIVATIVE_CACHE_SIZE``: past it, the least recently served derivatives
+are evicted, to be made again if they are asked for.
+
+Thumbnails need Pillow and PDF excerpts pypdf. Files without a derivative
+(other types, client-encrypted content, or those libraries missing) are
+previewed in full.
+"""
+import atexit
+import io
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from . import blobs, compression, crypto, keys
+from .models import Derivative, File
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover - optional dependency
+    Image = None
+
+try:
+    import pypdf
+except ImportError:  # pragma: no cover - optional dependency
+    pypdf = None
+
+THUMB = 'thumb'
+VARIANTS = (THUMB,)
+
+THUMBNAIL_SIZE = (256, 256)
+# Characters of text kept in an excerpt
+EXCERPT_LENGTH = 4000
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _base_type(mime_type):
+    return (mime_type or '').split(';')[0].strip().lower()
+
+
+def can_derive(file_obj, variant=THUMB):
+    """Whether ``file_obj`` can have a ``variant`` derivative at all."""
+    if not file_obj.blob_id or file_obj.storage_format == File.StorageFormat.CLIENT_ENCRYPTED:
+        return False
+    mime_type = _base_type(file_obj.mime_type)
+    if mime_type.startswith('text/'):
+        return True
+    if file_obj.size > settings.FILE_DERIVATIVE_MAX_SOURCE_SIZE:
+        # Images and PDFs are decoded whole
+        return False
+    if mime_type.startswith('image/'):
+        return Image is not None
+    return mime_type == 'application/pdf' and pypdf is not None
+
+
+def _read_plaintext(file_obj, stop=None):
+    return b''.join(blobs.open_plaintext(file_obj, 0, stop))
+
+
+def _render_image(file_obj):
+    image = Image.open(io.BytesIO(_read_plaintext(file_obj)))
+    # Let JPEG decoding downscale on the way in
+    image.draft('RGB', THUMBNAIL_SIZE)
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail(THUMBNAIL_SIZE)
+    out = io.BytesIO()
+    if image.mode in ('RGBA', 'LA') or 'transparency' in image.info:
+        image.save(out, 'PNG', optimize=True)
+        return out.getvalue(), 'image/png'
+    image.convert('RGB').save(out, 'JPEG', quality=80)
+    return out.getvalue(), 'image/jpeg'
+
+
+def _render_text(file_obj):
+    # UTF-8 needs at most 4 bytes per character
+    data = _read_plaintext(file_obj, EXCERPT_LENGTH * 4)
+    text = data.decode('utf-8', errors='ignore')[:EXCERPT_LENGTH]
+    return text.encode(), 'text/plain; charset=utf-8'
+
+
+def _render_pdf(file_obj):
+    reader = pypdf.PdfReader(io.BytesIO(_read_plaintext(file_obj)))
+    text = reader.pages[0].extract_text() if reader.pages else ''
+    return text[:EXCERPT_LENGTH].encode(), 'text/plain; charset=utf-8'
+
+
+def render(file_obj, variant=THUMB):
+    """
+    Render the ``variant`` derivative of ``file_obj`` from its plaintext.
+
+    Returns ``(content, mime_type)``, or ``None`` if the file can't have one.
+    """
+    if not can_derive(file_obj, variant):
+        return None
+    mime_type = _base_type(file_obj.mime_type)
+    try:
+        if mime_type.startswith('text/'):
+            return _render_text(file_obj)
+        if mime_type.startswith('image/'):
+            return _render_image(file_obj)
+        return _render_pdf(file_obj)
+    except Exception as e:
+        # Unreadable or unsupported content: preview the original instead
+        logger.info('No %s derivative for %s: %s', variant, file_obj.name, e)
+        return None
+
+
+def get_derivative(file_obj, variant=THUMB):
+    """
+    Return the ``variant`` derivative of ``file_obj``, making it if there is
+    none yet, or ``None`` if the file can't have one.
+    """
+    if not can_derive(file_obj, variant):
+        return None
+    derivative = Derivative.objects.filter(blob_id=file_obj.blob_id, variant=variant).first()
+    if derivative is not None:
+        Derivative.objects.filter(pk=derivative.pk).update(last_accessed_at=timezone.now())
+        return derivative
+
+    rendered = render(file_obj, variant)
+    if rendered is None:
+        return None
+    content, mime_type = rendered
+    key = crypto.generate_key()
+    writer = blobs.BlobWriter(blobs.new_blob_name(), key, mime_type, compress=False)
+    try:
+        writer.write(content)
+    except Exception:
+        writer.abort()
+        raise
+    writer.close()
+
+    try:
+        with transaction.atomic():
+            derivative = Derivative.objects.create(
+                blob_id=file_obj.blob_id,
+                variant=variant,
+                name=writer.name,
+                encryption_key=keys.wrap(key),
+                mime_type=mime_type,
+                size=writer.size
+            )
+    except IntegrityError:
+        # Made by a concurrent preview first, or the blob went away
+        blobs.delete_blob(writer.name)
+        return Derivative.objects.filter(blob_id=file_obj.blob_id, variant=variant).first()
+    evict()
+    return derivative
+
+
+def evict(limit=None):
+    """
+    Delete the least recently served derivatives until their total size is
+    at most ``limit`` (default ``FILE_DERIVATIVE_CACHE_SIZE``). Returns the
+    number of bytes freed.
+    """
+    limit = settings.FILE_DERIVATIVE_CACHE_SIZE if limit is None else limit
+    total = Derivative.objects.aggregate(total=Sum('size'))['total'] or 0
+    freed = 0
+    if total <= limit:
+        return freed
+    for derivative in Derivative.objects.order_by('last_accessed_at').only('pk', 'name', 'size'):
+        if total - freed <= limit:
+            break
+        # The stored derivative is deleted by the post_delete signal
+        derivative.delete()
+        freed += derivative.size
+    return freed
+
+
+def preview_file(file_obj, variant):
+    """
+    The file to send for a ``variant`` preview of ``file_obj``: an unsaved
+    stand-in pointing at its derivative, or ``file_obj`` itself if it has none.
+    """
+    derivative = get_derivative(file_obj, variant)
+    if derivative is None:
+        return file_obj
+    return File(
+        name=derivative.name,
+        original_name=file_obj.original_name,
+        mime_type=derivative.mime_type,
+        size=derivative.size,
+        encryption_key_id=derivative.encryption_key,
+        storage_format=File.StorageFormat.SEGMENTED_AEAD,
+        compression=compression.NONE,
+        client_key=None
+    )
+
+
+def _make_all(file_obj):
+    try:
+        for variant in VARIANTS:
+            get_derivative(file_obj, variant)
+    except Exception:
+        logger.exception('Failed to make derivatives of %s', file_obj.name)
+    finally:
+        connection.close()
+
+
+def schedule(file_obj):
+    """
+    Make the derivatives of a newly stored file in the background, if
+    ``FILE_DERIVATIVES_ON_UPLOAD`` is enabled. Call once the file is committed.
+    """
+    global _executor
+    if not settings.FILE_DERIVATIVES_ON_UPLOAD:
+        return
+    if not any(can_derive(file_obj, variant) for variant in VARIANTS):
+        return
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='file-derivatives')
+            atexit.register(_executor.shutdown)
+    _executor.submit(_make_all, file_obj)
@@ -0,0 +1,178 @@
+"""
+Envelope encryption of the per-file data keys.
+
+Every blob is encrypted with its own random data key, and that key is only
+ever stored wrapped (AES-256-GCM) by a key-encryption key (KEK). Wrapped keys
+are stored as ``kek:<kek id>:<base64 nonce + ciphertext>``, so rotating the
+KEK means rewrapping these short records (``manage.py rewrap_keys``) rather
+than re-encrypting blobs. Values without the prefix are data keys stored
+before envelope encryption; migration 0018 wraps them, and they are still
+accepted until then.
+
+KEKs come from the provider named by ``FILE_KEY_PROVIDER``, by default a JSON
+keyfile at ``FILE_KEK_FILE``::
+
+    {"active": "<kek id>", "keys": {"<kek id>": "<urlsafe base64, 32 bytes>"}}
+
+New keys are wrapped with the active KEK; retired KEKs must stay in the
+keyfile until no record is wrapped with them. Unwrapped data keys are kept in
+a bounded LRU cache so hot files skip the unwrap.
+"""
+import base64
+import json
+import os
+import threading
+from collections import namedtuple
+from functools import lru_cache
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+WRAPPED_PREFIX = 'kek'
+NONCE_SIZE = 12
+KEK_SIZE = 32
+
+Keyring = namedtuple('Keyring', ['active', 'keys'])
+
+_keyring = None
+_keyring_lock = threading.Lock()
+
+
+class UnknownKeyError(Exception):
+    """A data key was wrapped with a KEK that is not in the keyring."""
+
+
+def _keyfile_path():
+    return getattr(settings, 'FILE_KEK_FILE', os.path.join(settings.BASE_DIR, 'kek.json'))
+
+
+def _new_kek_id():
+    return timezone.now().strftime('%Y%m%d%H%M%S')
+
+
+def _write_keyfile(path, active, keys):
+    data = {
+        'active': active,
+        'keys': {
+            kek_id: base64.urlsafe_b64encode(key).decode()
+            for kek_id, key in keys.items()
+        },
+    }
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def load_keyfile():
+    """
+    Default key provider: read the KEKs from ``FILE_KEK_FILE``.
+
+    If ``FILE_KEK_AUTOCREATE`` is set (in development), a keyfile with a
+    fresh KEK is created when none exists.
+    """
+    path = _keyfile_path()
+    if not os.path.exists(path):
+        if not getattr(settings, 'FILE_KEK_AUTOCREATE', False):
+            raise ImproperlyConfigured(f'Key-encryption keyfile not found: {path}')
+        _write_keyfile(path, 'dev', {'dev': os.urandom(KEK_SIZE)})
+
+    with open(path) as f:
+        data = json.load(f)
+    keys = {
+        kek_id: base64.urlsafe_b64decode(value)
+        for kek_id, value in data.get('keys', {}).items()
+    }
+    active = data.get('active')
+    if active not in keys:
+        raise ImproperlyConfigured(f'Active key-encryption key {active!r} is not in {path}')
+    if any(len(key) != KEK_SIZE for key in keys.values()):
+        raise ImproperlyConfigured('Key-encryption keys must be 32 bytes')
+    return Keyring(active, keys)
+
+
+def add_kek():
+    """
+    Generate a new KEK, add it to the keyfile and make it the active one.
+
+    Only applies to the default keyfile provider. Returns the new KEK id.
+    """
+    keyring = load_keyfile()
+    kek_id = _new_kek_id()
+    if kek_id in keyring.keys:
+        raise ImproperlyConfigured(f'Key-encryption key {kek_id!r} already exists')
+    keys = dict(keyring.keys, **{kek_id: os.urandom(KEK_SIZE)})
+    _write_keyfile(_keyfile_path(), kek_id, keys)
+    reset_keyring()
+    return kek_id
+
+
+def get_keyring():
+    global _keyring
+    if _keyring is None:
+        with _keyring_lock:
+            if _keyring is None:
+                provider = getattr(settings, 'FILE_KEY_PROVIDER', 'files.keys.load_keyfile')
+                _keyring = import_string(provider)()
+    return _keyring
+
+
+def reset_keyring():
+    """Forget the loaded KEKs and cached data keys, e.g. after a rotation."""
+    global _keyring
+    with _keyring_lock:
+        _keyring = None
+    _unwrap.cache_clear()
+
+
+def wrap(data_key, kek_id=None):
+    """Wrap a data key (as returned by ``crypto.generate_key``) for storage."""
+    keyring = get_keyring()
+    kek_id = kek_id or keyring.active
+    nonce = os.urandom(NONCE_SIZE)
+    sealed = AESGCM(keyring.keys[kek_id]).encrypt(
+        nonce, data_key.encode(), kek_id.encode()
+    )
+    return f'{WRAPPED_PREFIX}:{kek_id}:{base64.urlsafe_b64encode(nonce + sealed).decode()}'
+
+
+def wrapped_with(value):
+    """The id of the KEK ``value`` is wrapped with, or ``None`` for a bare key."""
+    prefix, _, rest = value.partition(':')
+    if prefix != WRAPPED_PREFIX or not rest:
+        return None
+    return rest.partition(':')[0]
+
+
+def unwrap(value):
+    """Return the data key held in a stored key record."""
+    if wrapped_with(value) is None:
+        return value
+    return _unwrap(value)
+
+
+@lru_cache(maxsize=getattr(settings, 'FILE_DATA_KEY_CACHE_SIZE', 1024))
+def _unwrap(value):
+    _, kek_id, payload = value.split(':', 2)
+    keys = get_keyring().keys
+    if kek_id not in keys:
+        raise UnknownKeyError(f'Unknown key-encryption key {kek_id!r}')
+    raw = base64.urlsafe_b64decode(payload)
+    return AESGCM(keys[kek_id]).decrypt(
+        raw[:NONCE_SIZE], raw[NONCE_SIZE:], kek_id.encode()
+    ).decode()
+
+
+def rewrap(value, kek_id=None):
+    """Rewrap a stored key record (wrapped or bare) with ``kek_id``."""
+    return wrap(unwrap(value), kek_id)
+
+
+def cache_info():
+    """Hit/miss statistics of the unwrapped data key cache."""
+    return _unwrap.cache_info()
@@ -0,0 +1,86 @@
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from files.storage import ShardedStorage
+
+
+class Command(BaseCommand):
+    help = (
+        'Compares stat() and open() latency of blobs in the flat and sharded '
+        'layouts, using empty files in a scratch directory.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--files', type=int, default=100000,
+            help='Files created in each layout'
+        )
+        parser.add_argument(
+            '--lookups', type=int, default=10000,
+            help='Random lookups timed per operation and layout'
+        )
+        parser.add_argument(
+            '--levels', type=int, default=2,
+            help='Shard levels of the sharded layout'
+        )
+        parser.add_argument(
+            '--dir', default=None,
+            help='Scratch directory, on the filesystem to measure (default: a temp dir)'
+        )
+
+    def handle(self, *args, **options):
+        scratch = tempfile.mkdtemp(prefix='blob-layout-', dir=options['dir'])
+        try:
+            names = [f'{random.getrandbits(128):032x}.bin' for _ in range(options['files'])]
+            sample = random.choices(names, k=options['lookups'])
+            layouts = {
+                'flat': ShardedStorage(location=os.path.join(scratch, 'flat'), levels=0),
+                'sharded': ShardedStorage(
+                    location=os.path.join(scratch, 'sharded'), levels=options['levels']
+                ),
+            }
+            for label, storage in layouts.items():
+                os.makedirs(storage.location)
+                started = time.perf_counter()
+                for name in names:
+                    path = os.path.join(storage.location, storage.shard_name(name))
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    open(path, 'wb').close()
+                created = time.perf_counter() - started
+                self.stdout.write(f'{label}: created {len(names)} files in {created:.2f}s')
+
+            for operation in ('stat', 'open'):
+                for label, storage in layouts.items():
+                    timings = self.measure(storage, sample, operation)
+                    self.stdout.write(
+                        f'{operation:5} {label:8} '
+                        f'p50 {self.percentile(timings, 50):8.1f}us  '
+                        f'p99 {self.percentile(timings, 99):8.1f}us  '
+                        f'mean {statistics.fmean(timings):8.1f}us'
+                    )
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    def measure(self, storage, names, operation):
+        """Per-lookup latency in microseconds, resolving paths like the app does."""
+        timings = []
+        for name in names:
+            started = time.perf_counter()
+            path = storage.path(name)
+            if operation == 'stat':
+                os.stat(path)
+            else:
+                with open(path, 'rb'):
+                    pass
+            timings.append((time.perf_counter() - started) * 1e6)
+        return timings
+
+    def percentile(self, timings, percent):
+        ordered = sorted(timings)
+        return ordered[min(len(ordered) - 1, len(ordered) * percent // 100)]
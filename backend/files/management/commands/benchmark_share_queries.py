@@ -0,0 +1,187 @@
+import random
+import statistics
+import time
+import uuid
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from files import access
+from files.models import File, FileShare
+from files.views import users_with_email
+
+User = get_user_model()
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        'Times the hot sharing queries against generated users, files and '
+        'shares, with and without the indexes declared on File, FileShare '
+        'and User, and prints their query plans. Everything is created in '
+        'a transaction that is rolled back.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--shares', type=int, default=1000000,
+            help='Shares created'
+        )
+        parser.add_argument(
+            '--users', type=int, default=10000,
+            help='Users created'
+        )
+        parser.add_argument(
+            '--files', type=int, default=100000,
+            help='Files created'
+        )
+        parser.add_argument(
+            '--lookups', type=int, default=200,
+            help='Times each query is run per index setting'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=5000,
+            help='Rows per INSERT while generating data'
+        )
+
+    def handle(self, *args, **options):
+        if not connection.features.can_rollback_ddl:
+            raise CommandError(
+                f"{connection.vendor} can't roll back index changes; "
+                "run this against SQLite or PostgreSQL"
+            )
+        try:
+            with transaction.atomic():
+                self.run(options)
+                raise _Rollback
+        except _Rollback:
+            pass
+
+    def run(self, options):
+        started = time.perf_counter()
+        users, files, tokens = self.populate(options)
+        self.stdout.write(
+            f'Created {len(users)} users, {len(files)} files and {len(tokens)} shares '
+            f'in {time.perf_counter() - started:.1f}s'
+        )
+        self.analyze()
+
+        sample = [
+            (random.choice(users), random.choice(files), random.choice(tokens))
+            for _ in range(options['lookups'])
+        ]
+        queries = {
+            'shared listing': lambda user, file_id, token: File.objects.filter(
+                shares__shared_with=user, shares__expires_at__gt=timezone.now()
+            ).distinct(),
+            'access check': lambda user, file_id, token: access.accessible_files(user).filter(
+                pk=file_id
+            ),
+            'share by token': lambda user, file_id, token: FileShare.objects.filter(
+                access_token=token, expires_at__gt=timezone.now()
+            ),
+            'owned files': lambda user, file_id, token: File.objects.filter(owner=user),
+            'user by email': lambda user, file_id, token: users_with_email(user.email.upper()),
+        }
+
+        indexes = [
+            (model, index)
+            for model in (File, FileShare, User)
+            for index in model._meta.indexes
+        ]
+        results = {'with indexes': self.measure(queries, sample)}
+        # Dropped directly: SQLite's schema editor refuses to run inside a
+        # transaction, and both supported backends roll DROP INDEX back
+        with connection.cursor() as cursor:
+            for model, index in indexes:
+                cursor.execute(f'DROP INDEX {connection.ops.quote_name(index.name)}')
+        self.analyze()
+        results['without indexes'] = self.measure(queries, sample)
+
+        for label in queries:
+            self.stdout.write(f'\n{label}:')
+            for setting in ('without indexes', 'with indexes'):
+                plan, timings = results[setting][label]
+                self.stdout.write(
+                    f'  {setting}: median {statistics.median(timings) * 1000:.2f}ms, '
+                    f'p95 {self.percentile(timings, 95) * 1000:.2f}ms'
+                )
+                for line in plan.splitlines():
+                    self.stdout.write(f'    {line}')
+
+    def populate(self, options):
+        batch_size = options['batch_size']
+        # Unusable passwords skip the deliberately slow hashing
+        users = User.objects.bulk_create(
+            (
+                User(username=f'bench-{i}', email=f'Bench-{i}@example.com', password='!')
+                for i in range(options['users'])
+            ),
+            batch_size=batch_size
+        )
+        files = [
+            file_obj.pk
+            for file_obj in File.objects.bulk_create(
+                (
+                    File(
+                        name=f'bench-{i}',
+                        original_name=f'bench-{i}.txt',
+                        mime_type='text/plain',
+                        size=0,
+                        owner=random.choice(users),
+                        encryption_key_id=''
+                    )
+                    for i in range(options['files'])
+                ),
+                batch_size=batch_size
+            )
+        ]
+
+        now = timezone.now()
+        tokens = []
+        created = 0
+        while created < options['shares']:
+            batch = []
+            for _ in range(min(batch_size, options['shares'] - created)):
+                token = uuid.uuid4().hex
+                tokens.append(token)
+                batch.append(FileShare(
+                    file_id=random.choice(files),
+                    created_by=users[0],
+                    shared_with=random.choice(users),
+                    permission=random.choice(FileShare.Permissions.values),
+                    access_token=token,
+                    # A quarter of the shares have expired
+                    expires_at=now + timedelta(days=random.uniform(-1, 3))
+                ))
+            FileShare.objects.bulk_create(batch)
+            created += len(batch)
+        return users, files, tokens
+
+    def analyze(self):
+        # Refresh the planner's statistics after bulk changes
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def measure(self, queries, sample):
+        results = {}
+        for label, build in queries.items():
+            plan = build(*sample[0]).explain()
+            timings = []
+            for args in sample:
+                queryset = build(*args)
+                started = time.perf_counter()
+                list(queryset)
+                timings.append(time.perf_counter() - started)
+            results[label] = (plan, timings)
+        return results
+
+    def percentile(self, timings, percent):
+        ordered = sorted(timings)
+        return ordered[min(len(ordered) - 1, len(ordered) * percent // 100)]
@@ -0,0 +1,81 @@
+import time
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+
+from files.blobs import blob_storage
+from files.models import Blob, Derivative, File
+
+
+class Command(BaseCommand):
+    help = (
+        'Deletes stored blobs that no file, blob or derivative row refers to '
+        '(mark and sweep). The storage listing is streamed and checked against '
+        'the database a batch at a time.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--grace', type=int, default=24 * 3600,
+            help='Never delete blobs written in the last this many seconds, '
+                 'so uploads in flight are left alone'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Stored blobs checked per database query'
+        )
+        parser.add_argument(
+            '--max-deletes', type=float, default=0,
+            help='Deletions per second (0 for no limit)'
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only report the orphaned blobs and the space they take'
+        )
+
+    def handle(self, *args, **options):
+        storage = blob_storage()
+        if not hasattr(storage, 'iter_blobs'):
+            raise CommandError("STORAGES['blobs'] can't list its blobs")
+        cutoff = time.time() - options['grace']
+        pause = 1 / options['max_deletes'] if options['max_deletes'] else 0
+
+        scanned = 0
+        orphaned = 0
+        reclaimed = 0
+        listing = storage.iter_blobs()
+        while True:
+            batch = list(islice(listing, options['batch_size']))
+            if not batch:
+                break
+            scanned += len(batch)
+            candidates = {name: size for name, size, mtime in batch if mtime < cutoff}
+            live = self.live_names(candidates)
+            for name, size in candidates.items():
+                if name in live:
+                    continue
+                if options['verbosity'] > 1:
+                    self.stdout.write(f'  {name}: {size} bytes')
+                if not options['dry_run']:
+                    storage.delete(name)
+                    if pause:
+                        time.sleep(pause)
+                orphaned += 1
+                reclaimed += size
+            if scanned % (options['batch_size'] * 10) == 0:
+                self.stdout.write(f'  {scanned} scanned, {orphaned} orphaned')
+
+        verb = 'Would reclaim' if options['dry_run'] else 'Reclaimed'
+        self.stdout.write(self.style.SUCCESS(
+            f'Scanned {scanned} blobs: {verb} {reclaimed / 2 ** 20:.1f} MiB '
+            f'from {orphaned} orphaned blobs'
+        ))
+
+    def live_names(self, names):
+        """The subset of ``names`` that rows still refer to, via their indexed names."""
+        live = set()
+        for model in (File, Blob, Derivative):
+            live.update(
+                model.objects.filter(name__in=names).values_list('name', flat=True)
+            )
+        return live
@@ -0,0 +1,53 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from files.blobs import blob_storage
+from files.storage import PackedStorage
+
+
+class Command(BaseCommand):
+    help = (
+        'Rewrites blob pack files that are mostly dead space, moving their live '
+        'blobs into the current pack.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--threshold', type=float, default=0.5,
+            help='Compact packs whose live fraction is at most this (0-1)'
+        )
+        parser.add_argument(
+            '--min-age', type=int, default=3600,
+            help='Only compact packs not written to for this many seconds'
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only report what would be compacted'
+        )
+
+    def handle(self, *args, **options):
+        storage = blob_storage()
+        if not isinstance(storage, PackedStorage):
+            raise CommandError("STORAGES['blobs'] is not a PackedStorage (set FILE_BLOB_PACKING)")
+
+        packs = list(storage.pack_usage())
+        now = time.time()
+        compacted = 0
+        reclaimed = 0
+        # The newest pack is still being appended to
+        for pack_name, size, live, mtime in packs[:-1]:
+            ratio = live / size if size else 0
+            if ratio > options['threshold'] or now - mtime < options['min_age']:
+                continue
+            self.stdout.write(f'{pack_name}: {size} bytes, {ratio:.0%} live')
+            if options['dry_run']:
+                reclaimed += size - live
+            else:
+                reclaimed += storage.compact(pack_name)
+            compacted += 1
+
+        verb = 'Would compact' if options['dry_run'] else 'Compacted'
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb} {compacted} of {len(packs)} packs, reclaiming {reclaimed / 2 ** 20:.1f} MiB'
+        ))
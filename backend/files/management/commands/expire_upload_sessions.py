@@ -0,0 +1,90 @@
+import os
+import uuid
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from files.blobs import UPLOAD_PARTS_DIR, delete_parts
+from files.models import UploadChunk, UploadSession
+
+
+def _is_uuid(name):
+    try:
+        uuid.UUID(name)
+    except ValueError:
+        return False
+    return True
+
+
+class Command(BaseCommand):
+    help = (
+        'Deletes resumable upload sessions that have expired, with the '
+        'encrypted parts they received, then removes part directories in '
+        'default storage that no session refers to any more.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help='Sessions deleted per query'
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only report what would be deleted'
+        )
+
+    def handle(self, *args, **options):
+        sessions, parts = self.expire_sessions(options)
+        orphaned = self.sweep_parts(options)
+        verb = 'Would delete' if options['dry_run'] else 'Deleted'
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb} {sessions} expired sessions with {parts} parts, '
+            f'and {orphaned} orphaned part directories'
+        ))
+
+    def expire_sessions(self, options):
+        expired = UploadSession.objects.filter(expires_at__lt=timezone.now()).order_by('pk')
+        sessions = 0
+        parts = 0
+        last_pk = None
+        while True:
+            page = expired.filter(pk__gt=last_pk) if last_pk else expired
+            batch = list(page.values_list('pk', flat=True)[:options['batch_size']])
+            if not batch:
+                return sessions, parts
+            last_pk = batch[-1]
+            part_names = list(
+                UploadChunk.objects.filter(session__in=batch).values_list('part_name', flat=True)
+            )
+            if not options['dry_run']:
+                # Rows go first, so a chunk arriving meanwhile finds no session
+                UploadSession.objects.filter(pk__in=batch).delete()
+                delete_parts(part_names)
+            sessions += len(batch)
+            parts += len(part_names)
+
+    def sweep_parts(self, options):
+        """Remove the part directories of sessions that no longer exist."""
+        try:
+            directories, _ = default_storage.listdir(UPLOAD_PARTS_DIR)
+        except FileNotFoundError:
+            return 0
+        live = {
+            str(pk) for pk in UploadSession.objects.filter(
+                pk__in=[name for name in directories if _is_uuid(name)]
+            ).values_list('pk', flat=True)
+        }
+        orphaned = 0
+        for directory in directories:
+            if directory in live:
+                continue
+            path = os.path.join(UPLOAD_PARTS_DIR, directory)
+            _, files = default_storage.listdir(path)
+            if options['verbosity'] > 1:
+                self.stdout.write(f'  {path}: {len(files)} parts')
+            if not options['dry_run']:
+                delete_parts(os.path.join(path, name) for name in files)
+                default_storage.delete(path)
+            orphaned += 1
+        return orphaned
@@ -0,0 +1,80 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from files.blobs import blob_storage
+from files.storage import ShardedStorage
+
+
+class Command(BaseCommand):
+    help = (
+        'Moves blobs from the flat encrypted_files/ directory into the hashed '
+        'subdirectories of the sharded layout. Safe to run while serving traffic.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--flatten', action='store_true',
+            help='Move sharded blobs back into the flat layout instead'
+        )
+        parser.add_argument(
+            '--limit', type=int, default=0,
+            help='Stop after moving this many blobs (0 for all)'
+        )
+        parser.add_argument(
+            '--pause', type=float, default=0,
+            help='Seconds to sleep after every 1000 moves'
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only count the blobs that would be moved'
+        )
+
+    def handle(self, *args, **options):
+        storage = blob_storage()
+        if not isinstance(storage, ShardedStorage):
+            raise CommandError("STORAGES['blobs'] is not a ShardedStorage")
+        if not storage.levels and not options['flatten']:
+            raise CommandError('Sharding is disabled (FILE_BLOB_SHARD_LEVELS is 0)')
+        root = storage.location
+
+        moved = 0
+        conflicts = 0
+        for source, name in self.iter_blobs(root, options['flatten']):
+            target = name if options['flatten'] else storage.shard_name(name)
+            target = os.path.join(root, target)
+            if os.path.lexists(target):
+                self.stderr.write(f'Skipping {name}: already exists at {target}')
+                conflicts += 1
+                continue
+            if not options['dry_run']:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                # A rename within one filesystem is atomic: readers see the
+                # blob at one path or the other, and open handles stay valid
+                os.rename(source, target)
+            moved += 1
+            if moved % 1000 == 0:
+                self.stdout.write(f'  {moved} moved')
+                if options['pause']:
+                    time.sleep(options['pause'])
+            if options['limit'] and moved >= options['limit']:
+                break
+
+        verb = 'Would move' if options['dry_run'] else 'Moved'
+        self.stdout.write(self.style.SUCCESS(f'{verb} {moved} blobs, {conflicts} skipped'))
+
+    def iter_blobs(self, root, sharded):
+        """Yield ``(path, name)`` of blobs in the layout being migrated from."""
+        if not sharded:
+            with os.scandir(root) as entries:
+                for entry in entries:
+                    if entry.is_file() and not entry.name.startswith('.'):
+                        yield entry.path, entry.name
+            return
+        for directory, subdirectories, names in os.walk(root):
+            if directory == root:
+                continue
+            for name in names:
+                if not name.startswith('.'):
+                    yield os.path.join(directory, name), name
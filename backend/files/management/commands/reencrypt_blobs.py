@@ -0,0 +1,334 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection
+from django.db.models import Sum
+from django.utils import timezone
+
+from files import blobs, crypto
+from files.models import Blob, File
+
+ALGORITHMS = {
+    'aes-256-gcm': crypto.ALGORITHM_AES_256_GCM,
+    'chacha20-poly1305': crypto.ALGORITHM_CHACHA20_POLY1305,
+}
+
+# Files predating deduplication own their blob; the rest share one per Blob
+PHASES = ('files', 'blobs')
+
+# Attempts at switching a file to its rewritten blob while the database is
+# busy (locked, or a serialization failure), with exponential backoff
+SWAP_ATTEMPTS = 5
+SWAP_BACKOFF = 0.5
+
+
+class Throttle:
+    """Token bucket shared by all workers, in bytes per second."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._allowance = rate
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __call__(self, size):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._allowance = min(self.rate, self._allowance + (now - self._last) * self.rate)
+            self._last = now
+            self._allowance -= size
+            wait = -self._allowance / self.rate if self._allowance < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class Command(BaseCommand):
+    help = (
+        'Re-encrypts every stored blob with a fresh data key in the current storage '
+        'format, throttled and resumable from a checkpoint.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--legacy-only', action='store_true',
+            help='Only migrate files still stored in the legacy Fernet format'
+        )
+        parser.add_argument(
+            '--algorithm', choices=sorted(ALGORITHMS), default='aes-256-gcm',
+            help='Cipher for the rewritten blobs'
+        )
+        parser.add_argument(
+            '--segment-size', type=int, default=None,
+            help='Segment size for the rewritten blobs (default FILE_ENCRYPTION_SEGMENT_SIZE)'
+        )
+        parser.add_argument(
+            '--workers', type=int, default=None,
+            help='Blobs rewritten in parallel (default 2, or 1 on SQLite)'
+        )
+        parser.add_argument(
+            '--max-mbps', type=float, default=0,
+            help='I/O budget in MiB/s of plaintext across all workers; each byte is '
+                 'read and written once (0 for no limit)'
+        )
+        parser.add_argument(
+            '--cpu-budget', type=float, default=1.0,
+            help='Fraction of each worker\'s time spent working; the rest is slept (0-1]'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help='Rows fetched per query; the checkpoint is written after each batch'
+        )
+        parser.add_argument(
+            '--checkpoint', default=os.path.join(settings.BASE_DIR, 'reencrypt_checkpoint.json'),
+            help='Progress file used to resume an interrupted run'
+        )
+        parser.add_argument(
+            '--restart', action='store_true',
+            help='Ignore an existing checkpoint and start from the beginning'
+        )
+        parser.add_argument(
+            '--verify', action='store_true',
+            help='Read every rewritten blob back and check its digest before switching to it'
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Count the work and estimate throughput on a sample without writing'
+        )
+        parser.add_argument(
+            '--sample', type=int, default=20,
+            help='Blobs decrypted and re-encrypted in memory to estimate throughput in a dry run'
+        )
+
+    def handle(self, *args, **options):
+        if not 0 < options['cpu_budget'] <= 1:
+            raise CommandError('--cpu-budget must be in (0, 1]')
+        if options['workers'] is None:
+            # SQLite takes one writer at a time; more workers only wait on it
+            options['workers'] = 1 if connection.vendor == 'sqlite' else 2
+        self.options = options
+        self.writer_options = {
+            'algorithm': ALGORITHMS[options['algorithm']],
+            'segment_size': options['segment_size'],
+        }
+
+        if options['dry_run']:
+            self.estimate()
+            return
+
+        self.checkpoint = self.load_checkpoint()
+        self.throttle = Throttle(options['max_mbps'] * 2 ** 20)
+        self.lock = threading.Lock()
+        # Swaps are serialized where the database allows only one writer
+        self.db_lock = threading.Lock() if connection.vendor == 'sqlite' else None
+        started = time.monotonic()
+
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            # Files that failed in an interrupted run lie behind the
+            # checkpoint, so they are retried before moving on
+            retry = self.failed_files()
+            if retry:
+                self.stdout.write(f'Retrying {len(retry)} blobs that failed before')
+                self.checkpoint['failed'] = []
+                list(executor.map(self.process, retry))
+                self.save_checkpoint()
+            for phase in PHASES[PHASES.index(self.checkpoint['phase']):]:
+                if self.checkpoint['phase'] != phase:
+                    self.checkpoint.update(phase=phase, last_pk=None)
+                for last_pk, batch in self.iter_batches(phase, self.checkpoint['last_pk']):
+                    list(executor.map(self.process, batch))
+                    self.checkpoint['last_pk'] = str(last_pk)
+                    self.save_checkpoint()
+                    self.report(started)
+
+        self.checkpoint['phase'] = 'done'
+        self.save_checkpoint()
+        self.stdout.write(self.style.SUCCESS(
+            f"Re-encrypted {self.checkpoint['processed']} blobs "
+            f"({self.checkpoint['bytes'] / 2 ** 20:.1f} MiB), "
+            f"{self.checkpoint['skipped']} skipped, {len(self.checkpoint['failed'])} failed"
+        ))
+        for name in self.checkpoint['failed']:
+            self.stdout.write(self.style.ERROR(f'  failed: {name}'))
+
+    def pending_files(self, phase):
+        """Queryset of the files to process in ``phase``, one per blob."""
+        if phase == 'files':
+            queryset = File.objects.filter(blob__isnull=True)
+            if self.options['legacy_only']:
+                queryset = queryset.filter(storage_format=File.StorageFormat.FERNET)
+            return queryset
+        if self.options['legacy_only']:
+            # Blobs are only ever written in the segmented format
+            return Blob.objects.none()
+        # Blobs written by this run (for files from the first phase) are
+        # already done, and client-encrypted blobs have no layer of ours
+        return Blob.objects.filter(created_at__lt=self.checkpoint['started_at']).exclude(
+            files__storage_format=File.StorageFormat.CLIENT_ENCRYPTED
+        )
+
+    def failed_files(self):
+        """One file per blob named in the checkpoint's failures, if still stored there."""
+        files = {}
+        queryset = File.objects.filter(name__in=self.checkpoint['failed']).select_related('blob')
+        for file_obj in queryset.order_by('pk'):
+            files.setdefault(file_obj.name, file_obj)
+        return list(files.values())
+
+    def iter_batches(self, phase, last_pk=None):
+        """
+        Yield ``(last_pk, files)`` in primary key order, ``batch_size`` rows
+        at a time, without ever loading the whole table.
+        """
+        queryset = self.pending_files(phase).order_by('pk')
+        while True:
+            page = queryset.filter(pk__gt=last_pk) if last_pk else queryset
+            rows = list(page[:self.options['batch_size']])
+            if not rows:
+                return
+            last_pk = rows[-1].pk
+            if phase == 'blobs':
+                # Any file of a blob carries its key, format and compression
+                rows = [
+                    file_obj for file_obj in (
+                        blob.files.select_related('blob').first() for blob in rows
+                    )
+                    if file_obj is not None
+                ]
+            yield last_pk, rows
+
+    def process(self, file_obj):
+        started = time.monotonic()
+        try:
+            key = crypto.generate_key()
+            writer = blobs.rewrite_blob(
+                file_obj, key,
+                verify=self.options['verify'],
+                throttle=self.throttle,
+                **self.writer_options
+            )
+            try:
+                swapped = self.swap(file_obj, writer, key)
+            except Exception:
+                blobs.delete_blob(writer.name)
+                raise
+            with self.lock:
+                if swapped:
+                    self.checkpoint['processed'] += 1
+                    self.checkpoint['bytes'] += writer.size
+                else:
+                    self.checkpoint['skipped'] += 1
+        except Exception as e:
+            self.stderr.write(f'Failed to re-encrypt {file_obj.name}: {e}')
+            with self.lock:
+                self.checkpoint['failed'].append(file_obj.name)
+        finally:
+            connection.close()
+
+        budget = self.options['cpu_budget']
+        if budget < 1:
+            time.sleep((time.monotonic() - started) * (1 / budget - 1))
+
+    def swap(self, file_obj, writer, key):
+        """``blobs.swap_blob``, retried while the database is busy."""
+        for attempt in range(SWAP_ATTEMPTS):
+            try:
+                if self.db_lock is None:
+                    return blobs.swap_blob(file_obj, writer, key)
+                with self.db_lock:
+                    return blobs.swap_blob(file_obj, writer, key)
+            except OperationalError:
+                if attempt == SWAP_ATTEMPTS - 1:
+                    raise
+                connection.close()
+                time.sleep(SWAP_BACKOFF * 2 ** attempt)
+
+    def estimate(self):
+        """Report the pending work and a throughput measured on a sample."""
+        self.checkpoint = self.new_checkpoint()
+        count = 0
+        total = 0
+        for phase in PHASES:
+            queryset = self.pending_files(phase)
+            count += queryset.count()
+            total += queryset.aggregate(total=Sum('size'))['total'] or 0
+        self.stdout.write(f'{count} blobs to re-encrypt, {total / 2 ** 20:.1f} MiB of plaintext')
+
+        sampled = 0
+        sampled_bytes = 0
+        elapsed = 0.0
+        for phase in PHASES:
+            for _, batch in self.iter_batches(phase):
+                for file_obj in batch[:self.options['sample'] - sampled]:
+                    started = time.monotonic()
+                    encryptor = crypto.SegmentEncryptor(
+                        crypto.generate_key(),
+                        self.writer_options['segment_size'],
+                        self.writer_options['algorithm']
+                    )
+                    for chunk in blobs.open_plaintext(file_obj):
+                        encryptor.update(chunk)
+                        sampled_bytes += len(chunk)
+                    encryptor.finalize()
+                    elapsed += time.monotonic() - started
+                    sampled += 1
+                if sampled >= self.options['sample']:
+                    break
+            if sampled >= self.options['sample']:
+                break
+
+        if not sampled or not elapsed:
+            return
+        rate = sampled_bytes / elapsed
+        self.stdout.write(
+            f'Sampled {sampled} blobs: {rate / 2 ** 20:.1f} MiB/s per worker '
+            f'(storage writes not included)'
+        )
+        rate *= self.options['workers'] * self.options['cpu_budget']
+        if self.options['max_mbps']:
+            rate = min(rate, self.options['max_mbps'] * 2 ** 20)
+        self.stdout.write(f'Estimated duration: {total / rate / 60:.1f} minutes')
+
+    def load_checkpoint(self):
+        path = self.options['checkpoint']
+        if os.path.exists(path) and not self.options['restart']:
+            with open(path) as f:
+                checkpoint = json.load(f)
+            if checkpoint['phase'] != 'done':
+                self.stdout.write(
+                    f"Resuming from {checkpoint['phase']} after {checkpoint['last_pk']}"
+                )
+                return checkpoint
+        return self.new_checkpoint()
+
+    def new_checkpoint(self):
+        return {
+            'started_at': timezone.now().isoformat(),
+            'phase': PHASES[0],
+            'last_pk': None,
+            'processed': 0,
+            'skipped': 0,
+            'bytes': 0,
+            'failed': [],
+        }
+
+    def save_checkpoint(self):
+        path = self.options['checkpoint']
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.checkpoint, f)
+        os.replace(tmp_path, path)
+
+    def report(self, started):
+        elapsed = time.monotonic() - started
+        rate = self.checkpoint['bytes'] / elapsed / 2 ** 20 if elapsed else 0.0
+        self.stdout.write(
+            f"  {self.checkpoint['phase']}: {self.checkpoint['processed']} done, "
+            f"{rate:.1f} MiB/s"
+        )
@@ -0,0 +1,54 @@
+from itertools import chain
+
+from django.core.management.base import BaseCommand, CommandError
+
+from files.blobs import blob_storage
+from files.models import Derivative, File
+from files.storage import MultiVolumeStorage
+
+
+class Command(BaseCommand):
+    help = (
+        'Copies blobs and derivatives that have fewer than FILE_BLOB_REPLICAS '
+        'copies (for example after replacing a lost volume) onto other volumes.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only report under-replicated and missing blobs'
+        )
+
+    def handle(self, *args, **options):
+        storage = blob_storage()
+        if not isinstance(storage, MultiVolumeStorage):
+            raise CommandError("STORAGES['blobs'] is not a MultiVolumeStorage (set FILE_BLOB_VOLUMES)")
+
+        checked = repaired = copies = 0
+        missing = []
+        # Files of a shared blob all carry its name; derivatives have their own
+        names = chain(
+            File.objects.order_by('name').values_list('name', flat=True).distinct().iterator(),
+            Derivative.objects.order_by('name').values_list('name', flat=True).iterator(),
+        )
+        for name in names:
+            checked += 1
+            found = storage.replica_indexes(name)
+            if not found:
+                missing.append(name)
+                continue
+            if len(found) >= storage.replicas:
+                continue
+            repaired += 1
+            if not options['dry_run']:
+                try:
+                    copies += storage.replicate(name)
+                except OSError as e:
+                    self.stderr.write(f'Failed to replicate {name}: {e}')
+
+        verb = 'Would repair' if options['dry_run'] else 'Repaired'
+        self.stdout.write(self.style.SUCCESS(
+            f'Checked {checked} blobs. {verb} {repaired} ({copies} copies made)'
+        ))
+        for name in missing:
+            self.stdout.write(self.style.ERROR(f'  no copy left: {name}'))
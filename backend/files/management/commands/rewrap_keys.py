@@ -0,0 +1,69 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from files import keys
+from files.models import Derivative, File, UploadSession
+
+
+class Command(BaseCommand):
+    help = (
+        'Rewraps stored data keys with the active key-encryption key, in batches. '
+        'Blobs are not touched.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--new-kek', action='store_true',
+            help='Generate a new key-encryption key in the keyfile and make it active first'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Key records rewrapped per transaction'
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only count the records that would be rewrapped'
+        )
+
+    def handle(self, *args, **options):
+        if options['new_kek'] and not options['dry_run']:
+            kek_id = keys.add_kek()
+            self.stdout.write(self.style.SUCCESS(f'Added key-encryption key {kek_id}'))
+        active = keys.get_keyring().active
+        prefix = f'{keys.WRAPPED_PREFIX}:{active}:'
+
+        records = (
+            (File, 'encryption_key_id'),
+            (UploadSession, 'encryption_key'),
+            (Derivative, 'encryption_key'),
+        )
+        for model, field in records:
+            # Client-encrypted files have no data key
+            stale = model.objects.exclude(**{f'{field}__startswith': prefix}).exclude(**{field: ''})
+            if options['dry_run']:
+                count = stale.count()
+                self.stdout.write(f'{model.__name__}: {count} key records to rewrap')
+                continue
+            count = self.rewrap(stale, field, active, options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(
+                f'{model.__name__}: rewrapped {count} key records with {active}'
+            ))
+
+    def rewrap(self, queryset, field, kek_id, batch_size):
+        """Rewrap in primary key order, one locked batch at a time."""
+        total = 0
+        last_pk = None
+        while True:
+            with transaction.atomic():
+                batch = queryset.order_by('pk').select_for_update().only('pk', field)
+                if last_pk is not None:
+                    batch = batch.filter(pk__gt=last_pk)
+                records = list(batch[:batch_size])
+                if not records:
+                    return total
+                for record in records:
+                    setattr(record, field, keys.rewrap(getattr(record, field), kek_id))
+                type(records[0]).objects.bulk_update(records, [field])
+            last_pk = records[-1].pk
+            total += len(records)
+            self.stdout.write(f'  {total} rewrapped')
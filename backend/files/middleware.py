@@ -0,0 +1,37 @@
+"""
+Middleware deleting the blobs of uploads whose request failed.
+"""
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+
+from .uploadhandler import discard_uploads
+
+
+class DiscardFailedUploadsMiddleware:
+    """
+    ``EncryptingUploadHandler`` writes an upload's blob while the body is
+    parsed, before the view decides anything. Whenever the response is not a
+    success (a rejected form, a denied request, an error) the blobs no file
+    ended up referring to are deleted, however the request got there.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        response = self.get_response(request)
+        if not 200 <= response.status_code < 300:
+            discard_uploads(request)
+        return response
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        if not 200 <= response.status_code < 300:
+            await sync_to_async(discard_uploads)(request)
+        return response
@@ -0,0 +1,22 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0004_fileshare_shared_with_email'),
+    ]
+
+    operations = [
+        # Blobs written before this migration are whole-file Fernet tokens
+        migrations.AddField(
+            model_name='file',
+            name='storage_format',
+            field=models.PositiveSmallIntegerField(choices=[(1, 'Fernet token'), (2, 'Segmented AEAD')], default=1, help_text='On-disk format of the encrypted blob'),
+        ),
+        migrations.AlterField(
+            model_name='file',
+            name='storage_format',
+            field=models.PositiveSmallIntegerField(choices=[(1, 'Fernet token'), (2, 'Segmented AEAD')], default=2, help_text='On-disk format of the encrypted blob'),
+        ),
+    ]
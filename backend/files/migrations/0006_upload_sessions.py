@@ -0,0 +1,52 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:11
+
+import django.db.models.deletion
+import files.models
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0005_file_storage_format'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('original_name', models.CharField(max_length=255)),
+                ('mime_type', models.CharField(max_length=100)),
+                ('size', models.BigIntegerField(help_text='Total size of the file being uploaded in bytes')),
+                ('chunk_size', models.PositiveIntegerField(help_text='Size of every chunk except the last, a multiple of the segment size')),
+                ('encryption_key', models.CharField(max_length=64)),
+                ('header', models.BinaryField(help_text='Header of the blob being assembled, shared by all chunks')),
+                ('client_key', models.CharField(blank=True, max_length=512, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('expires_at', models.DateTimeField(default=files.models.get_upload_session_expiry)),
+                ('file', models.OneToOneField(blank=True, help_text='File created when the session was finalized', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='upload_session', to='files.file')),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='upload_sessions', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='UploadChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveIntegerField()),
+                ('part_name', models.CharField(help_text='Storage path of the encrypted part', max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='files.uploadsession')),
+            ],
+            options={
+                'ordering': ['index'],
+                'constraints': [models.UniqueConstraint(fields=('session', 'index'), name='unique_upload_chunk')],
+            },
+        ),
+    ]
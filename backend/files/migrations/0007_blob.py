@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:15
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0006_upload_sessions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('name', models.CharField(help_text='Storage name of the encrypted blob', max_length=255, unique=True)),
+                ('digest', models.CharField(blank=True, help_text='Hex SHA-256 digest of the plaintext', max_length=64, null=True, unique=True)),
+                ('size', models.BigIntegerField(help_text='Size of the plaintext in bytes')),
+                ('refcount', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='blob',
+            field=models.ForeignKey(blank=True, help_text='Shared content-addressed blob; empty for files stored before deduplication', null=True, on_delete=django.db.models.deletion.PROTECT, related_name='files', to='files.blob'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0007_blob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='compression',
+            field=models.CharField(choices=[('none', 'Uncompressed'), ('zlib', 'zlib'), ('zstd', 'Zstandard')], default='none', help_text='Compression applied to the plaintext before encryption', max_length=8),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0008_file_compression'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='file',
+            name='encryption_key_id',
+            field=models.CharField(help_text='Data key of this file, wrapped by a key-encryption key', max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='uploadsession',
+            name='encryption_key',
+            field=models.CharField(help_text='Data key of the blob being assembled, wrapped by a key-encryption key', max_length=255),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0009_wrapped_data_keys'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PackedBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(help_text='Storage name of the encrypted blob', max_length=255, unique=True)),
+                ('pack', models.CharField(db_index=True, help_text='Name of the pack file holding the blob', max_length=64)),
+                ('offset', models.BigIntegerField()),
+                ('length', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
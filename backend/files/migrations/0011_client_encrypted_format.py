@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0010_packed_blob'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='file',
+            name='storage_format',
+            field=models.PositiveSmallIntegerField(choices=[(1, 'Fernet token'), (2, 'Segmented AEAD'), (3, 'Client-encrypted')], default=2, help_text='On-disk format of the encrypted blob'),
+        ),
+    ]
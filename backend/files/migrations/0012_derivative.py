@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:39
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0011_client_encrypted_format'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Derivative',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('variant', models.CharField(help_text='Kind of derivative, e.g. thumb', max_length=16)),
+                ('name', models.CharField(help_text='Storage name of the encrypted derivative', max_length=255, unique=True)),
+                ('encryption_key', models.CharField(help_text='Data key of the derivative, wrapped by a key-encryption key', max_length=255)),
+                ('mime_type', models.CharField(max_length=100)),
+                ('size', models.BigIntegerField(help_text='Size of the derivative in bytes')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_accessed_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('blob', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='derivatives', to='files.blob')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('blob', 'variant'), name='unique_blob_derivative')],
+            },
+        ),
+    ]
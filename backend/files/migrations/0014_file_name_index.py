@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0013_list_version'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='file',
+            name='name',
+            field=models.CharField(db_index=True, help_text='Encrypted filename as stored in the system', max_length=255),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:48
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0014_file_name_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(fields=['owner', '-uploaded_at'], name='file_owner_uploaded_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fileshare',
+            index=models.Index(fields=['shared_with', 'expires_at', 'file'], name='share_recipient_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fileshare',
+            index=models.Index(fields=['file', 'shared_with', 'expires_at', 'permission'], name='share_file_recipient_idx'),
+        ),
+    ]
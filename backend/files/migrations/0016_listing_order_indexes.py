@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:52
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0015_sharing_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(fields=['-uploaded_at', '-id'], name='file_uploaded_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fileshare',
+            index=models.Index(fields=['-created_at', '-id'], name='share_created_idx'),
+        ),
+    ]
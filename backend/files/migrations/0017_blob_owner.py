@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-17 05:03
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def set_blob_owners(apps, schema_editor):
+    # Existing blobs go to the owner of their oldest file; files of other
+    # users keep their reference, but new uploads never join it
+    Blob = apps.get_model('files', 'Blob')
+    File = apps.get_model('files', 'File')
+    for blob in Blob.objects.filter(owner__isnull=True).iterator():
+        owner_id = File.objects.filter(blob=blob).order_by('uploaded_at').values_list(
+            'owner_id', flat=True
+        ).first()
+        if owner_id is not None:
+            Blob.objects.filter(pk=blob.pk).update(owner_id=owner_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0016_listing_order_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blob',
+            name='owner',
+            field=models.ForeignKey(blank=True, help_text='User whose uploads may share this blob', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='blobs', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='blob',
+            name='digest',
+            field=models.CharField(blank=True, help_text='Hex SHA-256 digest of the plaintext', max_length=64, null=True),
+        ),
+        migrations.RunPython(set_blob_owners, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='blob',
+            constraint=models.UniqueConstraint(fields=('owner', 'digest'), name='unique_owner_blob_digest'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-17 09:12
+
+from django.db import migrations
+
+# Data keys stored before envelope encryption (0009) are bare; client-encrypted
+# files have none
+KEY_FIELDS = (
+    ('File', 'encryption_key_id'),
+    ('UploadSession', 'encryption_key'),
+)
+BATCH_SIZE = 500
+
+
+def wrap_bare_keys(apps, schema_editor):
+    from files import keys
+
+    for model_name, field in KEY_FIELDS:
+        model = apps.get_model('files', model_name)
+        bare = model.objects.exclude(
+            **{f'{field}__startswith': f'{keys.WRAPPED_PREFIX}:'}
+        ).exclude(**{field: ''}).order_by('pk').only('pk', field)
+        # The keyring is only loaded once there is something to wrap, so
+        # fresh installs migrate without a keyfile
+        while records := list(bare[:BATCH_SIZE]):
+            for record in records:
+                setattr(record, field, keys.wrap(getattr(record, field)))
+            model.objects.bulk_update(records, [field])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0017_blob_owner'),
+    ]
+
+    operations = [
+        # Wrapped keys stay readable after unapplying, so there is nothing to undo
+        migrations.RunPython(wrap_bare_keys, migrations.RunPython.noop),
+    ]
@@ -10,10 +10,132 @@ def get_default_expiry():
     """Return default expiration time (24 hours from now)"""
     return timezone.now() + timedelta(days=1)
 
+def get_upload_session_expiry():
+    """Return when a new resumable upload session stops accepting chunks"""
+    return timezone.now() + getattr(
+        settings, 'FILE_UPLOAD_SESSION_LIFETIME', timedelta(days=1)
+    )
+
+class Blob(models.Model):
+    """
+    A stored encrypted blob, addressed by its owner and the SHA-256 digest of
+    its plaintext so identical uploads of one user share one copy. ``refcount``
+    tracks how many File rows point at it; the blob is removed when the last
+    of them is deleted.
+    """
+    id = models.UUIDField(
+        primary_key=True,
+        default=uuid.uuid4,
+        editable=False
+    )
+    name = models.CharField(
+        max_length=255,
+        unique=True,
+        help_text="Storage name of the encrypted blob"
+    )
+    owner = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='blobs',
+        help_text="User whose uploads may share this blob"
+    )
+    digest = models.CharField(
+        max_length=64,
+        null=True,
+        blank=True,
+        help_text="Hex SHA-256 digest of the plaintext"
+    )
+    size = models.BigIntegerField(
+        help_text="Size of the plaintext in bytes"
+    )
+    refcount = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['owner', 'digest'],
+                name='unique_owner_blob_digest'
+            )
+        ]
+
+class PackedBlob(models.Model):
+    """
+    Location of a small blob appended to a pack file by the packing blob
+    storage (``files.storage.PackedStorage``).
+    """
+    name = models.CharField(
+        max_length=255,
+        unique=True,
+        help_text="Storage name of the encrypted blob"
+    )
+    pack = models.CharField(
+        max_length=64,
+        db_index=True,
+        help_text="Name of the pack file holding the blob"
+    )
+    offset = models.BigIntegerField()
+    length = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+class Derivative(models.Model):
+    """
+    An encrypted preview derivative of a blob (a thumbnail or a first-page
+    excerpt), shared by every file of the blob. Derivatives are a size-bounded
+    cache evicted least recently used first; see ``files.derivatives``.
+    """
+    blob = models.ForeignKey(
+        Blob,
+        on_delete=models.CASCADE,
+        related_name='derivatives'
+    )
+    variant = models.CharField(
+        max_length=16,
+        help_text="Kind of derivative, e.g. thumb"
+    )
+    name = models.CharField(
+        max_length=255,
+        unique=True,
+        help_text="Storage name of the encrypted derivative"
+    )
+    encryption_key = models.CharField(
+        max_length=255,
+        help_text="Data key of the derivative, wrapped by a key-encryption key"
+    )
+    mime_type = models.CharField(max_length=100)
+    size = models.BigIntegerField(
+        help_text="Size of the derivative in bytes"
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_accessed_at = models.DateTimeField(
+        default=timezone.now,
+        db_index=True
+    )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['blob', 'variant'],
+                name='unique_blob_derivative'
+            )
+        ]
+
 class File(models.Model):
     """
     Represents an encrypted file in the system.
     """
+    class StorageFormat(models.IntegerChoices):
+        FERNET = 1, 'Fernet token'
+        SEGMENTED_AEAD = 2, 'Segmented AEAD'
+        CLIENT_ENCRYPTED = 3, 'Client-encrypted'
+
+    class Compression(models.TextChoices):
+        NONE = 'none', 'Uncompressed'
+        ZLIB = 'zlib', 'zlib'
+        ZSTD = 'zstd', 'Zstandard'
+
     id = models.UUIDField(
         primary_key=True,
         default=uuid.uuid4,
@@ -21,6 +143,7 @@ class File(models.Model):
     )
     name = models.CharField(
         max_length=255,
+        db_index=True,
         help_text="Encrypted filename as stored in the system"
     )
     original_name = models.CharField(
@@ -35,8 +158,19 @@ class File(models.Model):
         help_text="Size of the file in bytes"
     )
     encryption_key_id = models.CharField(
-        max_length=64,
-        help_text="Reference to the encryption key used for this file"
+        max_length=255,
+        help_text="Data key of this file, wrapped by a key-encryption key"
+    )
+    storage_format = models.PositiveSmallIntegerField(
+        choices=StorageFormat.choices,
+        default=StorageFormat.SEGMENTED_AEAD,
+        help_text="On-disk format of the encrypted blob"
+    )
+    compression = models.CharField(
+        max_length=8,
+        choices=Compression.choices,
+        default=Compression.NONE,
+        help_text="Compression applied to the plaintext before encryption"
     )
     client_key = models.CharField(
         max_length=512,
@@ -44,6 +178,14 @@ class File(models.Model):
         blank=True,
         help_text="Client-side encryption key"
     )
+    blob = models.ForeignKey(
+        Blob,
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+        related_name='files',
+        help_text="Shared content-addressed blob; empty for files stored before deduplication"
+    )
     owner = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
@@ -54,6 +196,12 @@ class File(models.Model):
 
     class Meta:
         ordering = ['-uploaded_at']
+        indexes = [
+            # A user's files, newest first
+            models.Index(fields=['owner', '-uploaded_at'], name='file_owner_uploaded_idx'),
+            # Keyset pagination of all files
+            models.Index(fields=['-uploaded_at', '-id'], name='file_uploaded_idx'),
+        ]
 
 class FileShare(models.Model):
     """
@@ -114,4 +262,122 @@ class FileShare(models.Model):
         return timezone.now() <= self.expires_at
 
     class Meta:
-        ordering = ['-created_at']
\ No newline at end of file
+        ordering = ['-created_at']
+        indexes = [
+            # Files shared with a user and still active; the file column
+            # answers the join to File from the index alone
+            models.Index(
+                fields=['shared_with', 'expires_at', 'file'],
+                name='share_recipient_active_idx'
+            ),
+            # A user's active share of one file (access checks, listings),
+            # covering the permission read
+            models.Index(
+                fields=['file', 'shared_with', 'expires_at', 'permission'],
+                name='share_file_recipient_idx'
+            ),
+            # Keyset pagination of all shares
+            models.Index(fields=['-created_at', '-id'], name='share_created_idx'),
+        ]
+
+class UploadSession(models.Model):
+    """
+    A resumable upload in progress. Chunks are encrypted as they arrive and
+    kept as parts until the session is finalized into a File.
+    """
+    id = models.UUIDField(
+        primary_key=True,
+        default=uuid.uuid4,
+        editable=False
+    )
+    owner = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='upload_sessions'
+    )
+    original_name = models.CharField(max_length=255)
+    mime_type = models.CharField(max_length=100)
+    size = models.BigIntegerField(
+        help_text="Total size of the file being uploaded in bytes"
+    )
+    chunk_size = models.PositiveIntegerField(
+        help_text="Size of every chunk except the last, a multiple of the segment size"
+    )
+    encryption_key = models.CharField(
+        max_length=255,
+        help_text="Data key of the blob being assembled, wrapped by a key-encryption key"
+    )
+    header = models.BinaryField(
+        help_text="Header of the blob being assembled, shared by all chunks"
+    )
+    client_key = models.CharField(
+        max_length=512,
+        null=True,
+        blank=True
+    )
+    file = models.OneToOneField(
+        File,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='upload_session',
+        help_text="File created when the session was finalized"
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(default=get_upload_session_expiry)
+
+    @property
+    def total_chunks(self):
+        return max(1, -(-self.size // self.chunk_size))
+
+    def chunk_length(self, index):
+        """Expected plaintext length of chunk ``index``"""
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    def missing_chunks(self):
+        received = set(self.chunks.values_list('index', flat=True))
+        return [i for i in range(self.total_chunks) if i not in received]
+
+    def is_valid(self):
+        return timezone.now() <= self.expires_at
+
+    class Meta:
+        ordering = ['-created_at']
+
+class UploadChunk(models.Model):
+    """
+    An encrypted chunk received for an upload session.
+    """
+    session = models.ForeignKey(
+        UploadSession,
+        on_delete=models.CASCADE,
+        related_name='chunks'
+    )
+    index = models.PositiveIntegerField()
+    part_name = models.CharField(
+        max_length=255,
+        help_text="Storage path of the encrypted part"
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['index']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['session', 'index'],
+                name='unique_upload_chunk'
+            ),
+        ]
+
+class ListVersion(models.Model):
+    """
+    Change counter behind the ETags of file listings: one per user
+    (``user:<id>``) and one for all files (``all``), bumped whenever a file
+    or share that the listing shows is saved or deleted, or the owner shown
+    with a file is renamed.
+    """
+    scope = models.CharField(
+        max_length=64,
+        unique=True
+    )
+    version = models.PositiveBigIntegerField(default=0)
\ No newline at end of file
@@ -1,5 +1,5 @@
 from rest_framework import permissions
-from django.utils import timezone
+from . import access
 
 class IsFileOwnerOrSharedWith(permissions.BasePermission):
     """
@@ -8,27 +8,20 @@ class IsFileOwnerOrSharedWith(permissions.BasePermission):
     """
     
     def has_object_permission(self, request, view, obj):
-        # Admin users have full access
-        if request.user.is_admin():
-            return True
-            
-        # Check if user is the owner
-        if obj.owner == request.user:
+        # Resolved with the file itself when it came from access.get_file()
+        permission = access.effective_permission(request.user, obj)
+
+        # Admins and owners have full access
+        if permission in (access.ADMIN, access.OWNER):
             return True
-            
-        # Check if file is shared with the user
-        share = obj.shares.filter(
-            shared_with=request.user,
-            expires_at__gt=timezone.now()
-        ).first()
-        
-        if share:
+
+        if permission:
             # For GET requests (viewing), any share permission is enough
             if request.method in permissions.SAFE_METHODS:
                 return True
             # For modification/deletion, only allow if explicitly permitted
-            return share.permission == 'DOWNLOAD'
-            
+            return access.can_download(permission)
+
         return False
     
 class IsAdmin(permissions.BasePermission):
@@ -0,0 +1,149 @@
+"""
+Per-process cache of the decrypted content of small, hot files.
+
+Entries are keyed by the storage name of the blob they were decrypted from,
+so a blob rewritten under a new name is never served stale. The cache holds
+at most ``FILE_PLAINTEXT_CACHE_SIZE`` bytes (0, the default, disables it),
+evicting the least recently used entries first; entries expire after
+``FILE_PLAINTEXT_CACHE_TTL`` seconds and files larger than
+``FILE_PLAINTEXT_CACHE_MAX_ITEM_SIZE`` bytes are never cached.
+
+Deleting a file or revoking a share drops the entry in this process and
+records a new generation for the blob in Django's cache, which every hit is
+checked against, so other processes stop serving the entry too as long as
+``CACHES['default']`` is shared between them (Redis, Memcached, ...). With a
+per-process cache backend they only do so within the TTL. Access is always
+checked before the cache is consulted.
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.core.cache import cache as shared_cache
+
+CacheInfo = namedtuple('CacheInfo', 'hits misses evictions entries size max_size')
+
+GENERATION_KEY = 'files:plaintext-generation:{}'
+
+
+class PlaintextCache:
+    """
+    Byte-bounded LRU mapping of blob names to plaintext, with a TTL.
+
+    Each entry remembers the generation it was stored under; an entry asked
+    for under another generation is dropped.
+    """
+
+    def __init__(self, max_size, max_item_size, ttl):
+        self.max_size = max_size
+        self.max_item_size = min(max_item_size, max_size)
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def accepts(self, size):
+        """Whether content of ``size`` bytes may be cached."""
+        return 0 <= size <= self.max_item_size
+
+    def get(self, name, generation=None):
+        """Return the cached plaintext of ``name``, or ``None``."""
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and (entry[0] <= time.monotonic() or entry[2] != generation):
+                self._remove(name)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(name)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, name, content, generation=None):
+        if not self.accepts(len(content)):
+            return
+        with self._lock:
+            self._remove(name)
+            self._entries[name] = (time.monotonic() + self.ttl, content, generation)
+            self.size += len(content)
+            while self.size > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, name):
+        with self._lock:
+            self._remove(name)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, name):
+        entry = self._entries.pop(name, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(
+                self.hits, self.misses, self.evictions,
+                len(self._entries), self.size, self.max_size
+            )
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """The process-wide cache, or ``None`` when it is disabled."""
+    global _cache
+    if _cache is None:
+        max_size = getattr(settings, 'FILE_PLAINTEXT_CACHE_SIZE', 0)
+        if max_size <= 0:
+            return None
+        with _cache_lock:
+            if _cache is None:
+                _cache = PlaintextCache(
+                    max_size,
+                    getattr(settings, 'FILE_PLAINTEXT_CACHE_MAX_ITEM_SIZE', 256 * 1024),
+                    getattr(settings, 'FILE_PLAINTEXT_CACHE_TTL', 60)
+                )
+    return _cache
+
+
+def reset_cache():
+    """Drop the cache, so it is rebuilt from the current settings."""
+    global _cache
+    with _cache_lock:
+        _cache = None
+
+
+def generation(name):
+    """
+    The current generation of the blob ``name``. Read it before decrypting
+    the blob, so an invalidation while it is being read is not lost.
+    """
+    return shared_cache.get(GENERATION_KEY.format(name))
+
+
+def invalidate(name):
+    """Forget the plaintext of the blob ``name``, here and in other processes."""
+    cache = get_cache()
+    if cache is not None:
+        cache.invalidate(name)
+        # Entries older than the TTL are gone anyway, so the marker can be too
+        shared_cache.set(GENERATION_KEY.format(name), uuid.uuid4().hex, cache.ttl + 1)
+
+
+def cache_info():
+    """Hit/miss counts and footprint of this process's cache, or ``None``."""
+    cache = get_cache()
+    return cache.info() if cache is not None else None
@@ -1,6 +1,8 @@
 # files/serializers.py
 from rest_framework import serializers
-from .models import File, FileShare
+from .models import File, FileShare, UploadSession
+from . import access, crypto, keys
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.utils import timezone
 from datetime import timedelta
@@ -30,6 +32,16 @@ class FileSerializer(serializers.ModelSerializer):
         )
         return file_instance
 
+    @staticmethod
+    def setup_eager_loading(queryset, user):
+        """
+        Load everything the serializer reads for ``user`` in the listing
+        query itself: the owner is joined and the user's active share
+        permission is annotated, so a listing costs a constant number of
+        queries however many files it holds.
+        """
+        return access.annotate_share_permission(queryset.select_related('owner'), user)
+
     def get_owner_name(self, obj):
         return f"{obj.owner.first_name} {obj.owner.last_name}"
     
@@ -39,19 +51,51 @@ class FileSerializer(serializers.ModelSerializer):
         if not request or not request.user:
             return None
 
-        user = request.user
-        
-        # If user is the owner, they have full permissions
-        if user.is_admin() or obj.owner == user:
+        permission = access.effective_permission(request.user, obj)
+
+        # Admins and owners have full permissions
+        if permission in (access.ADMIN, access.OWNER):
             return 'DOWNLOAD'
-            
-        # Check if there's an active share for this user
-        share = obj.shares.filter(
-            shared_with=user,
-            expires_at__gt=timezone.now()
-        ).first()
-        
-        return share.permission if share else None
+        return permission
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    total_chunks = serializers.IntegerField(read_only=True)
+    missing_chunks = serializers.SerializerMethodField()
+
+    class Meta:
+        model = UploadSession
+        fields = ('id', 'original_name', 'mime_type', 'size', 'client_key',
+                 'chunk_size', 'total_chunks', 'missing_chunks', 'file',
+                 'created_at', 'expires_at')
+        read_only_fields = ('id', 'chunk_size', 'file', 'created_at', 'expires_at')
+        extra_kwargs = {
+            'client_key': {'write_only': True}
+        }
+
+    def validate_size(self, value):
+        if value <= 0:
+            raise serializers.ValidationError("The submitted file is empty.")
+        return value
+
+    def get_missing_chunks(self, obj):
+        return obj.missing_chunks()
+
+    def create(self, validated_data):
+        # Chunks are sealed as whole runs of segments, so they must line up
+        # with segment boundaries
+        segment_size = crypto.default_segment_size()
+        chunk_size = max(
+            segment_size,
+            settings.FILE_UPLOAD_CHUNK_SIZE // segment_size * segment_size
+        )
+
+        return UploadSession.objects.create(
+            **validated_data,
+            owner=self.context['request'].user,
+            chunk_size=chunk_size,
+            encryption_key=keys.wrap(crypto.generate_key()),
+            header=crypto.new_header(segment_size)
+        )
 
 class FileShareSerializer(serializers.ModelSerializer):
     shared_with_email = serializers.EmailField(write_only=True)
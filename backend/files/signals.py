@@ -0,0 +1,83 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import blobs, conditional, plaintext_cache
+from .models import Derivative, File, FileShare
+
+
+@receiver(post_delete, sender=File)
+def release_file_blob(sender, instance, **kwargs):
+    """
+    Drop the deleted file's reference to its shared blob, or delete the blob
+    of a file stored before deduplication, which it owns.
+    """
+    plaintext_cache.invalidate(instance.name)
+    if instance.blob_id:
+        blobs.release_blob(instance.blob_id)
+    elif instance.name and not File.objects.filter(name=instance.name).exists():
+        name = instance.name
+        transaction.on_commit(lambda: blobs.delete_blob(name))
+
+
+@receiver(post_delete, sender=Derivative)
+def delete_derivative_blob(sender, instance, **kwargs):
+    """
+    Delete the stored derivative once its row is gone, whether it was
+    evicted or its blob was deleted.
+    """
+    name = instance.name
+    transaction.on_commit(lambda: blobs.delete_blob(name))
+
+
+@receiver(post_delete, sender=FileShare)
+def forget_shared_plaintext(sender, instance, **kwargs):
+    """Stop serving a file whose share is gone from the plaintext cache."""
+    # Shares are also deleted along with their file, which was handled above
+    name = File.objects.filter(pk=instance.file_id).values_list('name', flat=True).first()
+    if name is not None:
+        plaintext_cache.invalidate(name)
+
+
+@receiver(post_save, sender=File)
+@receiver(post_delete, sender=File)
+def bump_file_lists(sender, instance, **kwargs):
+    """Change the ETags of the listings showing this file."""
+    scopes = [conditional.ALL, conditional.user_scope(instance.owner_id)]
+    if kwargs['signal'] is post_save and not kwargs['created']:
+        # Shares of a deleted file bump their users as they are deleted
+        scopes += [
+            conditional.user_scope(user_id) for user_id in FileShare.objects.filter(
+                file_id=instance.pk, shared_with__isnull=False
+            ).values_list('shared_with_id', flat=True)
+        ]
+    conditional.bump(*scopes)
+
+
+@receiver(post_save, sender=FileShare)
+@receiver(post_delete, sender=FileShare)
+def bump_share_lists(sender, instance, **kwargs):
+    """Change the ETag of the shared-with-me listing of the share's user."""
+    if instance.shared_with_id:
+        conditional.bump(conditional.user_scope(instance.shared_with_id))
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def bump_owner_lists(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Change the ETags of the listings showing the user's name as the owner of
+    their files: their own, all files, and those of the users they share with.
+    """
+    if created:
+        return
+    # Logins only save last_login
+    if update_fields is not None and not {'first_name', 'last_name'} & set(update_fields):
+        return
+    scopes = [conditional.ALL, conditional.user_scope(instance.pk)]
+    scopes += [
+        conditional.user_scope(user_id) for user_id in FileShare.objects.filter(
+            file__owner_id=instance.pk, shared_with__isnull=False
+        ).values_list('shared_with_id', flat=True).distinct()
+    ]
+    conditional.bump(*scopes)
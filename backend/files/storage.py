@@ -0,0 +1,822 @@
+"""
+Storage backends for encrypted blobs, configured as ``STORAGES['blobs']``.
+"""
+import hashlib
+import mmap
+import os
+import random
+import re
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import File
+from django.core.files.storage import FileSystemStorage, Storage
+from django.db.models import Sum
+
+from .models import PackedBlob
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+try:
+    import boto3
+    from botocore.config import Config as BotoConfig
+    from botocore.exceptions import ClientError
+except ImportError:  # pragma: no cover - optional dependency
+    boto3 = None
+
+# Smallest part S3 accepts in a multipart upload, other than the last
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class ShardedStorage(FileSystemStorage):
+    """
+    Filesystem storage that fans files out into hashed subdirectories.
+
+    A file named ``name`` is stored at ``ab/cd/name``, where ``abcd`` are the
+    leading hex digits of ``sha256(name)`` (``levels`` directories of 256
+    entries each), so no directory grows past a few thousand entries. Callers
+    keep using the bare name.
+
+    Files still in the flat layout are found too, so existing blobs can be
+    moved by ``manage.py migrate_blob_layout`` while the site is serving them.
+    New files are always written sharded.
+    """
+
+    def __init__(self, *args, levels=2, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.levels = levels
+
+    def shard_name(self, name):
+        """Path of ``name`` in the sharded layout, relative to the root."""
+        digest = hashlib.sha256(os.path.basename(name).encode()).hexdigest()
+        shards = [digest[i * 2:i * 2 + 2] for i in range(self.levels)]
+        return os.path.join(*shards, name)
+
+    def _resolve(self, name):
+        if not self.levels:
+            return name
+        sharded = self.shard_name(name)
+        if os.path.lexists(super().path(sharded)):
+            return sharded
+        if os.path.lexists(super().path(name)):
+            return name
+        # Not stored yet, or moved to its shard since the first check
+        return sharded
+
+    def path(self, name):
+        return super().path(self._resolve(name))
+
+    def _open(self, name, mode='rb'):
+        if any(flag in mode for flag in 'wax+'):
+            os.makedirs(os.path.dirname(self.path(name)), exist_ok=True)
+        return super()._open(name, mode)
+
+    def iter_blobs(self):
+        """
+        Yield ``(name, size, mtime)`` for every stored blob, in either layout,
+        reading one directory at a time. Temporary and hidden files are skipped.
+        """
+        if not os.path.isdir(self.location):
+            return
+        directories = [self.location]
+        while directories:
+            with os.scandir(directories.pop()) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.') or entry.name.endswith('.tmp'):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        stat = entry.stat()
+                        yield entry.name, stat.st_size, stat.st_mtime
+
+
+class PackedStorage(ShardedStorage):
+    """
+    Sharded storage that appends small blobs to large pack files.
+
+    Blobs of at most ``max_packed_size`` bytes (a 64 KiB upload plus
+    encryption overhead by default) are appended to the current pack of up
+    to ``pack_size`` bytes under ``pack_location`` and located through
+    ``PackedBlob`` rows; larger ones are stored as ordinary sharded files.
+    Packed blobs are read through a shared read-only memory map of their pack
+    and handed out as memory views, so no bytes are copied on the way to the
+    cipher.
+
+    Deleting a packed blob only drops its row. ``manage.py compact_packs``
+    rewrites packs that are mostly dead to reclaim the space.
+    """
+    PACK_NAME = 'pack-{:08d}.dat'
+    PACK_PATTERN = re.compile(r'^pack-(\d{8})\.dat$')
+
+    def __init__(self, *args, pack_location=None, max_packed_size=64 * 1024 + 1024,
+                 pack_size=256 * 1024 * 1024, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Kept outside the sharded tree so layout migrations never touch packs
+        self.pack_location = pack_location or os.path.join(
+            os.path.dirname(self.location), 'blob_packs'
+        )
+        self.max_packed_size = max_packed_size
+        self.pack_size = pack_size
+        self._pack_number = None
+        self._append_lock = threading.Lock()
+        self._maps = {}
+        self._maps_lock = threading.Lock()
+
+    def _entry(self, name):
+        return PackedBlob.objects.filter(name=name).first()
+
+    def pack_path(self, pack_name):
+        return os.path.join(self.pack_location, pack_name)
+
+    def pack_names(self):
+        """Names of the existing pack files, oldest first."""
+        if not os.path.isdir(self.pack_location):
+            return []
+        return sorted(
+            name for name in os.listdir(self.pack_location)
+            if self.PACK_PATTERN.match(name)
+        )
+
+    def _current_pack_number(self):
+        number = self._pack_number
+        if number is None or not os.path.exists(self.pack_path(self.PACK_NAME.format(number))):
+            names = self.pack_names()
+            number = int(self.PACK_PATTERN.match(names[-1]).group(1)) if names else 1
+        # Another process may have rolled over to a newer pack
+        while os.path.exists(self.pack_path(self.PACK_NAME.format(number + 1))):
+            number += 1
+        return number
+
+    def append(self, data):
+        """Append ``data`` to the current pack; returns ``(pack, offset)``."""
+        os.makedirs(self.pack_location, exist_ok=True)
+        with self._append_lock:
+            number = self._current_pack_number()
+            while True:
+                pack_name = self.PACK_NAME.format(number)
+                with open(self.pack_path(pack_name), 'ab') as f:
+                    if fcntl is not None:
+                        fcntl.flock(f, fcntl.LOCK_EX)
+                    offset = f.seek(0, os.SEEK_END)
+                    if offset and offset + len(data) > self.pack_size:
+                        number += 1
+                        continue
+                    f.write(data)
+                    f.flush()
+                self._pack_number = number
+                return pack_name, offset
+
+    def _map(self, pack_name, end):
+        """A read-only map of ``pack_name`` covering at least ``end`` bytes."""
+        path = self.pack_path(pack_name)
+        inode = os.stat(path).st_ino
+        with self._maps_lock:
+            cached = self._maps.get(pack_name)
+            if cached is None or cached[0] != inode or len(cached[1]) < end:
+                with open(path, 'rb') as f:
+                    # Maps are never closed explicitly: views handed out to
+                    # readers keep them alive until they are released
+                    cached = (inode, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+                self._maps[pack_name] = cached
+            return cached[1]
+
+    def _open(self, name, mode='rb'):
+        if 'r' in mode and '+' not in mode:
+            entry = self._entry(name)
+            if entry is None:
+                return super()._open(name, mode)
+            try:
+                data = self._map(entry.pack, entry.offset + entry.length)
+            except FileNotFoundError:
+                # The pack was compacted since the row was read
+                entry = self._entry(name)
+                if entry is None:
+                    raise
+                data = self._map(entry.pack, entry.offset + entry.length)
+            view = memoryview(data)[entry.offset:entry.offset + entry.length]
+            return File(MappedBlob(view), name)
+        if 'w' in mode:
+            return File(_PackWriter(self, name, mode), name)
+        return super()._open(name, mode)
+
+    def _save(self, name, content):
+        with self._open(name, 'wb') as out:
+            for chunk in content.chunks():
+                out.write(chunk)
+        return name
+
+    def exists(self, name):
+        return self._entry(name) is not None or super().exists(name)
+
+    def size(self, name):
+        entry = self._entry(name)
+        return entry.length if entry is not None else super().size(name)
+
+    def delete(self, name):
+        if not PackedBlob.objects.filter(name=name).delete()[0]:
+            super().delete(name)
+
+    def iter_blobs(self):
+        yield from super().iter_blobs()
+        for name, length, created_at in PackedBlob.objects.order_by('pk').values_list(
+                'name', 'length', 'created_at').iterator():
+            yield name, length, created_at.timestamp()
+
+    def pack_usage(self):
+        """Yield ``(pack, size, live_bytes, mtime)`` for every pack file."""
+        live = dict(
+            PackedBlob.objects.values('pack').annotate(live=Sum('length'))
+            .values_list('pack', 'live')
+        )
+        for pack_name in self.pack_names():
+            stat = os.stat(self.pack_path(pack_name))
+            yield pack_name, stat.st_size, live.get(pack_name, 0), stat.st_mtime
+
+    def compact(self, pack_name):
+        """
+        Move the live blobs of a pack into the current pack and delete it.
+
+        The pack must no longer be appended to. Returns the bytes reclaimed.
+        """
+        path = self.pack_path(pack_name)
+        size = os.path.getsize(path)
+        moved = 0
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+            entries = PackedBlob.objects.filter(pack=pack_name).order_by('offset')
+            for entry in entries.iterator():
+                new_pack, new_offset = self.append(data[entry.offset:entry.offset + entry.length])
+                # Skips blobs deleted while they were being copied
+                updated = PackedBlob.objects.filter(
+                    pk=entry.pk, pack=pack_name, offset=entry.offset
+                ).update(pack=new_pack, offset=new_offset)
+                if updated:
+                    moved += entry.length
+        os.remove(path)
+        with self._maps_lock:
+            self._maps.pop(pack_name, None)
+        return size - moved
+
+
+class MappedBlob:
+    """Read-only, seekable file object over a memory view."""
+
+    def __init__(self, view):
+        self._view = view
+        self._position = 0
+        self.closed = False
+
+    def read(self, size=-1):
+        start = self._position
+        stop = len(self._view) if size is None or size < 0 else min(start + size, len(self._view))
+        self._position = max(stop, start)
+        return self._view[start:stop]
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += len(self._view)
+        self._position = max(offset, 0)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        self.closed = True
+        self._view.release()
+
+    @property
+    def size(self):
+        return len(self._view)
+
+
+class _PackWriter:
+    """
+    Buffers a blob being written and packs it on close, unless it outgrows
+    ``max_packed_size`` and is spilled to an ordinary sharded file.
+    """
+
+    def __init__(self, storage, name, mode):
+        self.storage = storage
+        self.name = name
+        self.mode = mode
+        self.closed = False
+        self._buffer = bytearray()
+        self._file = None
+
+    def write(self, data):
+        if self._file is not None:
+            return self._file.write(data)
+        self._buffer += data
+        if len(self._buffer) > self.storage.max_packed_size:
+            self._file = ShardedStorage._open(self.storage, self.name, self.mode)
+            self._file.write(self._buffer)
+            self._buffer = bytearray()
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._file is not None:
+            self._file.close()
+            return
+        pack_name, offset = self.storage.append(bytes(self._buffer))
+        PackedBlob.objects.update_or_create(
+            name=self.name,
+            defaults={'pack': pack_name, 'offset': offset, 'length': len(self._buffer)}
+        )
+
+    def abort(self):
+        """Drop the blob instead of packing it; a spilled file is only closed."""
+        if self.closed:
+            return
+        self.closed = True
+        if self._file is not None:
+            self._file.close()
+        self._buffer = bytearray()
+
+
+class MultiVolumeStorage(Storage):
+    """
+    Spreads blobs over several filesystem volumes, optionally replicated.
+
+    Each new blob is written to ``replicas`` distinct volumes, picked at
+    random weighted by free space, so writes and capacity scale with the
+    number of volumes. Each volume is a ``ShardedStorage`` of its own root.
+    Copies are written under a temporary name and renamed into place once
+    the blob is complete, so readers never see a partial one. By default
+    blobs are kept on two volumes (or the one there is), since a lost volume
+    takes the blobs it held the sole copy of with it.
+    Reads probe the volumes for the blob and go to the replica with the
+    fewest reads in flight in this process, falling back to the next one if
+    it fails, so a lost volume only matters for blobs it held the sole copy
+    of. ``manage.py repair_blob_replicas`` restores missing replicas.
+    """
+
+    def __init__(self, volumes=(), replicas=2, levels=2):
+        if not volumes:
+            raise ImproperlyConfigured('MultiVolumeStorage needs at least one volume')
+        self.volumes = [ShardedStorage(location=root, levels=levels) for root in volumes]
+        self.replicas = max(1, min(replicas, len(self.volumes)))
+        self._reads = [0] * len(self.volumes)
+        self._reads_lock = threading.Lock()
+
+    def _free_space(self, volume):
+        try:
+            return shutil.disk_usage(volume.location).free
+        except OSError:
+            return 0
+
+    def placement(self, count=None, exclude=()):
+        """Indexes of ``count`` volumes for a new copy, weighted by free space."""
+        count = self.replicas if count is None else count
+        candidates = {
+            index: self._free_space(volume)
+            for index, volume in enumerate(self.volumes)
+            if index not in exclude
+        }
+        candidates = {index: free for index, free in candidates.items() if free}
+        chosen = []
+        while candidates and len(chosen) < count:
+            index = random.choices(list(candidates), weights=list(candidates.values()))[0]
+            chosen.append(index)
+            del candidates[index]
+        if not chosen and count:
+            raise OSError('No blob volume is available for writing')
+        return chosen
+
+    def replica_indexes(self, name):
+        """Indexes of the volumes currently holding ``name``."""
+        found = []
+        for index, volume in enumerate(self.volumes):
+            try:
+                if volume.exists(name):
+                    found.append(index)
+            except OSError:
+                continue
+        return found
+
+    def _release(self, index):
+        with self._reads_lock:
+            self._reads[index] -= 1
+
+    def _open(self, name, mode='rb'):
+        if any(flag in mode for flag in 'wax+'):
+            copies = []
+            try:
+                for index in self.placement():
+                    target = self.volumes[index].path(name)
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    copies.append((open(f'{target}.tmp', mode), target))
+            except Exception:
+                _TeeWriter(copies).abort()
+                raise
+            return File(_TeeWriter(copies), name)
+
+        # Probing the volumes is I/O, so it stays outside the lock
+        found = self.replica_indexes(name)
+        with self._reads_lock:
+            candidates = sorted(found, key=self._reads.__getitem__)
+        for index in candidates:
+            try:
+                f = self.volumes[index].open(name, mode)
+            except OSError:
+                continue
+            with self._reads_lock:
+                self._reads[index] += 1
+            return File(_TrackedReader(f, lambda index=index: self._release(index)), name)
+        raise FileNotFoundError(f'Blob not found on any volume: {name}')
+
+    def _save(self, name, content):
+        with self._open(name, 'wb') as out:
+            for chunk in content.chunks():
+                out.write(chunk)
+        return name
+
+    def delete(self, name):
+        for volume in self.volumes:
+            try:
+                volume.delete(name)
+            except OSError:
+                continue
+
+    def iter_blobs(self):
+        """Yield ``(name, size, mtime)`` for every copy on every volume."""
+        for volume in self.volumes:
+            yield from volume.iter_blobs()
+
+    def exists(self, name):
+        return bool(self.replica_indexes(name))
+
+    def size(self, name):
+        for index in self.replica_indexes(name):
+            try:
+                return self.volumes[index].size(name)
+            except OSError:
+                continue
+        raise FileNotFoundError(f'Blob not found on any volume: {name}')
+
+    def path(self, name):
+        found = self.replica_indexes(name)
+        return self.volumes[found[0] if found else 0].path(name)
+
+    def replicate(self, name):
+        """
+        Copy ``name`` to more volumes until it has ``replicas`` copies.
+
+        Returns the number of copies made. Copies are written under a
+        temporary name and renamed into place, so readers never see a
+        partial replica.
+        """
+        found = self.replica_indexes(name)
+        if not found:
+            raise FileNotFoundError(f'Blob not found on any volume: {name}')
+        missing = self.replicas - len(found)
+        if missing <= 0:
+            return 0
+        made = 0
+        for index in self.placement(missing, exclude=found):
+            target = self.volumes[index].path(name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with self._open(name, 'rb') as source, open(f'{target}.tmp', 'wb') as out:
+                for chunk in source.chunks():
+                    out.write(chunk)
+            os.replace(f'{target}.tmp', target)
+            made += 1
+        return made
+
+
+class _TeeWriter:
+    """
+    Writes the same bytes to the temporary file of every replica of a blob
+    being stored, renaming them into place on close.
+    """
+
+    def __init__(self, copies):
+        self._copies = copies
+        self.closed = False
+
+    def write(self, data):
+        try:
+            for f, _ in self._copies:
+                f.write(data)
+        except Exception:
+            self.abort()
+            raise
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            for f, _ in self._copies:
+                f.close()
+            for _, target in self._copies:
+                os.replace(f'{target}.tmp', target)
+        except Exception:
+            self._discard()
+            raise
+
+    def abort(self):
+        """Drop the temporary files without publishing the blob."""
+        if self.closed:
+            return
+        self.closed = True
+        self._discard()
+
+    def _discard(self):
+        for f, target in self._copies:
+            f.close()
+            try:
+                os.remove(f'{target}.tmp')
+            except FileNotFoundError:
+                pass
+
+
+class _TrackedReader:
+    """Proxies a replica's file object and reports when it is closed."""
+
+    def __init__(self, f, on_close):
+        self._file = f
+        self._on_close = on_close
+        self._closed = False
+
+    def __getattr__(self, attr):
+        return getattr(self._file, attr)
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._file.close()
+            self._on_close()
+
+
+class S3Storage(Storage):
+    """
+    Stores blobs as objects in an S3-compatible bucket (AWS S3, MinIO, ...).
+
+    Blobs being written are buffered into ``part_size`` parts and sent as a
+    multipart upload with up to ``concurrency`` parts in flight, so at most
+    ``concurrency + 1`` parts are held in memory; blobs smaller than one part
+    are sent with a single PUT. Reads are served by ranged GETs of
+    ``read_size`` bytes from the current position, so downloads and ranges
+    only fetch what they decrypt. Each process keeps one client with a pool
+    of at most ``max_pool_connections`` HTTP connections.
+
+    Requires ``boto3``; credentials come from its usual sources (environment,
+    config files or instance roles).
+    """
+
+    def __init__(self, bucket=None, prefix='', endpoint_url=None, region_name=None,
+                 part_size=8 * 1024 * 1024, concurrency=4, read_size=4 * 1024 * 1024,
+                 max_pool_connections=10):
+        if boto3 is None:
+            raise ImproperlyConfigured('boto3 is required for S3Storage')
+        if not bucket:
+            raise ImproperlyConfigured('S3Storage needs a bucket')
+        if part_size < S3_MIN_PART_SIZE:
+            raise ImproperlyConfigured('S3 multipart parts must be at least 5 MiB')
+        self.bucket = bucket
+        self.prefix = prefix
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.read_size = read_size
+        self.client = boto3.session.Session().client(
+            's3',
+            endpoint_url=endpoint_url,
+            region_name=region_name,
+            config=BotoConfig(
+                max_pool_connections=max_pool_connections,
+                retries={'mode': 'standard'}
+            )
+        )
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_pool_connections, thread_name_prefix='s3-upload'
+        )
+
+    def key(self, name):
+        return f'{self.prefix}{name}'
+
+    def _open(self, name, mode='rb'):
+        if any(flag in mode for flag in 'wax+'):
+            return File(_S3MultipartWriter(self, self.key(name)), name)
+        return File(_S3RangedReader(self, self.key(name)), name)
+
+    def _save(self, name, content):
+        with self._open(name, 'wb') as out:
+            for chunk in content.chunks():
+                out.write(chunk)
+        return name
+
+    def _head(self, name):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def exists(self, name):
+        return self._head(name) is not None
+
+    def size(self, name):
+        head = self._head(name)
+        if head is None:
+            raise FileNotFoundError(f'Blob not found: {name}')
+        return head['ContentLength']
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+
+    def iter_blobs(self):
+        """Yield ``(name, size, mtime)`` for every object under the prefix, a page at a time."""
+        pages = self.client.get_paginator('list_objects_v2').paginate(
+            Bucket=self.bucket, Prefix=self.prefix
+        )
+        for page in pages:
+            for item in page.get('Contents', ()):
+                yield (
+                    item['Key'][len(self.prefix):], item['Size'],
+                    item['LastModified'].timestamp()
+                )
+
+
+class _S3MultipartWriter:
+    """Streams a blob into a multipart upload, several parts at a time."""
+
+    def __init__(self, storage, key):
+        self.storage = storage
+        self.key = key
+        self.closed = False
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._futures = []
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self.storage.part_size:
+            part = bytes(self._buffer[:self.storage.part_size])
+            del self._buffer[:self.storage.part_size]
+            self._send_part(part)
+        return len(data)
+
+    def _send_part(self, data):
+        storage = self.storage
+        try:
+            if self._upload_id is None:
+                self._upload_id = storage.client.create_multipart_upload(
+                    Bucket=storage.bucket, Key=self.key
+                )['UploadId']
+            # Bound the parts held in memory by waiting for the oldest ones
+            pending = [future for future in self._futures if not future.done()]
+            while len(pending) >= storage.concurrency:
+                pending[0].result()
+                pending = [future for future in self._futures if not future.done()]
+            self._futures.append(storage._executor.submit(
+                self._upload_part, len(self._futures) + 1, data
+            ))
+        except Exception:
+            self.abort()
+            raise
+
+    def _upload_part(self, number, data):
+        storage = self.storage
+        response = storage.client.upload_part(
+            Bucket=storage.bucket, Key=self.key, UploadId=self._upload_id,
+            PartNumber=number, Body=data
+        )
+        return {'PartNumber': number, 'ETag': response['ETag']}
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        storage = self.storage
+        if self._upload_id is None:
+            storage.client.put_object(Bucket=storage.bucket, Key=self.key, Body=bytes(self._buffer))
+            return
+        try:
+            if self._buffer:
+                self._send_part(bytes(self._buffer))
+            parts = [future.result() for future in self._futures]
+            storage.client.complete_multipart_upload(
+                Bucket=storage.bucket, Key=self.key, UploadId=self._upload_id,
+                MultipartUpload={'Parts': parts}
+            )
+        except Exception:
+            self.abort()
+            raise
+
+    def abort(self):
+        self.closed = True
+        if self._upload_id is not None:
+            for future in self._futures:
+                future.cancel()
+            self.storage.client.abort_multipart_upload(
+                Bucket=self.storage.bucket, Key=self.key, UploadId=self._upload_id
+            )
+            self._upload_id = None
+
+
+class _S3RangedReader:
+    """Seekable file object over an S3 object, read with ranged GETs."""
+
+    def __init__(self, storage, key):
+        self.storage = storage
+        self.key = key
+        self.closed = False
+        self._position = 0
+        self._size = None
+        self._body = None
+        self._body_position = 0
+        self._body_end = 0
+        # Fail early, like opening a missing local file
+        self._fetch(0)
+
+    @property
+    def size(self):
+        return self._size
+
+    def _fetch(self, start):
+        self._release()
+        try:
+            response = self.storage.client.get_object(
+                Bucket=self.storage.bucket, Key=self.key,
+                Range=f'bytes={start}-{start + self.storage.read_size - 1}'
+            )
+        except ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code in ('NoSuchKey', '404'):
+                raise FileNotFoundError(f'Blob not found: {self.key}')
+            if code == 'InvalidRange':
+                # Empty object, or reading past the end
+                self._size = self._size if self._size is not None else 0
+                self._body_position = self._body_end = start
+                return
+            raise
+        self._size = int(response['ContentRange'].rpartition('/')[2])
+        self._body = response['Body']
+        self._body_position = start
+        self._body_end = start + response['ContentLength']
+
+    def _release(self):
+        if self._body is not None:
+            self._body.close()
+            self._body = None
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = max(self._size - self._position, 0)
+        chunks = []
+        while size > 0 and self._position < self._size:
+            if (self._body is None or self._body_position != self._position
+                    or self._body_position >= self._body_end):
+                self._fetch(self._position)
+                if self._body is None:
+                    break
+            chunk = self._body.read(min(size, self._body_end - self._body_position))
+            if not chunk:
+                self._release()
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+            self._position += len(chunk)
+            self._body_position += len(chunk)
+        return b''.join(chunks)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self._size
+        self._position = max(offset, 0)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        self.closed = True
+        self._release()
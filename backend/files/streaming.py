@@ -0,0 +1,290 @@
+"""
+Streaming HTTP responses for decrypted file content, including byte ranges,
+and raw ciphertext responses for clients that decrypt themselves.
+"""
+import os
+import re
+import secrets
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+
+from . import blobs, conditional, derivatives
+from .models import File
+
+# Names of the stored formats in the X-Blob-Format header of raw responses
+BLOB_FORMATS = {
+    File.StorageFormat.FERNET: 'fernet',
+    File.StorageFormat.SEGMENTED_AEAD: 'segmented-aead',
+    File.StorageFormat.CLIENT_ENCRYPTED: 'client',
+}
+
+# Requests asking for more ranges than this get the whole body instead
+MAX_RANGES = 16
+# Bytes read at a time from a stored blob sent as it is
+RAW_READ_SIZE = 64 * 1024
+
+_RANGE_SPEC = re.compile(r'^(\d*)-(\d*)$')
+
+
+def parse_range_header(header, size):
+    """
+    Parse a ``Range`` header into a list of ``(start, stop)`` byte ranges.
+
+    Returns ``None`` when the header should be ignored (missing, malformed,
+    not in bytes, or asking for too many ranges) and an empty list when it is
+    well formed but none of its ranges can be satisfied.
+    """
+    if not header:
+        return None
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not specs:
+        return None
+
+    ranges = []
+    for spec in specs.split(','):
+        match = _RANGE_SPEC.match(spec.strip())
+        if not match or match.groups() == ('', ''):
+            return None
+        first, last = match.groups()
+        if not first:
+            # Suffix range: the last N bytes
+            length = int(last)
+            if length == 0:
+                continue
+            ranges.append((max(size - length, 0), size))
+            continue
+        start = int(first)
+        stop = size if not last else int(last) + 1
+        if last and stop <= start:
+            return None
+        if start < size:
+            ranges.append((start, min(stop, size)))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+    return _coalesce(ranges)
+
+
+def _coalesce(ranges):
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(stop, merged[-1][1]))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def _multipart_parts(reader, ranges, boundary, content_type):
+    size = reader.size
+    for start, stop in ranges:
+        yield (
+            f'--{boundary}\r\n'
+            f'Content-Type: {content_type}\r\n'
+            f'Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n'
+        ).encode()
+        yield from reader.iter_range(start, stop)
+        yield b'\r\n'
+    yield f'--{boundary}--\r\n'.encode()
+
+
+def _multipart_length(ranges, size, boundary, content_type):
+    length = len(f'--{boundary}--\r\n')
+    for start, stop in ranges:
+        length += len(
+            f'--{boundary}\r\n'
+            f'Content-Type: {content_type}\r\n'
+            f'Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n'
+        ) + (stop - start) + 2
+    return length
+
+
+def _requested_ranges(request, etag, size):
+    """
+    The ranges of a ``size``-byte representation ``request`` asks for, as
+    ``parse_range_header`` returns them.
+    """
+    # A range is only sent if the client's copy (named by If-Range) is
+    # current; otherwise the full representation is sent, as RFC 9110 requires.
+    if request.META.get('HTTP_IF_RANGE', etag) != etag:
+        return None
+    return parse_range_header(request.META.get('HTTP_RANGE'), size)
+
+
+def _partial_response(reader, ranges, content_type):
+    """
+    Build the ``206`` (or ``416``, for no satisfiable range) response sending
+    ``ranges`` of ``reader``, which has ``size``, ``iter_range()`` and
+    ``close()``, and is closed once the body is sent.
+    """
+    size = reader.size
+    if not ranges:
+        reader.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+    elif len(ranges) == 1:
+        start, stop = ranges[0]
+        response = StreamingHttpResponse(
+            blobs.iter_closing(reader.iter_range(start, stop), reader),
+            status=206,
+            content_type=content_type
+        )
+        response['Content-Length'] = stop - start
+        response['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+    else:
+        boundary = secrets.token_hex(16)
+        response = StreamingHttpResponse(
+            blobs.iter_closing(
+                _multipart_parts(reader, ranges, boundary, content_type), reader
+            ),
+            status=206,
+            content_type=f'multipart/byteranges; boundary={boundary}'
+        )
+        response['Content-Length'] = _multipart_length(ranges, size, boundary, content_type)
+    return response
+
+
+class _StoredReader:
+    """Reads byte ranges of a stored blob as it is, for ``_partial_response``."""
+
+    def __init__(self, f):
+        self._file = f
+        self.size = f.size
+
+    def iter_range(self, start=0, stop=None):
+        stop = self.size if stop is None else min(stop, self.size)
+        self._file.seek(start)
+        while start < stop:
+            data = self._file.read(min(RAW_READ_SIZE, stop - start))
+            if not data:
+                break
+            start += len(data)
+            yield data
+
+    def close(self):
+        self._file.close()
+
+
+def file_response(request, file_obj, as_attachment=False):
+    """
+    Build a response that decrypts a file segment by segment as it is sent.
+
+    Only one segment is held in memory at a time, and the first bytes go out
+    as soon as the first segment has been authenticated. ``Range`` requests
+    are answered with ``206 Partial Content`` by decrypting only the segments
+    that cover the requested bytes.
+
+    Client-encrypted files have no server-side layer and are sent as stored.
+    Requests whose ``If-None-Match`` already holds the content's ETag get
+    ``304 Not Modified`` without the blob being opened.
+    """
+    if file_obj.storage_format == File.StorageFormat.CLIENT_ENCRYPTED:
+        return ciphertext_response(request, file_obj, as_attachment)
+
+    etag = conditional.content_etag(file_obj)
+    response = conditional.not_modified(request, etag)
+    if response is not None:
+        return response
+
+    content_type = file_obj.mime_type or 'application/octet-stream'
+    reader = blobs.PlaintextReader(file_obj)
+    size = reader.size
+
+    ranges = _requested_ranges(request, etag, size)
+    if ranges is None:
+        response = StreamingHttpResponse(
+            blobs.iter_closing(reader.iter_range(), reader),
+            content_type=content_type
+        )
+        response['Content-Length'] = size
+    else:
+        response = _partial_response(reader, ranges, content_type)
+
+    response['Accept-Ranges'] = 'bytes'
+    if as_attachment:
+        response['Content-Disposition'] = f'attachment; filename="{file_obj.original_name}"'
+    response['X-Client-Key'] = file_obj.client_key
+    return conditional.set_validators(response, etag)
+
+
+def preview_response(request, file_obj, variant=None):
+    """
+    Build the response for an inline preview of ``file_obj``, or with
+    ``variant`` of its derivative if it can have one. ``X-Preview-Variant``
+    tells which was sent (``original`` when falling back to the file itself).
+    """
+    preview = derivatives.preview_file(file_obj, variant) if variant else file_obj
+    response = file_response(request, preview)
+    response['X-Preview-Variant'] = variant if preview is not file_obj else 'original'
+    return response
+
+
+def _local_path(name):
+    """Filesystem path of a blob stored in a file of its own, or ``None``."""
+    try:
+        path = blobs.blob_storage().path(name)
+    except NotImplementedError:
+        # Object storage has no local paths
+        return None
+    # Packed blobs live inside a pack file and have no path of their own
+    return path if os.path.isfile(path) else None
+
+
+def ciphertext_response(request, file_obj, as_attachment=False):
+    """
+    Build a response carrying a client-encrypted file's stored blob as it is,
+    for the client to decrypt with its own key. Only for files in the
+    ``CLIENT_ENCRYPTED`` format: the server's data keys never leave it, and
+    the response is ``no-store``. With ``FILE_SENDFILE_BACKEND`` set the
+    body is left to the fronting web server (which then also answers ranges);
+    otherwise the blob is returned as a ``FileResponse``, which WSGI servers
+    send with ``os.sendfile()``, and ranges of it are read and sent by the
+    worker. Blobs without a path of their own (packed or in object storage)
+    are always streamed by the worker, but never decrypted.
+    """
+    if file_obj.storage_format != File.StorageFormat.CLIENT_ENCRYPTED:
+        raise ValueError('Only client-encrypted files are sent as stored')
+    etag = conditional.content_etag(file_obj, raw=True)
+    response = conditional.not_modified(request, etag)
+    if response is not None:
+        return _no_store(response)
+
+    backend = settings.FILE_SENDFILE_BACKEND
+    path = _local_path(file_obj.name) if backend else None
+    root = os.path.join(os.path.realpath(settings.FILE_SENDFILE_ROOT), '')
+
+    if path and backend == 'x-accel-redirect' and os.path.realpath(path).startswith(root):
+        response = HttpResponse(content_type='application/octet-stream')
+        relative = os.path.relpath(os.path.realpath(path), root)
+        response['X-Accel-Redirect'] = settings.FILE_SENDFILE_URL + quote(relative)
+    elif path and backend == 'x-sendfile':
+        response = HttpResponse(content_type='application/octet-stream')
+        response['X-Sendfile'] = path
+    else:
+        stored = blobs.blob_storage().open(file_obj.name, 'rb')
+        ranges = _requested_ranges(request, etag, stored.size)
+        if ranges is None:
+            response = FileResponse(
+                stored,
+                as_attachment=as_attachment,
+                filename=file_obj.original_name,
+                content_type='application/octet-stream'
+            )
+        else:
+            response = _partial_response(
+                _StoredReader(stored), ranges, 'application/octet-stream'
+            )
+        response['Accept-Ranges'] = 'bytes'
+    if as_attachment and not response.has_header('Content-Disposition'):
+        response['Content-Disposition'] = f'attachment; filename="{file_obj.original_name}"'
+    response['X-Blob-Format'] = BLOB_FORMATS[file_obj.storage_format]
+    response['X-Client-Key'] = file_obj.client_key
+    return _no_store(conditional.set_validators(response, etag))
+
+
+def _no_store(response):
+    # Ciphertext is never kept by browsers or caches, even privately
+    response['Cache-Control'] = 'no-store'
+    return response
@@ -1,3 +1,1648 @@
-from django.test import TestCase
-
-# Create your tests here.
+import base64
+import hashlib
+import importlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import uuid
+from datetime import timedelta
+from unittest import mock
+
+from cryptography.exceptions import InvalidTag
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import include, path
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from . import blobs, conditional, crypto, derivatives, keys, plaintext_cache, streaming
+from . import urls as file_urls
+from .models import Blob, Derivative, File, FileShare, PackedBlob, UploadSession
+from .storage import MultiVolumeStorage, S3Storage
+
+try:
+    import boto3
+    import moto
+except ImportError:  # pragma: no cover - optional test dependencies
+    boto3 = moto = None
+
+try:
+    from PIL import Image
+except ImportError:  # pragma: no cover - optional dependency
+    Image = None
+
+User = get_user_model()
+
+# URLs with the async views routed as under FILES_ASYNC_VIEWS, for
+# AsyncViewTests (settings.ROOT_URLCONF = 'files.tests')
+urlpatterns = [
+    path('api/v1/', include(file_urls.async_urlpatterns + file_urls.urlpatterns)),
+]
+
+
+class StorageTestMixin:
+    """
+    Runs each test against blob storage and a keyfile in a fresh temporary
+    directory, with uploads going through the full API.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        overrides = override_settings(
+            MEDIA_ROOT=self.root,
+            STORAGES={
+                'default': {
+                    'BACKEND': 'django.core.files.storage.FileSystemStorage',
+                },
+                'staticfiles': {
+                    'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+                },
+                'blobs': {
+                    'BACKEND': 'files.storage.ShardedStorage',
+                    'OPTIONS': {'location': os.path.join(self.root, 'encrypted_files')},
+                },
+            },
+            FILE_KEK_FILE=os.path.join(self.root, 'kek.json'),
+            FILE_KEK_AUTOCREATE=True,
+            FILE_DERIVATIVES_ON_UPLOAD=False,
+            FILE_PLAINTEXT_CACHE_SIZE=0,
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        keys.reset_keyring()
+        self.addCleanup(keys.reset_keyring)
+        # Rate limits are counted in the cache
+        cache.clear()
+
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def upload(self, user, content, name='report.pdf', mime_type='application/pdf'):
+        response = self.client_for(user).post('/api/v1/files/', {
+            'file': SimpleUploadedFile(name, content, mime_type),
+            'original_name': name,
+            'mime_type': mime_type,
+        }, format='multipart')
+        self.assertEqual(response.status_code, 201, response.content)
+        return File.objects.get(pk=response.json()['id'])
+
+    def stored_blobs(self):
+        return list(blobs.blob_storage().iter_blobs())
+
+
+class FileListingQueryCountTests(TestCase):
+    """Listings cost the same number of queries however many files they hold."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(
+            username='owner', email='owner@example.com', password='pw',
+            first_name='Olive', last_name='Owner'
+        )
+        cls.recipient = User.objects.create_user(
+            username='recipient', email='recipient@example.com', password='pw'
+        )
+        cls.admin = User.objects.create_user(
+            username='admin', email='admin@example.com', password='pw',
+            role=User.Roles.ADMIN
+        )
+
+    def add_files(self, count):
+        for _ in range(count):
+            file_obj = File.objects.create(
+                name=f'blob-{File.objects.count()}',
+                original_name='report.txt',
+                mime_type='text/plain',
+                size=1,
+                owner=self.owner,
+                encryption_key_id='unused'
+            )
+            FileShare.objects.create(
+                file=file_obj,
+                created_by=self.owner,
+                shared_with=self.recipient,
+                permission=FileShare.Permissions.DOWNLOAD,
+                expires_at=timezone.now() + timedelta(days=1)
+            )
+
+    def count_queries(self, user, url):
+        client = APIClient()
+        client.force_authenticate(user)
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.json()['results']
+
+    def assertConstantQueries(self, user, url):
+        self.add_files(2)
+        few, _ = self.count_queries(user, url)
+        self.add_files(8)
+        many, data = self.count_queries(user, url)
+        self.assertEqual(len(data), 10)
+        self.assertEqual(few, many)
+        return data
+
+    def test_list(self):
+        data = self.assertConstantQueries(self.owner, '/api/v1/files/')
+        self.assertEqual({item['share_permission'] for item in data}, {'DOWNLOAD'})
+        self.assertEqual({item['owner_name'] for item in data}, {'Olive Owner'})
+
+    def test_shared(self):
+        data = self.assertConstantQueries(self.recipient, '/api/v1/files/shared/')
+        self.assertEqual({item['share_permission'] for item in data}, {'DOWNLOAD'})
+
+    def test_all_files(self):
+        data = self.assertConstantQueries(self.admin, '/api/v1/files/all_files/')
+        self.assertEqual({item['owner_name'] for item in data}, {'Olive Owner'})
+
+    def test_pages(self):
+        self.add_files(10)
+        client = APIClient()
+        client.force_authenticate(self.owner)
+        url = '/api/v1/files/?page_size=4'
+        seen = []
+        counts = []
+        while url:
+            with CaptureQueriesContext(connection) as queries:
+                response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            counts.append(len(queries))
+            seen.extend(item['id'] for item in response.json()['results'])
+            url = response.json()['next']
+
+        expected = File.objects.order_by('-uploaded_at', '-id').values_list('id', flat=True)
+        self.assertEqual(seen, [str(pk) for pk in expected])
+        self.assertEqual(len(counts), 3)
+        self.assertEqual(len(set(counts)), 1)
+
+    def test_invalid_cursor(self):
+        client = APIClient()
+        client.force_authenticate(self.owner)
+        self.assertEqual(client.get('/api/v1/files/?cursor=bogus').status_code, 404)
+
+
+class FileAccessQueryCountTests(TestCase):
+    """Fetching a file resolves the caller's access in a single query."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(
+            username='owner', email='owner@example.com', password='pw'
+        )
+        cls.viewer = User.objects.create_user(
+            username='viewer', email='viewer@example.com', password='pw'
+        )
+        cls.stranger = User.objects.create_user(
+            username='stranger', email='stranger@example.com', password='pw'
+        )
+        cls.file = File.objects.create(
+            name='blob', original_name='report.txt', mime_type='text/plain',
+            size=1, owner=cls.owner, encryption_key_id='unused'
+        )
+        FileShare.objects.create(
+            file=cls.file,
+            created_by=cls.owner,
+            shared_with=cls.viewer,
+            permission=FileShare.Permissions.VIEW,
+            expires_at=timezone.now() + timedelta(days=1)
+        )
+
+    def get(self, user, url):
+        client = APIClient()
+        client.force_authenticate(user)
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(url)
+        return response, len(queries)
+
+    def test_retrieve(self):
+        url = f'/api/v1/files/{self.file.pk}/'
+        response, queries = self.get(self.viewer, url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['share_permission'], 'VIEW')
+        self.assertEqual(queries, 1)
+
+        response, queries = self.get(self.owner, url)
+        self.assertEqual(response.json()['share_permission'], 'DOWNLOAD')
+        self.assertEqual(queries, 1)
+
+    def test_download_denied_to_viewer(self):
+        response, queries = self.get(self.viewer, f'/api/v1/files/{self.file.pk}/download/')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(queries, 1)
+
+    def test_not_found_for_stranger(self):
+        response, _ = self.get(self.stranger, f'/api/v1/files/{self.file.pk}/')
+        self.assertEqual(response.status_code, 404)
+
+
+class DeduplicationTests(StorageTestMixin, TestCase):
+    """Identical uploads share a blob only among one user's files."""
+
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user(
+            username='owner', email='owner@example.com', password='pw'
+        )
+        self.other = User.objects.create_user(
+            username='other', email='other@example.com', password='pw'
+        )
+        self.content = os.urandom(4096)
+
+    def test_same_owner_shares_blob(self):
+        first = self.upload(self.owner, self.content)
+        second = self.upload(self.owner, self.content, name='copy.pdf')
+        self.assertEqual(first.blob_id, second.blob_id)
+        self.assertEqual(Blob.objects.get(pk=first.blob_id).refcount, 2)
+
+    def upload(self, *args, **kwargs):
+        # Run on-commit work, such as deleting a duplicate's blob
+        with self.captureOnCommitCallbacks(execute=True):
+            return super().upload(*args, **kwargs)
+
+    def delete(self, file_obj):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client_for(self.owner).delete(f'/api/v1/files/{file_obj.pk}/')
+        self.assertEqual(response.status_code, 204)
+
+    def test_delete_releases_blob(self):
+        first = self.upload(self.owner, self.content)
+        second = self.upload(self.owner, self.content, name='copy.pdf')
+        self.assertEqual(len(self.stored_blobs()), 1)
+
+        self.delete(first)
+        blob = Blob.objects.get(pk=second.blob_id)
+        self.assertEqual(blob.refcount, 1)
+        self.assertEqual(len(self.stored_blobs()), 1)
+        response = self.client_for(self.owner).get(f'/api/v1/files/{second.pk}/download/')
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+        # The last file takes its blob and the stored ciphertext with it
+        self.delete(second)
+        self.assertFalse(Blob.objects.exists())
+        self.assertEqual(self.stored_blobs(), [])
+
+    def test_reupload_after_delete(self):
+        first = self.upload(self.owner, self.content)
+        self.delete(first)
+        second = self.upload(self.owner, self.content)
+        self.assertEqual(Blob.objects.get(pk=second.blob_id).refcount, 1)
+        self.assertEqual(len(self.stored_blobs()), 1)
+
+    def test_other_user_learns_nothing(self):
+        digest = hashlib.sha256(self.content).hexdigest()
+        first = self.upload(self.owner, self.content)
+
+        other = self.client_for(self.other)
+        response = other.get(f'/api/v1/files/digests/{digest}/')
+        self.assertFalse(response.json()['exists'])
+        response = other.post('/api/v1/files/from-digest/', {'digest': digest})
+        self.assertEqual(response.status_code, 404)
+
+        second = self.upload(self.other, self.content)
+        self.assertNotEqual(second.blob_id, first.blob_id)
+        self.assertNotEqual(second.name, first.name)
+        self.assertEqual(Blob.objects.get(pk=first.blob_id).refcount, 1)
+
+        response = other.get(f'/api/v1/files/{second.pk}/')
+        self.assertEqual(response.json()['name'], second.name)
+        self.assertNotIn('.pdf', second.name)
+        response = other.get(f'/api/v1/files/{second.pk}/download/')
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertNotIn(first.name, response['ETag'])
+
+
+class RawDownloadTests(StorageTestMixin, TestCase):
+    """Only client-encrypted files are sent as stored, never with a server key."""
+
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user(
+            username='owner', email='owner@example.com', password='pw'
+        )
+        self.client = self.client_for(self.owner)
+
+    def test_server_encrypted_refused(self):
+        file_obj = self.upload(self.owner, b'secret', name='a.txt', mime_type='text/plain')
+        file_obj.client_key = 'wrapped-by-client'
+        file_obj.save(update_fields=['client_key'])
+        response = self.client.get(f'/api/v1/files/{file_obj.pk}/download/?raw=1')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(response.has_header('X-Blob-Key'))
+
+    def upload_client_encrypted(self, ciphertext):
+        response = self.client.post('/api/v1/files/?encryption=client', {
+            'file': SimpleUploadedFile('a.bin', ciphertext, 'application/octet-stream'),
+            'original_name': 'a.bin',
+            'mime_type': 'application/octet-stream',
+            'client_key': 'wrapped-by-client',
+        }, format='multipart')
+        self.assertEqual(response.status_code, 201, response.content)
+        return response.json()['id']
+
+    def test_client_encrypted(self):
+        ciphertext = os.urandom(1024)
+        pk = self.upload_client_encrypted(ciphertext)
+
+        response = self.client.get(f'/api/v1/files/{pk}/download/?raw=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), ciphertext)
+        self.assertEqual(response['X-Client-Key'], 'wrapped-by-client')
+        self.assertFalse(response.has_header('X-Blob-Key'))
+        self.assertEqual(response['Cache-Control'], 'no-store')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+    def test_client_encrypted_range(self):
+        ciphertext = os.urandom(200 * 1024)
+        pk = self.upload_client_encrypted(ciphertext)
+        url = f'/api/v1/files/{pk}/download/?raw=1'
+
+        response = self.client.get(url, HTTP_RANGE='bytes=1000-99999')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 1000-99999/{len(ciphertext)}')
+        self.assertEqual(b''.join(response.streaming_content), ciphertext[1000:100000])
+        self.assertEqual(response['Cache-Control'], 'no-store')
+
+        response = self.client.get(url, HTTP_RANGE='bytes=0-9,-10')
+        self.assertEqual(response.status_code, 206)
+        body = b''.join(response.streaming_content)
+        self.assertEqual(int(response['Content-Length']), len(body))
+        self.assertIn(ciphertext[:10], body)
+        self.assertIn(ciphertext[-10:], body)
+
+        response = self.client.get(url, HTTP_RANGE=f'bytes={len(ciphertext)}-')
+        self.assertEqual(response.status_code, 416)
+
+
+class FailedUploadTests(StorageTestMixin, TestCase):
+    """Uploads that don't succeed leave no blob behind."""
+
+    def post(self, client, data):
+        return client.post('/api/v1/files/', {
+            'file': SimpleUploadedFile('a.txt', b'secret', 'text/plain'),
+            **data,
+        }, format='multipart')
+
+    def test_unauthenticated(self):
+        response = self.post(APIClient(), {'original_name': 'a.txt', 'mime_type': 'text/plain'})
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(self.stored_blobs(), [])
+
+    def test_invalid_token(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Bearer bogus')
+        response = self.post(client, {'original_name': 'a.txt', 'mime_type': 'text/plain'})
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(self.stored_blobs(), [])
+
+    def test_rejected(self):
+        owner = User.objects.create_user(
+            username='owner', email='owner@example.com', password='pw'
+        )
+        response = self.post(self.client_for(owner), {})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.stored_blobs(), [])
+        self.assertFalse(File.objects.exists())
+
+
+@unittest.skipIf(moto is None, 'S3 tests need boto3 and moto')
+class S3StorageTests(unittest.TestCase):
+    """S3Storage against a moto-mocked bucket."""
+
+    part_size = 5 * 1024 * 1024
+
+    def setUp(self):
+        mock = moto.mock_aws()
+        mock.start()
+        self.addCleanup(mock.stop)
+        self.s3 = boto3.client('s3', region_name='us-east-1')
+        self.s3.create_bucket(Bucket='blobs')
+        self.storage = S3Storage(
+            bucket='blobs', prefix='encrypted_files/', region_name='us-east-1',
+            part_size=self.part_size, concurrency=2, read_size=1024 * 1024
+        )
+
+    def write(self, name, data, chunk_size=1024 * 1024):
+        with self.storage.open(name, 'wb') as out:
+            for start in range(0, len(data), chunk_size):
+                out.write(data[start:start + chunk_size])
+
+    def test_multipart_upload(self):
+        data = os.urandom(2 * self.part_size + 7)
+        self.write('big', data)
+        head = self.s3.head_object(Bucket='blobs', Key='encrypted_files/big')
+        # Multipart ETags end in the number of parts
+        self.assertTrue(head['ETag'].strip('"').endswith('-3'))
+        self.assertEqual(self.storage.size('big'), len(data))
+        with self.storage.open('big', 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(self.s3.list_multipart_uploads(Bucket='blobs').get('Uploads', []), [])
+
+    def test_small_blob_single_put(self):
+        self.write('small', b'ciphertext')
+        head = self.s3.head_object(Bucket='blobs', Key='encrypted_files/small')
+        self.assertNotIn('-', head['ETag'])
+        self.assertEqual([name for name, _, _ in self.storage.iter_blobs()], ['small'])
+
+    def test_ranged_open(self):
+        data = os.urandom(3 * 1024 * 1024 + 5)
+        self.write('blob', data)
+        with self.storage.open('blob', 'rb') as f:
+            f.seek(1000000)
+            self.assertEqual(f.read(1500000), data[1000000:2500000])
+            self.assertEqual(f.tell(), 2500000)
+            f.seek(-10, os.SEEK_END)
+            self.assertEqual(f.read(), data[-10:])
+            self.assertEqual(f.read(), b'')
+
+    def test_missing(self):
+        with self.assertRaises(FileNotFoundError):
+            self.storage.open('missing', 'rb')
+        self.assertFalse(self.storage.exists('missing'))
+
+    def test_abort(self):
+        client = self.storage.client
+        with mock.patch.object(blobs, 'blob_storage', return_value=self.storage), \
+                mock.patch.object(client, 'put_object', wraps=client.put_object) as put, \
+                mock.patch.object(client, 'complete_multipart_upload',
+                                  wraps=client.complete_multipart_upload) as complete:
+            for size in (10, self.part_size + 7):
+                writer = blobs.RawBlobWriter('aborted')
+                writer.write(os.urandom(size))
+                writer.abort()
+        # Neither the small blob nor the multipart upload is ever stored
+        put.assert_not_called()
+        complete.assert_not_called()
+        self.assertFalse(self.storage.exists('aborted'))
+        self.assertEqual(self.s3.list_multipart_uploads(Bucket='blobs').get('Uploads', []), [])
+
+
+class ReencryptBlobsTests(StorageTestMixin, TransactionTestCase):
+    """
+    The reencrypt_blobs command, resumed from a checkpoint. Its workers use
+    connections of their own, so the test can't hold a transaction open.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user(
+            username='owner', email='owner@example.com', password='pw'
+        )
+        self.checkpoint = os.path.join(self.root, 'checkpoint.json')
+
+    def test_listings_change(self):
+        recipient = User.objects.create_user(
+            username='recipient', email='recipient@example.com', password='pw'
+        )
+        file_obj = self.upload(self.owner, os.urandom(4096))
+        FileShare.objects.create(
+            file=file_obj, created_by=self.owner, shared_with=recipient,
+            permission=FileShare.Permissions.VIEW,
+            expires_at=timezone.now() + timedelta(days=1)
+        )
+        scopes = [
+            conditional.ALL,
+            conditional.user_scope(self.owner.pk),
+            conditional.user_scope(recipient.pk),
+        ]
+        before = [conditional.list_etag(scope) for scope in scopes]
+
+        call_command('reencrypt_blobs', checkpoint=self.checkpoint, stdout=io.StringIO())
+
+        self.assertNotEqual(File.objects.get(pk=file_obj.pk).name, file_obj.name)
+        after = [conditional.list_etag(scope) for scope in scopes]
+        for scope, old, new in zip(scopes, before, after):
+            self.assertNotEqual(old, new, scope)
+
+    def test_resume_retries_failed(self):
+        content = os.urandom(4096)
+        file_obj = self.upload(self.owner, content)
+        old_name = file_obj.name
+        # Interrupted after the blob failed and the checkpoint moved past it
+        with open(self.checkpoint, 'w') as f:
+            json.dump({
+                'started_at': (timezone.now() + timedelta(minutes=1)).isoformat(),
+                'phase': 'blobs',
+                'last_pk': str(file_obj.blob_id),
+                'processed': 0,
+                'skipped': 0,
+                'bytes': 0,
+                'failed': [file_obj.name],
+            }, f)
+
+        call_command('reencrypt_blobs', checkpoint=self.checkpoint, stdout=io.StringIO())
+
+        file_obj.refresh_from_db()
+        with open(self.checkpoint) as f:
+            checkpoint = json.load(f)
+        self.assertEqual(checkpoint['failed'], [])
+        self.assertEqual(checkpoint['processed'], 1)
+        self.assertNotEqual(file_obj.name, old_name)
+        self.assertEqual(len(self.stored_blobs()), 1)
+        response = self.client_for(self.owner).get(f'/api/v1/files/{file_obj.pk}/download/')
+        self.assertEqual(b''.join(response.streaming_content), content)
+
+
+@override_settings(FILE_ENCRYPTION_SEGMENT_SIZE=1024, FILE_UPLOAD_CHUNK_SIZE=2048)
+class ResumableUploadTests(StorageTestMixin, TestCase):
+    """Resumable uploads, from their chunks to a File or to expiry."""
+
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user(
+            username='owner', email='owner@example.com', password='pw'
+        )
+        self.client = self.client_for(self.owner)
+        self.content = os.urandom(5000)
+
+    def start(self):
+        response = self.client.post('/api/v1/files/uploads/', {
+            'original_name': 'report.pdf',
+            'mime_type': 'application/pdf',
+            'size': len(self.content),
+        })
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(response.json()['total_chunks'], 3)
+        return response.json()['id']
+
+    def send(self, session_id, index):
+        chunk = self.content[index * 2048:(index + 1) * 2048]
+        return self.client.put(
+            f'/api/v1/files/uploads/{session_id}/chunks/{index}/',
+            chunk, content_type='application/octet-stream'
+        )
+
+    def finalize(self, session_id):
+        return self.client.post(f'/api/v1/files/uploads/{session_id}/finalize/')
+
+    def parts(self):
+        parts = []
+        for path, _, names in os.walk(os.path.join(self.root, blobs.UPLOAD_PARTS_DIR)):
+            parts.extend(os.path.join(path, name) for name in names)
+        return parts
+
+    def test_finalize(self):
+        session_id = self.start()
+        for index in range(3):
+            self.assertEqual(self.send(session_id, index).status_code, 200)
+        response = self.finalize(session_id)
+        self.assertEqual(response.status_code, 201, response.content)
+        file_id = response.json()['id']
+        self.assertEqual(self.parts(), [])
+
+        # Finalizing again returns the same file
+        response = self.finalize(session_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['id'], file_id)
+        response = self.client.get(f'/api/v1/files/{file_id}/download/')
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+    def test_out_of_order(self):
+        session_id = self.start()
+        for index in (2, 0, 1):
+            self.assertEqual(self.send(session_id, index).status_code, 200)
+        response = self.finalize(session_id)
+        self.assertEqual(response.status_code, 201, response.content)
+        response = self.client.get(f"/api/v1/files/{response.json()['id']}/download/")
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+    def test_duplicate_chunk(self):
+        session_id = self.start()
+        for index in (0, 1, 1, 2, 0):
+            self.assertEqual(self.send(session_id, index).status_code, 200)
+        self.assertEqual(UploadSession.objects.get(pk=session_id).chunks.count(), 3)
+        self.assertEqual(len(self.parts()), 3)
+        response = self.finalize(session_id)
+        self.assertEqual(response.status_code, 201, response.content)
+        response = self.client.get(f"/api/v1/files/{response.json()['id']}/download/")
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+    def test_missing_chunk(self):
+        session_id = self.start()
+        self.send(session_id, 0)
+        self.send(session_id, 2)
+        response = self.finalize(session_id)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['missing_chunks'], [1])
+        self.assertFalse(File.objects.exists())
+        self.assertEqual(self.stored_blobs(), [])
+
+        self.send(session_id, 1)
+        self.assertEqual(self.finalize(session_id).status_code, 201)
+
+    def test_wrong_chunk_length(self):
+        session_id = self.start()
+        response = self.client.put(
+            f'/api/v1/files/uploads/{session_id}/chunks/0/',
+            self.content[:100], content_type='application/octet-stream'
+        )
+        self.assertEqual(response.status_code, 400)
+        response = self.client.put(
+            f'/api/v1/files/uploads/{session_id}/chunks/3/',
+            b'', content_type='application/octet-stream'
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.parts(), [])
+
+    def test_expired_sessions_reclaimed(self):
+        session_id = self.start()
+        self.send(session_id, 0)
+        self.send(session_id, 2)
+        kept = self.start()
+        self.send(kept, 1)
+        UploadSession.objects.filter(pk=session_id).update(
+            expires_at=timezone.now() - timedelta(minutes=1)
+        )
+        # Left behind by a session deleted while a chunk was being written
+        orphan = os.path.join(self.root, blobs.UPLOAD_PARTS_DIR, str(uuid.uuid4()))
+        os.makedirs(orphan)
+        with open(os.path.join(orphan, '00000000'), 'wb') as f:
+            f.write(b'part')
+        self.assertEqual(len(self.parts()), 4)
+
+        call_command('expire_upload_sessions', stdout=io.StringIO())
+
+        self.assertFalse(UploadSession.objects.filter(pk=session_id).exists())
+        self.assertEqual(len(self.parts()), 1)
+        self.assertIn(kept, self.parts()[0])
+        self.assertFalse(os.path.exists(orphan))
+        self.assertEqual(self.finalize(kept).status_code, 400)
+
+
+class SegmentedEncryptionTests(SimpleTestCase):
+    """Any change to a segmented blob fails authentication instead of decrypting."""
+
+    segment_size = 1024
+    stored_segment_size = segment_size + crypto.TAG_SIZE
+
+    def setUp(self):
+        self.key = crypto.generate_key()
+        self.plaintext = os.urandom(4 * self.segment_size + 100)
+        encryptor = crypto.SegmentEncryptor(self.key, self.segment_size)
+        self.blob = encryptor.update(self.plaintext) + encryptor.finalize()
+
+    def decrypt(self, blob, key=None):
+        return b''.join(crypto.iter_decrypt(io.BytesIO(blob), key or self.key))
+
+    def decrypt_range(self, blob, start, stop, size=None):
+        f = io.BytesIO(blob)
+        header = crypto.read_header(f)
+        return b''.join(crypto.iter_decrypt_range(
+            f, self.key, header, len(self.plaintext) if size is None else size, start, stop
+        ))
+
+    def segment(self, index):
+        offset = crypto.segment_offset(index, self.segment_size)
+        return slice(offset, offset + self.stored_segment_size)
+
+    def test_round_trip(self):
+        self.assertEqual(
+            len(self.blob), crypto.ciphertext_size(len(self.plaintext), self.segment_size)
+        )
+        self.assertEqual(self.decrypt(self.blob), self.plaintext)
+        self.assertEqual(self.decrypt_range(self.blob, 1000, 3000), self.plaintext[1000:3000])
+
+    def test_truncated_at_segment_boundary(self):
+        truncated = self.blob[:crypto.segment_offset(4, self.segment_size)]
+        with self.assertRaises(crypto.DecryptionError):
+            self.decrypt(truncated)
+
+    def test_truncated_mid_segment(self):
+        with self.assertRaises(crypto.DecryptionError):
+            self.decrypt(self.blob[:-10])
+        with self.assertRaises(crypto.DecryptionError):
+            self.decrypt_range(self.blob[:-10], 4 * self.segment_size, len(self.plaintext))
+
+    def test_truncated_header(self):
+        with self.assertRaises(crypto.DecryptionError):
+            self.decrypt(self.blob[:crypto.HEADER.size - 1])
+
+    def test_tampered_segment(self):
+        tampered = bytearray(self.blob)
+        tampered[crypto.segment_offset(2, self.segment_size) + 5] ^= 1
+        with self.assertRaises(crypto.DecryptionError):
+            self.decrypt(bytes(tampered))
+        with self.assertRaises(crypto.DecryptionError):
+            self.decrypt_range(bytes(tampered), 2 * self.segment_size, 2 * self.segment_size + 1)
+        # Ranges over untouched segments still decrypt
+        self.assertEqual(self.decrypt_range(bytes(tampered), 0, 100), self.plaintext[:100])
+
+    def test_tampered_header(self):
+        tampered = bytearray(self.blob)
+        # Last byte of the nonce prefix, which is authenticated as associated data
+        tampered[crypto.HEADER.size - 1] ^= 1
+        with self.assertRaises(crypto.DecryptionError):
+            self.decrypt(bytes(tampered))
+
+    def test_reordered_segments(self):
+        blob = bytearray(self.blob)
+        first, second = self.segment(1), self.segment(2)
+        blob[first], blob[second] = self.blob[second], self.blob[first]
+        with self.assertRaises(crypto.DecryptionError):
+            self.decrypt(bytes(blob))
+
+    def test_final_segment_dropped_claims_shorter_size(self):
+        # Dropping the last segment and claiming the shorter size in a range
+        # request still fails: the new last segment wasn't sealed as final
+        truncated = self.blob[:crypto.segment_offset(4, self.segment_size)]
+        with self.assertRaises(crypto.DecryptionError):
+            self.decrypt_range(truncated, 0, 4 * self.segment_size, size=4 * self.segment_size)
+
+    def test_wrong_key(self):
+        with self.assertRaises(crypto.DecryptionError):
+            self.decrypt(self.blob, crypto.generate_key())
+
+
+@override_settings(FILE_ENCRYPTION_SEGMENT_SIZE=1024)
+class RangeHeaderTests(SimpleTestCase):
+    """Parsing Range headers, and the length of the multipart bodies they get."""
+
+    def parse(self, header, size=5000):
+        return streaming.parse_range_header(header, size)
+
+    def test_suffix(self):
+        self.assertEqual(self.parse('bytes=-100'), [(4900, 5000)])
+        self.assertEqual(self.parse('bytes=-10000'), [(0, 5000)])
+        self.assertEqual(self.parse('bytes=-0'), [])
+
+    def test_past_end(self):
+        self.assertEqual(self.parse('bytes=4990-9999'), [(4990, 5000)])
+        self.assertEqual(self.parse('bytes=100-'), [(100, 5000)])
+        # Unsatisfiable, but well formed
+        self.assertEqual(self.parse('bytes=5000-5100'), [])
+
+    def test_ignored(self):
+        for header in (None, '', 'items=0-1', 'bytes=', 'bytes=-', 'bytes=5-1', 'bytes=a-b'):
+            with self.subTest(header=header):
+                self.assertIsNone(self.parse(header))
+
+    def test_too_many_ranges(self):
+        specs = [f'{i * 10}-{i * 10 + 1}' for i in range(streaming.MAX_RANGES + 1)]
+        self.assertIsNone(self.parse('bytes=' + ','.join(specs)))
+        self.assertEqual(len(self.parse('bytes=' + ','.join(specs[:-1]))), streaming.MAX_RANGES)
+
+    def test_coalesced(self):
+        self.assertEqual(
+            self.parse('bytes=300-400, 0-99,100-199,50-60'),
+            [(0, 200), (300, 401)]
+        )
+        self.assertEqual(self.parse('bytes=0-10,-4995'), [(0, 5000)])
+
+    def test_multipart_length(self):
+        content = os.urandom(5000)
+        ranges = [(0, 10), (100, 1100), (4990, 5000)]
+        reader = streaming._StoredReader(ContentFile(content))
+        body = b''.join(
+            streaming._multipart_parts(reader, ranges, 'b0undary', 'text/plain')
+        )
+        self.assertEqual(
+            streaming._multipart_length(ranges, 5000, 'b0undary', 'text/plain'), len(body)
+        )
+        self.assertIn(b'Content-Range: bytes 100-1099/5000\r\n\r\n' + content[100:1100], body)
+
+
+class CryptoPoolTests(SimpleTestCase):
+    """Segments sealed and opened on the crypto pool match the serial path exactly."""
+
+    segment_size = 1024
+
+    def setUp(self):
+        self.key = crypto.generate_key()
+        self.plaintext = os.urandom(20 * self.segment_size + 100)
+        # A shared header fixes the nonces, so both paths must agree byte for byte
+        self.header = crypto.new_header(self.segment_size)
+
+    def use_pool(self, workers, executor='thread'):
+        overrides = override_settings(FILE_CRYPTO_WORKERS=workers, FILE_CRYPTO_EXECUTOR=executor)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.addCleanup(setattr, crypto, '_executor', crypto._executor)
+        crypto._executor = None
+        pool = crypto.get_executor()
+        if pool is not None:
+            self.addCleanup(pool.shutdown)
+
+    def encrypt(self):
+        encryptor = crypto.SegmentEncryptor(self.key, header=self.header)
+        out = [self.header]
+        # Uneven writes, so batches start and end mid-segment
+        for start in range(0, len(self.plaintext), 3000):
+            out.append(encryptor.update(self.plaintext[start:start + 3000]))
+        out.append(encryptor.finalize())
+        return b''.join(out)
+
+    def decrypt(self, blob):
+        return b''.join(crypto.iter_decrypt(io.BytesIO(blob), self.key))
+
+    def test_matches_serial(self):
+        self.use_pool(1)
+        self.assertIsNone(crypto.get_executor())
+        serial = self.encrypt()
+
+        for executor in ('thread', 'process'):
+            with self.subTest(executor=executor):
+                self.use_pool(4, executor)
+                self.assertIsNotNone(crypto.get_executor())
+                pooled = self.encrypt()
+                self.assertEqual(pooled, serial)
+                self.assertEqual(self.decrypt(pooled), self.plaintext)
+                f = io.BytesIO(pooled)
+                header = crypto.read_header(f)
+                # Spans several segments and pool batches
+                self.assertEqual(b''.join(crypto.iter_decrypt_range(
+                    f, self.key, header, len(self.plaintext), 500, 15000
+                )), self.plaintext[500:15000])
+
+        self.use_pool(1)
+        self.assertEqual(self.decrypt(serial), self.plaintext)
+
+
+class RangeRequestTests(StorageTestMixin, TestCase):
+    """Range requests decrypt only what they ask for, however they ask for it."""
+
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user(
+            username='owner', email='owner@example.com', password='pw'
+        )
+        self.content = os.urandom(5000)
+        self.file = self.upload(self.owner, self.content, name='a.bin',
+                                mime_type='application/octet-stream')
+        self.url = f'/api/v1/files/{self.file.pk}/download/'
+
+    def get(self, range_header, **headers):
+        return self.client_for(self.owner).get(self.url, HTTP_RANGE=range_header, **headers)
+
+    def body(self, response):
+        return b''.join(response.streaming_content)
+
+    def assertPartial(self, response, start, stop):
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes {start}-{stop - 1}/5000')
+        self.assertEqual(int(response['Content-Length']), stop - start)
+        self.assertEqual(self.body(response), self.content[start:stop])
+
+    def test_single_range(self):
+        self.assertPartial(self.get('bytes=1000-2999'), 1000, 3000)
+
+    def test_open_ended(self):
+        self.assertPartial(self.get('bytes=4000-'), 4000, 5000)
+
+    def test_suffix(self):
+        self.assertPartial(self.get('bytes=-100'), 4900, 5000)
+
+    def test_suffix_longer_than_file(self):
+        self.assertPartial(self.get('bytes=-10000'), 0, 5000)
+
+    def test_end_past_file(self):
+        self.assertPartial(self.get('bytes=4990-9999'), 4990, 5000)
+
+    def test_overlapping_ranges_coalesced(self):
+        self.assertPartial(self.get('bytes=0-99,50-149'), 0, 150)
+
+    def test_multiple_ranges(self):
+        response = self.get('bytes=0-9,2000-2099,-5')
+        self.assertEqual(response.status_code, 206)
+        content_type, _, boundary = response['Content-Type'].partition('; boundary=')
+        self.assertEqual(content_type, 'multipart/byteranges')
+        body = self.body(response)
+        self.assertEqual(int(response['Content-Length']), len(body))
+
+        parts = body.split(f'--{boundary}'.encode())
+        self.assertEqual(parts[0], b'')
+        self.assertEqual(parts[-1], b'--\r\n')
+        expected = [(0, 10), (2000, 2100), (4995, 5000)]
+        self.assertEqual(len(parts[1:-1]), len(expected))
+        for part, (start, stop) in zip(parts[1:-1], expected):
+            headers, _, data = part.partition(b'\r\n\r\n')
+            self.assertIn(f'Content-Range: bytes {start}-{stop - 1}/5000'.encode(), headers)
+            self.assertEqual(data, self.content[start:stop] + b'\r\n')
+
+    def test_unsatisfiable(self):
+        for range_header in ('bytes=5000-', 'bytes=6000-7000', 'bytes=-0'):
+            response = self.get(range_header)
+            self.assertEqual(response.status_code, 416, range_header)
+            self.assertEqual(response['Content-Range'], 'bytes */5000')
+
+    def test_ignored(self):
+        # Malformed, in another unit, or inverted: the whole file is sent
+        for range_header in ('bytes=abc', 'items=0-1', 'bytes=10-5', 'bytes=-'):
+            response = self.get(range_header)
+            self.assertEqual(response.status_code, 200, range_header)
+            self.assertEqual(self.body(response), self.content)
+
+    def test_too_many_ranges(self):
+        spec = ','.join(f'{i * 10}-{i * 10 + 1}' for i in range(streaming.MAX_RANGES + 1))
+        response = self.get(f'bytes={spec}')
+        self.assertEqual(response.status_code, 200)
+
+    def test_stale_if_range(self):
+        response = self.get('bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), self.content)
+        response = self.get('bytes=0-9', HTTP_IF_RANGE=response['ETag'])
+        self.assertPartial(response, 0, 10)
+
+
+@override_settings(FILE_COMPRESSION_ALGORITHM='zlib', FILE_ENCRYPTION_SEGMENT_SIZE=1024)
+class CompressionTests(StorageTestMixin, TestCase):
+    """Compressible files round-trip, whole and in ranges, unless too large to compress."""
+
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user(
+            username='owner', email='owner@example.com', password='pw'
+        )
+        words = [b'alpha', b'beta', b'gamma', b'delta', b'epsilon']
+        self.content = b' '.join(words[i * 7 % 5] + str(i).encode() for i in range(20000))
+
+    def download(self, file_obj, **headers):
+        response = self.client_for(self.owner).get(
+            f'/api/v1/files/{file_obj.pk}/download/', **headers
+        )
+        return response, b''.join(response.streaming_content)
+
+    def test_round_trip(self):
+        file_obj = self.upload(self.owner, self.content, name='a.txt', mime_type='text/plain')
+        self.assertEqual(file_obj.compression, 'zlib')
+        self.assertLess(sum(size for _, size, _ in self.stored_blobs()), len(self.content) // 2)
+
+        response, body = self.download(file_obj)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, self.content)
+
+        for start, stop in ((0, 10), (50000, 60001), (len(self.content) - 5, len(self.content))):
+            response, body = self.download(file_obj, HTTP_RANGE=f'bytes={start}-{stop - 1}')
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(body, self.content[start:stop])
+
+    def test_large_files_not_compressed(self):
+        with self.settings(FILE_COMPRESSION_MAX_SIZE=len(self.content) // 2):
+            file_obj = self.upload(self.owner, self.content, name='a.txt', mime_type='text/plain')
+        self.assertEqual(file_obj.compression, 'none')
+        response, body = self.download(file_obj, HTTP_RANGE='bytes=50000-60000')
+        self.assertEqual(body, self.content[50000:60001])
+
+
+class EnvelopeKeyTests(SimpleTestCase):
+    """Data keys wrapped by the KEKs of a keyfile."""
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        self.keyfile = os.path.join(root, 'kek.json')
+        overrides = override_settings(FILE_KEK_FILE=self.keyfile, FILE_KEK_AUTOCREATE=True)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        keys.reset_keyring()
+        self.addCleanup(keys.reset_keyring)
+        self.data_key = crypto.generate_key()
+
+    def test_round_trip(self):
+        wrapped = keys.wrap(self.data_key)
+        self.assertNotIn(self.data_key, wrapped)
+        self.assertEqual(keys.wrapped_with(wrapped), 'dev')
+        self.assertEqual(keys.unwrap(wrapped), self.data_key)
+        # Fresh nonces: the same key never wraps to the same record
+        self.assertNotEqual(keys.wrap(self.data_key), wrapped)
+        keys.reset_keyring()
+        self.assertEqual(keys.unwrap(wrapped), self.data_key)
+
+    def test_bare_key(self):
+        # Stored before envelope encryption
+        self.assertIsNone(keys.wrapped_with(self.data_key))
+        self.assertEqual(keys.unwrap(self.data_key), self.data_key)
+
+    def test_unknown_kek(self):
+        wrapped = keys.wrap(self.data_key)
+        record = wrapped.replace('kek:dev:', 'kek:retired:')
+        with self.assertRaises(keys.UnknownKeyError):
+            keys.unwrap(record)
+
+        # The KEK it was wrapped with was dropped from the keyfile
+        keys._write_keyfile(self.keyfile, 'other', {'other': os.urandom(keys.KEK_SIZE)})
+        keys.reset_keyring()
+        with self.assertRaises(keys.UnknownKeyError):
+            keys.unwrap(wrapped)
+
+    def test_tampered(self):
+        wrapped = keys.wrap(self.data_key)
+        payload = bytearray(base64.urlsafe_b64decode(wrapped.rpartition(':')[2]))
+        payload[-1] ^= 1
+        with self.assertRaises(InvalidTag):
+            keys.unwrap(f'kek:dev:{base64.urlsafe_b64encode(bytes(payload)).decode()}')
+
+    def test_rotation(self):
+        old = keys.wrap(self.data_key)
+        kek_id = keys.add_kek()
+        new = keys.rewrap(old)
+        self.assertEqual(keys.wrapped_with(new), kek_id)
+        self.assertEqual(keys.unwrap(new), self.data_key)
+        # Records not yet rewrapped still open with the retired KEK
+        self.assertEqual(keys.unwrap(old), self.data_key)
+
+    @override_settings(FILE_KEK_AUTOCREATE=False)
+    def test_missing_keyfile(self):
+        with self.assertRaises(ImproperlyConfigured):
+            keys.wrap(self.data_key)
+
+
+class WrapBareKeysMigrationTests(StorageTestMixin, TestCase):
+    """Migration 0018 wraps the data keys stored before envelope encryption."""
+
+    def test_wraps_bare_keys(self):
+        owner = User.objects.create_user(
+            username='owner', email='owner@example.com', password='pw'
+        )
+        data_key = crypto.generate_key()
+        wrapped = keys.wrap(crypto.generate_key())
+        bare, already, client = (
+            File.objects.create(
+                name=blobs.new_blob_name(), original_name='a.txt', mime_type='text/plain',
+                size=1, owner=owner, encryption_key_id=key
+            )
+            for key in (data_key, wrapped, '')
+        )
+
+        migration = importlib.import_module('files.migrations.0018_wrap_bare_data_keys')
+        migration.wrap_bare_keys(django_apps, None)
+
+        bare.refresh_from_db()
+        self.assertEqual(keys.wrapped_with(bare.encryption_key_id), 'dev')
+        self.assertEqual(keys.unwrap(bare.encryption_key_id), data_key)
+        already.refresh_from_db()
+        self.assertEqual(already.encryption_key_id, wrapped)
+        client.refresh_from_db()
+        self.assertEqual(client.encryption_key_id, '')
+
+
+class PackedStorageTests(StorageTestMixin, TestCase):
+    """Small blobs are appended to packs, and compact_packs reclaims dead ones."""
+
+    def setUp(self):
+        super().setUp()
+        self.pack_location = os.path.join(self.root, 'blob_packs')
+        packed = override_settings(STORAGES={
+            **settings.STORAGES,
+            'blobs': {
+                'BACKEND': 'files.storage.PackedStorage',
+                'OPTIONS': {
+                    'location': os.path.join(self.root, 'encrypted_files'),
+                    'pack_location': self.pack_location,
+                    'max_packed_size': 1024,
+                    'pack_size': 4096,
+                },
+            },
+        })
+        packed.enable()
+        self.addCleanup(packed.disable)
+        self.storage = blobs.blob_storage()
+
+    def save(self, size):
+        name = blobs.new_blob_name()
+        content = os.urandom(size)
+        self.storage.save(name, ContentFile(content))
+        return name, content
+
+    def read(self, name):
+        with self.storage.open(name) as f:
+            return bytes(f.read())
+
+    def test_round_trip(self):
+        small, small_content = self.save(1000)
+        large, large_content = self.save(5000)
+        self.assertTrue(PackedBlob.objects.filter(name=small).exists())
+        self.assertFalse(PackedBlob.objects.filter(name=large).exists())
+        self.assertEqual(self.storage.pack_names(), ['pack-00000001.dat'])
+        for name, content in ((small, small_content), (large, large_content)):
+            self.assertTrue(self.storage.exists(name))
+            self.assertEqual(self.storage.size(name), len(content))
+            self.assertEqual(self.read(name), content)
+        self.assertEqual(sorted(name for name, _, _ in self.stored_blobs()), sorted([small, large]))
+
+    def test_upload(self):
+        owner = User.objects.create_user(
+            username='owner', email='owner@example.com', password='pw'
+        )
+        content = os.urandom(500)
+        file_obj = self.upload(owner, content, name='a.bin', mime_type='application/octet-stream')
+        self.assertTrue(PackedBlob.objects.filter(name=file_obj.name).exists())
+        response = self.client_for(owner).get(f'/api/v1/files/{file_obj.pk}/download/')
+        self.assertEqual(b''.join(response.streaming_content), content)
+
+    def test_delete(self):
+        name, _ = self.save(1000)
+        kept, kept_content = self.save(1000)
+        self.storage.delete(name)
+        self.assertFalse(self.storage.exists(name))
+        self.assertEqual([blob for blob, _, _ in self.stored_blobs()], [kept])
+        # Only the row goes; the bytes stay in the pack until it is compacted
+        self.assertEqual(os.path.getsize(self.storage.pack_path('pack-00000001.dat')), 2000)
+        self.assertEqual(self.read(kept), kept_content)
+
+    def test_compact(self):
+        # Four blobs fill a pack, so these take up the first two
+        saved = [self.save(1000) for _ in range(8)]
+        self.assertEqual(self.storage.pack_names(), ['pack-00000001.dat', 'pack-00000002.dat'])
+        for name, _ in saved[:3]:
+            self.storage.delete(name)
+
+        dry_run = io.StringIO()
+        call_command('compact_packs', '--min-age', '0', '--dry-run', stdout=dry_run)
+        self.assertIn('pack-00000001.dat: 4000 bytes, 25% live', dry_run.getvalue())
+        self.assertEqual(len(self.storage.pack_names()), 2)
+
+        call_command('compact_packs', '--min-age', '0', stdout=io.StringIO())
+        # The first pack is gone, its survivor moved on; the newest is left alone
+        self.assertNotIn('pack-00000001.dat', self.storage.pack_names())
+        self.assertIn('pack-00000002.dat', self.storage.pack_names())
+        usage = {pack: (size, live) for pack, size, live, _ in self.storage.pack_usage()}
+        self.assertEqual(sum(size for size, _ in usage.values()), 5000)
+        self.assertEqual(sum(live for _, live in usage.values()), 5000)
+        for name, content in saved[3:]:
+            self.assertEqual(self.read(name), content)
+
+
+@unittest.skipIf(Image is None, 'Pillow is not installed')
+class DerivativeTests(StorageTestMixin, TestCase):
+    """Previews send a cached thumbnail or excerpt, or the original without one."""
+
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user(
+            username='owner', email='owner@example.com', password='pw'
+        )
+
+    def image(self, color=(200, 30, 30)):
+        out = io.BytesIO()
+        Image.new('RGB', (1000, 800), color).save(out, 'JPEG')
+        return self.upload(self.owner, out.getvalue(), name='a.jpg', mime_type='image/jpeg')
+
+    def preview(self, file_obj):
+        response = self.client_for(self.owner).get(
+            f'/api/v1/files/{file_obj.pk}/preview/?variant=thumb'
+        )
+        self.assertEqual(response.status_code, 200)
+        return response, b''.join(response.streaming_content)
+
+    def test_thumbnail(self):
+        file_obj = self.image()
+        response, body = self.preview(file_obj)
+        self.assertEqual(response['X-Preview-Variant'], 'thumb')
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(Image.open(io.BytesIO(body)).size, (256, 205))
+        derivative = Derivative.objects.get(blob_id=file_obj.blob_id)
+        self.assertEqual((derivative.variant, derivative.size), ('thumb', len(body)))
+
+    def test_text_excerpt(self):
+        content = b'line of text\n' * 1000
+        file_obj = self.upload(self.owner, content, name='a.txt', mime_type='text/plain')
+        response, body = self.preview(file_obj)
+        self.assertEqual(response['X-Preview-Variant'], 'thumb')
+        self.assertEqual(body, content[:derivatives.EXCERPT_LENGTH])
+
+    def test_reused(self):
+        file_obj = self.image()
+        _, first = self.preview(file_obj)
+        derivative = Derivative.objects.get()
+        blob_count = len(self.stored_blobs())
+
+        with mock.patch.object(derivatives, 'render') as render:
+            _, second = self.preview(file_obj)
+        render.assert_not_called()
+        self.assertEqual(second, first)
+        self.assertEqual(Derivative.objects.get().pk, derivative.pk)
+        self.assertEqual(len(self.stored_blobs()), blob_count)
+        self.assertGreater(Derivative.objects.get().last_accessed_at, derivative.last_accessed_at)
+
+    def test_evicted(self):
+        old, new = self.image(), self.image((30, 30, 200))
+        self.preview(old)
+        old_derivative = Derivative.objects.get()
+        # Room for one thumbnail only: making the second evicts the first
+        with self.settings(FILE_DERIVATIVE_CACHE_SIZE=old_derivative.size * 3 // 2), \
+                self.captureOnCommitCallbacks(execute=True):
+            self.preview(new)
+        self.assertEqual(
+            list(Derivative.objects.values_list('blob_id', flat=True)), [new.blob_id]
+        )
+        self.assertFalse(blobs.blob_storage().exists(old_derivative.name))
+
+        # Asked for again, it is made again
+        response, _ = self.preview(old)
+        self.assertEqual(response['X-Preview-Variant'], 'thumb')
+
+    def test_unsupported_type(self):
+        content = os.urandom(2000)
+        file_obj = self.upload(self.owner, content, name='a.bin',
+                               mime_type='application/octet-stream')
+        response, body = self.preview(file_obj)
+        self.assertEqual(response['X-Preview-Variant'], 'original')
+        self.assertEqual(body, content)
+        self.assertFalse(Derivative.objects.exists())
+
+
+class MigrateBlobLayoutTests(StorageTestMixin, TestCase):
+    """migrate_blob_layout moves flat blobs into shards, readable all along."""
+
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user(
+            username='owner', email='owner@example.com', password='pw'
+        )
+        self.storage = blobs.blob_storage()
+        self.contents = [os.urandom(1000 + i) for i in range(3)]
+        self.files = [self.upload(self.owner, content) for content in self.contents]
+        # Stored before sharding
+        for file_obj in self.files:
+            os.rename(
+                self.storage.path(file_obj.name),
+                os.path.join(self.storage.location, file_obj.name)
+            )
+
+    def migrate(self, *args):
+        out = io.StringIO()
+        call_command('migrate_blob_layout', *args, stdout=out, stderr=out)
+        return out.getvalue()
+
+    def assertReadable(self):
+        client = self.client_for(self.owner)
+        for file_obj, content in zip(self.files, self.contents):
+            response = client.get(f'/api/v1/files/{file_obj.pk}/download/')
+            self.assertEqual(b''.join(response.streaming_content), content)
+
+    def test_migrate(self):
+        self.assertReadable()
+        self.assertIn('Would move 3 blobs, 0 skipped', self.migrate('--dry-run'))
+        self.assertIn('Moved 3 blobs, 0 skipped', self.migrate())
+
+        for file_obj in self.files:
+            path = os.path.join(self.storage.location, self.storage.shard_name(file_obj.name))
+            self.assertEqual(self.storage.path(file_obj.name), path)
+            self.assertTrue(os.path.isfile(path))
+            self.assertFalse(os.path.exists(os.path.join(self.storage.location, file_obj.name)))
+        self.assertReadable()
+
+        # Nothing left to move on a second run
+        self.assertIn('Moved 0 blobs, 0 skipped', self.migrate())
+        self.assertReadable()
+
+
+class CollectBlobsTests(StorageTestMixin, TestCase):
+    """collect_blobs deletes old blobs nothing refers to, and nothing else."""
+
+    def setUp(self):
+        super().setUp()
+        owner = User.objects.create_user(
+            username='owner', email='owner@example.com', password='pw'
+        )
+        self.storage = blobs.blob_storage()
+        self.referenced = self.upload(owner, os.urandom(1000)).name
+        self.orphan = self.store(2 * 1024 * 1024, age=2 * 24 * 3600)
+        self.young = self.store(100, age=60)
+        # The file's own blob is as old as the orphan
+        self.age(self.referenced, 2 * 24 * 3600)
+
+    def store(self, size, age):
+        name = blobs.new_blob_name()
+        self.storage.save(name, ContentFile(os.urandom(size)))
+        self.age(name, age)
+        return name
+
+    def age(self, name, seconds):
+        then = timezone.now().timestamp() - seconds
+        os.utime(self.storage.path(name), (then, then))
+
+    def collect(self, *args):
+        out = io.StringIO()
+        call_command('collect_blobs', *args, stdout=out)
+        return out.getvalue()
+
+    def stored(self):
+        return sorted(name for name, _, _ in self.stored_blobs())
+
+    def test_dry_run(self):
+        output = self.collect('--dry-run', '--verbosity', '2')
+        self.assertIn(f'{self.orphan}: {2 * 1024 * 1024} bytes', output)
+        self.assertNotIn(self.young, output)
+        self.assertIn('Scanned 3 blobs: Would reclaim 2.0 MiB from 1 orphaned blobs', output)
+        self.assertEqual(self.stored(), sorted([self.referenced, self.orphan, self.young]))
+
+    def test_collect(self):
+        output = self.collect()
+        self.assertIn('Scanned 3 blobs: Reclaimed 2.0 MiB from 1 orphaned blobs', output)
+        self.assertEqual(self.stored(), sorted([self.referenced, self.young]))
+
+    def test_grace(self):
+        self.collect('--grace', '30')
+        self.assertEqual(self.stored(), [self.referenced])
+
+
+class RepairBlobReplicasTests(StorageTestMixin, TestCase):
+    """repair_blob_replicas restores lost copies of blobs and derivatives."""
+
+    def setUp(self):
+        super().setUp()
+        roots = [os.path.join(self.root, 'a'), os.path.join(self.root, 'b')]
+        for root in roots:
+            os.makedirs(root)
+        volumes = override_settings(STORAGES={
+            **settings.STORAGES,
+            'blobs': {
+                'BACKEND': 'files.storage.MultiVolumeStorage',
+                'OPTIONS': {'volumes': roots, 'replicas': 2},
+            },
+        })
+        volumes.enable()
+        self.addCleanup(volumes.disable)
+        self.owner = User.objects.create_user(
+            username='owner', email='owner@example.com', password='pw'
+        )
+
+    def test_repair(self):
+        storage = blobs.blob_storage()
+        file_obj = self.upload(self.owner, os.urandom(4096))
+        self.assertEqual(storage.replica_indexes(file_obj.name), [0, 1])
+        storage.volumes[1].delete(file_obj.name)
+
+        derivative = Derivative.objects.create(
+            blob_id=file_obj.blob_id, variant='thumb', name=blobs.new_blob_name(),
+            encryption_key='unused', mime_type='image/webp', size=9
+        )
+        storage.volumes[0].save(derivative.name, ContentFile(b'thumbnail'))
+
+        call_command('repair_blob_replicas', stdout=io.StringIO())
+
+        self.assertEqual(storage.replica_indexes(file_obj.name), [0, 1])
+        self.assertEqual(storage.replica_indexes(derivative.name), [0, 1])
+
+    def test_writes_are_atomic(self):
+        storage = blobs.blob_storage()
+        out = storage.open('blob', 'wb')
+        out.write(b'partial')
+        self.assertFalse(storage.exists('blob'))
+        out.close()
+        self.assertEqual(storage.replica_indexes('blob'), [0, 1])
+        with storage.open('blob') as f:
+            self.assertEqual(f.read(), b'partial')
+
+        out = storage.open('aborted', 'wb')
+        out.write(b'partial')
+        out.file.abort()
+        self.assertFalse(storage.exists('aborted'))
+        self.assertEqual(sorted(name for name, _, _ in storage.iter_blobs()), ['blob', 'blob'])
+        for volume in storage.volumes:
+            self.assertFalse(os.path.exists(volume.path('aborted') + '.tmp'))
+
+    def test_default_replicas(self):
+        roots = [os.path.join(self.root, 'a'), os.path.join(self.root, 'b')]
+        self.assertEqual(MultiVolumeStorage(roots).replicas, 2)
+        self.assertEqual(MultiVolumeStorage(roots[:1]).replicas, 1)
+
+
+class OwnerRenameListingTests(TestCase):
+    """Renaming a user changes the ETags of the listings showing their name."""
+
+    def setUp(self):
+        self.owner = User.objects.create_user(
+            username='owner', email='owner@example.com', password='pw'
+        )
+        self.recipient = User.objects.create_user(
+            username='recipient', email='recipient@example.com', password='pw'
+        )
+        self.bystander = User.objects.create_user(
+            username='bystander', email='bystander@example.com', password='pw'
+        )
+        file_obj = File.objects.create(
+            name='blob', original_name='report.txt', mime_type='text/plain',
+            size=1, owner=self.owner, encryption_key_id='unused'
+        )
+        FileShare.objects.create(
+            file=file_obj, created_by=self.owner, shared_with=self.recipient,
+            permission=FileShare.Permissions.VIEW,
+            expires_at=timezone.now() + timedelta(days=1)
+        )
+        self.scopes = [
+            conditional.ALL,
+            conditional.user_scope(self.owner.pk),
+            conditional.user_scope(self.recipient.pk),
+        ]
+
+    def etags(self, scopes):
+        return [conditional.list_etag(scope) for scope in scopes]
+
+    def test_rename(self):
+        before = self.etags(self.scopes)
+        unrelated = self.etags([conditional.user_scope(self.bystander.pk)])
+        self.owner.first_name = 'Ada'
+        self.owner.save()
+        for scope, old, new in zip(self.scopes, before, self.etags(self.scopes)):
+            self.assertNotEqual(old, new, scope)
+        self.assertEqual(self.etags([conditional.user_scope(self.bystander.pk)]), unrelated)
+
+    def test_login_ignored(self):
+        before = self.etags(self.scopes)
+        self.owner.last_login = timezone.now()
+        self.owner.save(update_fields=['last_login'])
+        self.assertEqual(self.etags(self.scopes), before)
+
+
+class VerifyAccessTests(TestCase):
+    """Share links are claimed by the account with exactly the shared address."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(
+            username='owner', email='owner@example.com', password='pw'
+        )
+        cls.file = File.objects.create(
+            name='blob', original_name='report.txt', mime_type='text/plain',
+            size=1, owner=cls.owner, encryption_key_id='unused'
+        )
+
+    def setUp(self):
+        cache.clear()
+        self.share = FileShare.objects.create(
+            file=self.file,
+            created_by=self.owner,
+            shared_with_email='guest@example.com',
+            permission=FileShare.Permissions.VIEW,
+            expires_at=timezone.now() + timedelta(days=1)
+        )
+
+    def verify(self, email):
+        return APIClient().post('/api/v1/shares/verify-access/', {
+            'token': self.share.access_token, 'email': email
+        })
+
+    def test_other_case_not_bound(self):
+        other = User.objects.create_user(
+            username='other', email='Guest@example.com', password='pw'
+        )
+        response = self.verify('guest@example.com')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertTrue(response.json()['isNewUser'])
+        self.share.refresh_from_db()
+        self.assertNotEqual(self.share.shared_with, other)
+        self.assertEqual(self.share.shared_with.email, 'guest@example.com')
+
+    def test_existing_user(self):
+        guest = User.objects.create_user(
+            username='guest', email='guest@example.com', password='pw'
+        )
+        response = self.verify('guest@example.com')
+        self.assertFalse(response.json()['isNewUser'])
+        self.share.refresh_from_db()
+        self.assertEqual(self.share.shared_with, guest)
+
+
+@override_settings(ROOT_URLCONF='files.tests', FILE_ENCRYPTION_SEGMENT_SIZE=1024)
+class AsyncViewTests(StorageTestMixin, TransactionTestCase):
+    """
+    The async upload, download and preview views. Their blocking steps run
+    in executor threads with connections of their own, so the test can't
+    hold a transaction open.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user(
+            username='owner', email='owner@example.com', password='pw'
+        )
+        self.token = str(AccessToken.for_user(self.owner))
+        self.content = os.urandom(5000)
+
+    def get(self, path, **headers):
+        # Headers given to AsyncClient() itself don't reach the ASGI scope
+        return self.async_client.get(
+            path, headers={'Authorization': f'Bearer {self.token}', **headers}
+        )
+
+    async def body(self, response):
+        return b''.join([chunk async for chunk in response.streaming_content])
+
+    async def upload_async(self, content):
+        response = await self.async_client.post('/api/v1/files/', headers={
+            'Authorization': f'Bearer {self.token}'
+        }, data={
+            'file': SimpleUploadedFile('a.bin', content, 'application/octet-stream'),
+            'original_name': 'a.bin',
+            'mime_type': 'application/octet-stream',
+        })
+        self.assertEqual(response.status_code, 201, response.content)
+        return response.json()['id']
+
+    async def test_upload_and_download(self):
+        file_id = await self.upload_async(self.content)
+        response = await self.get(f'/api/v1/files/{file_id}/download/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('attachment', response['Content-Disposition'])
+        self.assertEqual(await self.body(response), self.content)
+
+    async def test_upload_unauthenticated(self):
+        response = await self.async_client.post('/api/v1/files/', {
+            'file': SimpleUploadedFile('a.bin', self.content, 'application/octet-stream'),
+            'original_name': 'a.bin',
+            'mime_type': 'application/octet-stream',
+        })
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(self.stored_blobs(), [])
+
+    async def test_range(self):
+        file_id = await self.upload_async(self.content)
+        response = await self.get(f'/api/v1/files/{file_id}/download/', Range='bytes=1000-2999')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 1000-2999/5000')
+        self.assertEqual(await self.body(response), self.content[1000:3000])
+
+    async def test_preview(self):
+        file_id = await self.upload_async(self.content)
+        response = await self.get(f'/api/v1/files/{file_id}/preview/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Preview-Variant'], 'original')
+        self.assertNotIn('attachment', response.get('Content-Disposition', ''))
+        self.assertEqual(await self.body(response), self.content)
+
+        response = await self.get(f'/api/v1/files/{file_id}/preview/?variant=bogus')
+        self.assertEqual(response.status_code, 400)
+
+    async def test_not_found(self):
+        response = await self.get(f'/api/v1/files/{uuid.uuid4()}/download/')
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(FILE_PLAINTEXT_CACHE_TTL=60)
+class PlaintextCacheTests(StorageTestMixin, TestCase):
+    """Small files are served from memory until they expire or are invalidated."""
+
+    def setUp(self):
+        super().setUp()
+        enabled = override_settings(FILE_PLAINTEXT_CACHE_SIZE=1024 * 1024)
+        enabled.enable()
+        self.addCleanup(enabled.disable)
+        plaintext_cache.reset_cache()
+        self.addCleanup(plaintext_cache.reset_cache)
+        self.owner = User.objects.create_user(
+            username='owner', email='owner@example.com', password='pw'
+        )
+        self.content = os.urandom(4096)
+        self.file = self.upload(self.owner, self.content)
+
+    def read(self):
+        reader = blobs.PlaintextReader(self.file)
+        try:
+            return b''.join(reader.iter_range())
+        finally:
+            reader.close()
+
+    def test_hit(self):
+        self.assertEqual(self.read(), self.content)
+        # Served without the blob
+        blobs.delete_blob(self.file.name)
+        self.assertEqual(self.read(), self.content)
+        info = plaintext_cache.cache_info()
+        self.assertEqual((info.hits, info.misses, info.entries), (1, 1, 1))
+
+    def test_ttl(self):
+        self.read()
+        later = plaintext_cache.time.monotonic() + 61
+        with mock.patch.object(plaintext_cache.time, 'monotonic', return_value=later):
+            self.read()
+        info = plaintext_cache.cache_info()
+        self.assertEqual((info.hits, info.misses), (0, 2))
+
+    def test_invalidated_by_other_process(self):
+        self.read()
+        # Another process invalidates its own cache, and the shared generation
+        own = plaintext_cache.get_cache()
+        plaintext_cache._cache = plaintext_cache.PlaintextCache(1024, 1024, 60)
+        plaintext_cache.invalidate(self.file.name)
+        plaintext_cache._cache = own
+        self.assertEqual(own.info().entries, 1)
+
+        self.read()
+        self.assertEqual(own.info().hits, 0)
+        self.read()
+        self.assertEqual(own.info().hits, 1)
+
+    def test_too_large(self):
+        content = os.urandom(2 * 1024 * 1024)
+        self.file = self.upload(self.owner, content)
+        self.assertEqual(self.read(), content)
+        self.assertEqual(plaintext_cache.cache_info().entries, 0)
@@ -0,0 +1,165 @@
+"""
+Upload handler that encrypts file uploads as they are received.
+"""
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import (
+    FileUploadHandler, SkipFile, StopFutureHandlers
+)
+from django.urls import Resolver404, resolve
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from . import blobs, crypto
+from .models import Blob, File
+
+
+# Query string switching file uploads to client-encrypted mode
+CLIENT_ENCRYPTION_PARAM = 'encryption'
+CLIENT_ENCRYPTION_VALUE = 'client'
+
+
+def is_client_encrypted(request):
+    """
+    Whether ``request`` uploads content the client encrypted itself.
+
+    The mode is given in the query string rather than the form, so it is
+    known before the file part of the body arrives.
+    """
+    return request.GET.get(CLIENT_ENCRYPTION_PARAM) == CLIENT_ENCRYPTION_VALUE
+
+
+class EncryptedUploadedFile(UploadedFile):
+    """
+    An upload whose content was encrypted into blob storage as it arrived.
+
+    It carries the blob name, data key, plaintext digest and compression
+    instead of readable content. Client-encrypted uploads are stored as they
+    are and have no data key or digest.
+    """
+
+    def __init__(self, name, content_type, size, charset, blob_name,
+                 encryption_key, digest, compression, content_type_extra=None):
+        super().__init__(None, name, content_type, size, charset, content_type_extra)
+        self.blob_name = blob_name
+        self.encryption_key = encryption_key
+        self.digest = digest
+        self.compression = compression
+
+    def open(self, mode=None):
+        raise ValueError('Encrypted uploads have no readable plaintext')
+
+    def close(self):
+        pass
+
+
+def _authenticated(request):
+    """Whether ``request`` carries credentials the API views accept."""
+    authenticators = [cls() for cls in api_settings.DEFAULT_AUTHENTICATION_CLASSES]
+    try:
+        return Request(request, authenticators=authenticators).user.is_authenticated
+    except APIException:
+        return False
+
+
+def discard_uploads(request):
+    """
+    Delete the blobs written while parsing ``request``'s body that no file
+    refers to, once the request has failed. Does nothing if the body was
+    never parsed.
+    """
+    uploaded = request.__dict__.get('_files')
+    if not uploaded:
+        return
+    for _, files in uploaded.lists():
+        for uploaded_file in files:
+            if not isinstance(uploaded_file, EncryptedUploadedFile):
+                continue
+            name = uploaded_file.blob_name
+            if File.objects.filter(name=name).exists() or Blob.objects.filter(name=name).exists():
+                continue
+            blobs.delete_blob(name)
+
+
+class EncryptingUploadHandler(FileUploadHandler):
+    """
+    Encrypts the ``file`` field of file upload requests chunk by chunk and
+    writes the ciphertext straight to its final blob, so the plaintext is
+    never spooled to a temporary file or read back a second time.
+
+    Uploads in client-encrypted mode (``?encryption=client``) are already
+    ciphertext and are written to their blob without a server-side layer.
+
+    Uploads to any other endpoint or field fall through to the next handler
+    in ``FILE_UPLOAD_HANDLERS``. The body may be parsed before the view
+    authenticates the request (by middleware reading ``request.POST``), so
+    files sent to the upload endpoints without valid credentials are skipped
+    rather than written anywhere.
+    """
+    field_name = 'file'
+    url_names = {'file-list', 'file-list-async'}
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.writer = None
+        self.body_length = None
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        # The file's own length is rarely sent; the body's bounds it
+        self.body_length = content_length
+
+    def _handles(self, field_name):
+        if field_name != self.field_name or self.request is None:
+            return False
+        try:
+            match = resolve(self.request.path_info)
+        except Resolver404:
+            return False
+        return match.url_name in self.url_names
+
+    def new_file(self, field_name, file_name, *args, **kwargs):
+        super().new_file(field_name, file_name, *args, **kwargs)
+        self.writer = None
+        if not self._handles(field_name):
+            return
+        if not _authenticated(self.request):
+            raise SkipFile()
+        name = blobs.new_blob_name()
+        if is_client_encrypted(self.request):
+            self.encryption_key = None
+            self.writer = blobs.RawBlobWriter(name)
+        else:
+            self.encryption_key = crypto.generate_key()
+            self.writer = blobs.BlobWriter(
+                name, self.encryption_key, self.content_type,
+                size=self.content_length or self.body_length
+            )
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.writer is None:
+            return raw_data
+        self.writer.write(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        if self.writer is None:
+            return None
+        writer, self.writer = self.writer, None
+        writer.close()
+        return EncryptedUploadedFile(
+            name=self.file_name,
+            content_type=self.content_type,
+            size=writer.size,
+            charset=self.charset,
+            blob_name=writer.name,
+            encryption_key=self.encryption_key,
+            digest=writer.digest,
+            compression=writer.compression,
+            content_type_extra=self.content_type_extra
+        )
+
+    def upload_interrupted(self):
+        if self.writer is not None:
+            self.writer.abort()
+            self.writer = None
@@ -1,9 +1,13 @@
+from django.conf import settings
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import FileViewSet, FileShareViewSet
+from .views import FileViewSet, FileShareViewSet, UploadSessionViewSet
+from . import async_views
 
 # Create a router and register our viewsets with it
 router = DefaultRouter()
+# Registered before 'files' so its URLs aren't taken for file IDs
+router.register(r'files/uploads', UploadSessionViewSet, basename='upload')
 router.register(r'files', FileViewSet, basename='file')
 router.register(r'shares', FileShareViewSet, basename='fileshare')
 
@@ -11,4 +15,15 @@ router.register(r'shares', FileShareViewSet, basename='fileshare')
 urlpatterns = [
     # Include the router-generated URLs
     path('', include(router.urls)),
-]
\ No newline at end of file
+]
+
+# Async versions of the upload, download and preview URLs
+async_urlpatterns = [
+    path('files/', async_views.file_list, name='file-list-async'),
+    path('files/<uuid:pk>/download/', async_views.download, name='file-download-async'),
+    path('files/<uuid:pk>/preview/', async_views.preview, name='file-preview-async'),
+]
+
+if settings.FILES_ASYNC_VIEWS:
+    # Take over the same URLs ahead of the router
+    urlpatterns = async_urlpatterns + urlpatterns
\ No newline at end of file
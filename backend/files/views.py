@@ -1,20 +1,20 @@
-from rest_framework import viewsets, status, permissions
+from rest_framework import viewsets, mixins, status, permissions
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.permissions import IsAuthenticated, AllowAny
-from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
 from django.conf import settings
 from django.http import HttpResponse, FileResponse
-from cryptography.fernet import Fernet
-import os
-import uuid
 from django.contrib.auth import get_user_model
 from django.utils import timezone
-from django.db import models
-from .models import File, FileShare
-from .serializers import FileSerializer, FileShareSerializer
+from django.db import models, transaction, IntegrityError
+from django.db.models.functions import Lower
+from .models import File, FileShare, UploadSession, UploadChunk
+from .serializers import FileSerializer, FileShareSerializer, UploadSessionSerializer
 from .permissions import IsAdmin, IsFileOwnerOrSharedWith
+from .uploadhandler import EncryptedUploadedFile, is_client_encrypted
+from . import access, blobs, conditional, crypto, derivatives, keys, plaintext_cache, streaming
+import io
 import secrets
 import string
 
@@ -32,6 +32,16 @@ def generate_secure_password(length=12):
                 and any(c in string.punctuation for c in password)):
             return password
         
+def users_with_email(email):
+    """
+    Users whose email matches ``email`` case-insensitively. Compares
+    ``LOWER(email)``, so the lookup can use the index on it (``iexact``
+    compiles to ``UPPER()`` or ``LIKE``, which no index matches).
+    """
+    return User.objects.annotate(email_lower=Lower('email')).filter(
+        email_lower=Lower(models.Value(email))
+    )
+
 def get_user_by_email(email: str):
     """
     Get a user by email, ensuring case-insensitive comparison
@@ -41,15 +51,8 @@ def get_user_by_email(email: str):
         # Log the query we're about to make
         print(f"Looking up user with email: {email}")
         
-        # Get all users and log them for debugging
-        all_users = User.objects.all()
-        print("All users in database:")
-        print(all_users)
-        for u in all_users:
-            print(f"User: {u.username}, Email: {u.email}, User details: {u}")
-        
-        # Use get() directly with iexact and handle DoesNotExist
-        user = User.objects.get(email__iexact=email)
+        # Use get() directly and handle DoesNotExist
+        user = users_with_email(email).get()
         
         # Log the found user details
         print(f"Query found user: {user.username}")
@@ -64,6 +67,78 @@ def get_user_by_email(email: str):
         print(f"Error in get_user_by_email: {str(e)}")
         return None
 
+def save_upload(serializer, uploaded_file, client_key=None, client_encrypted=False):
+    """
+    Encrypt an uploaded file (unless EncryptingUploadHandler already did) and
+    save its File row through ``serializer``. With ``client_encrypted`` the
+    upload is already ciphertext: only its framing is checked and it is
+    stored once, as it is.
+    """
+    if client_encrypted:
+        return save_client_upload(serializer, uploaded_file, client_key)
+
+    if isinstance(uploaded_file, EncryptedUploadedFile):
+        # Already encrypted into storage by EncryptingUploadHandler
+        encrypted_filename = uploaded_file.blob_name
+        encryption_key = uploaded_file.encryption_key
+        digest = uploaded_file.digest
+        compression = uploaded_file.compression
+    else:
+        # Generate a unique encryption key for this file
+        encryption_key = crypto.generate_key()
+        
+        # Encrypt segment by segment straight into storage
+        encrypted_filename = blobs.new_blob_name()
+        writer = blobs.write_blob(
+            encrypted_filename, uploaded_file.chunks(), encryption_key,
+            uploaded_file.content_type, size=uploaded_file.size
+        )
+        digest = writer.digest
+        compression = writer.compression
+    
+    # Store file metadata, sharing an identical stored blob if there is one
+    with transaction.atomic():
+        file_instance = serializer.save()
+        blobs.attach_blob(
+            file_instance, encrypted_filename, encryption_key, digest,
+            file_instance.size, compression
+        )
+        file_instance.client_key = client_key
+        file_instance.save()
+        transaction.on_commit(lambda: derivatives.schedule(file_instance))
+    return file_instance
+
+def save_client_upload(serializer, uploaded_file, client_key=None):
+    """
+    Store an upload the client encrypted itself without a server-side layer
+    and save its File row through ``serializer``.
+    """
+    try:
+        blobs.check_client_framing(uploaded_file.size)
+    except ValueError as e:
+        raise ValidationError({'file': str(e)})
+
+    if isinstance(uploaded_file, EncryptedUploadedFile):
+        # Already written to storage by EncryptingUploadHandler
+        blob_name = uploaded_file.blob_name
+    else:
+        blob_name = blobs.new_blob_name()
+        writer = blobs.RawBlobWriter(blob_name)
+        try:
+            for chunk in uploaded_file.chunks():
+                writer.write(chunk)
+        except Exception:
+            writer.abort()
+            raise
+        writer.close()
+
+    with transaction.atomic():
+        file_instance = serializer.save()
+        blobs.attach_client_blob(file_instance, blob_name, file_instance.size)
+        file_instance.client_key = client_key
+        file_instance.save()
+    return file_instance
+
 class FileViewSet(viewsets.ModelViewSet):
     """
     ViewSet for handling all file-related operations including upload, download,
@@ -71,6 +146,7 @@ class FileViewSet(viewsets.ModelViewSet):
     """
     serializer_class = FileSerializer
     permission_classes = [IsAuthenticated, IsFileOwnerOrSharedWith]
+    cursor_ordering = ('-uploaded_at', '-id')
     
     def get_queryset(self):
         """
@@ -79,119 +155,117 @@ class FileViewSet(viewsets.ModelViewSet):
         """
         user = self.request.user
         if user.is_admin():
-            return File.objects.all()
-        return File.objects.filter(models.Q(owner=user)).distinct()
+            queryset = File.objects.all()
+        else:
+            queryset = File.objects.filter(models.Q(owner=user)).distinct()
+        return FileSerializer.setup_eager_loading(queryset, user)
     
     def get_object(self):
         """
-        Override get_object to handle both owned and shared files.
-        """
-        obj = File.objects.filter(
-           models.Q(pk=self.kwargs['pk']),
-           (
-               models.Q(owner=self.request.user) |
-               models.Q(
-                   shares__shared_with=self.request.user,
-                   shares__expires_at__gt=timezone.now()
-               ) |
-               models.Q(owner__isnull=False)  # This will always be True, allowing admins through
-           )
-       ).first()
-        
-        # If object exists and user is admin, return it
-        if obj and self.request.user.is_admin():
-            return obj
-        
-        # For non-admin users, only return if they have proper access
-        if obj and (
-            obj.owner == self.request.user or
-            obj.shares.filter(
-                shared_with=self.request.user,
-                expires_at__gt=timezone.now()
-            ).exists()
-        ):
-            self.check_object_permissions(self.request, obj)
-            return obj
+        Override get_object to handle both owned and shared files. The file
+        and the caller's permission on it are resolved in one query, which
+        the permission check and the actions reuse.
+        """
+        obj = access.get_file(self.request, self.kwargs['pk'])
+        if obj is None:
+            raise NotFound('File not found or access denied')
+        self.check_object_permissions(self.request, obj)
+        return obj
 
-        print("File not found or access denied")
+    def list(self, request, *args, **kwargs):
+        """
+        List the user's files (all files for admins), with a weak ETag so
+        an unchanged listing can be revalidated with ``If-None-Match``.
+        """
+        if request.user.is_admin():
+            scope = conditional.ALL
+        else:
+            scope = conditional.user_scope(request.user.pk)
+        return conditional.conditional_list(
+            request, conditional.list_etag(scope, *conditional.page_key(request)),
+            lambda: super(FileViewSet, self).list(request, *args, **kwargs)
+        )
 
     def perform_create(self, serializer):
         """
-        Handle file upload with encryption.
+        Handle file upload with encryption, or with ``?encryption=client``
+        store content the client already encrypted as it is.
         """
-        uploaded_file = self.request.FILES['file']
-        client_key = self.request.POST.get('client_key')
-        
-        # Generate a unique encryption key for this file
-        encryption_key = Fernet.generate_key()
-        fernet = Fernet(encryption_key)
-        
-        # Read and encrypt the file content
-        file_content = uploaded_file.read()
-        encrypted_content = fernet.encrypt(file_content)
-        
-        # Generate a unique filename for storage
-        file_extension = os.path.splitext(uploaded_file.name)[1]
-        encrypted_filename = f"{uuid.uuid4()}{file_extension}"
-        
-        # Save the encrypted file
-        file_path = os.path.join('encrypted_files', encrypted_filename)
-        default_storage.save(file_path, ContentFile(encrypted_content))
-        
-        # Store file metadata and encryption key reference
-        file_instance = serializer.save()
-        file_instance.name = encrypted_filename
-        file_instance.encryption_key_id = encryption_key.decode()
-        file_instance.client_key = client_key
-        file_instance.save()
+        save_upload(
+            serializer,
+            self.request.FILES['file'],
+            self.request.POST.get('client_key'),
+            client_encrypted=is_client_encrypted(self.request)
+        )
+
+    @action(detail=False, methods=['get'], url_path=r'digests/(?P<digest>[0-9a-f]{64})')
+    def digest(self, request, digest=None):
+        """
+        Pre-flight deduplication check: does the caller already store content
+        with this SHA-256 digest? Only the caller's own files are considered,
+        and content is only ever deduplicated among one user's files, so
+        neither this answer nor a stored file's name reveals what other users
+        have uploaded.
+        """
+        exists = File.objects.filter(owner=request.user, blob__digest=digest).exists()
+        return Response({'digest': digest, 'exists': exists})
+
+    @action(detail=False, methods=['post'], url_path='from-digest')
+    def from_digest(self, request):
+        """
+        Create a file from content the caller already stores, identified by
+        its SHA-256 digest, without sending the bytes again.
+        """
+        digest = request.data.get('digest')
+        source = File.objects.filter(
+            owner=request.user, blob__digest=digest
+        ).first() if digest else None
+        if source is None:
+            return Response(
+                {'detail': 'No stored content with this digest'},
+                status=status.HTTP_404_NOT_FOUND
+            )
+
+        with transaction.atomic():
+            file_instance = File(
+                original_name=request.data.get('original_name') or source.original_name,
+                mime_type=request.data.get('mime_type') or source.mime_type,
+                size=source.size,
+                owner=request.user,
+                client_key=source.client_key
+            )
+            blobs.reference_blob(file_instance, source)
+            file_instance.save()
+
+        serializer = self.get_serializer(file_instance)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     @action(detail=True, methods=['get'], permission_classes=[IsFileOwnerOrSharedWith])
     def download(self, request, pk=None):
-        """Handle secure file download with decryption."""
+        """
+        Handle secure file download with decryption. With ``?raw=1`` a
+        client-encrypted file is sent as stored, without decrypting it.
+        """
         file_obj = self.get_object()
         print(file_obj)
-        if not request.user.is_admin():         
-            # Check download permission
-            if request.user != file_obj.owner:
-                share = file_obj.shares.filter(
-                    shared_with=request.user,
-                    expires_at__gt=timezone.now()   
-                ).first()
-                
-                if not share or share.permission != 'DOWNLOAD':
-                    return Response(
-                        {'detail': 'Download permission denied'},
-                        status=status.HTTP_403_FORBIDDEN
-                    )
-        try:
-            # Get the encryption key and initialize Fernet
-            fernet = Fernet(file_obj.encryption_key_id.encode())
-            
-            # Read the encrypted file
-            file_path = os.path.join(settings.ENCRYPTED_FILES_DIR, file_obj.name)
-            with default_storage.open(file_path, 'rb') as f:
-                encrypted_content = f.read()
-            
-            # Decrypt the content
-            decrypted_content = fernet.decrypt(encrypted_content)
-            
-            # Create response with proper headers
-            response = HttpResponse(
-                decrypted_content,
-                content_type=file_obj.mime_type or 'application/octet-stream'
+        # Check download permission
+        if not access.can_download(access.effective_permission(request.user, file_obj)):
+            return Response(
+                {'detail': 'Download permission denied'},
+                status=status.HTTP_403_FORBIDDEN
             )
-            
-            # Set required headers
-            response['Content-Disposition'] = f'attachment; filename="{file_obj.original_name}"'
-            # response['Access-Control-Allow-Origin'] = 'http://localhost:3000'
-            # response['Access-Control-Allow-Credentials'] = 'true'
-            response['X-Client-Key'] = file_obj.client_key
-            
-            # if request.method == 'OPTIONS':
-            #     response['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
-            #     response['Access-Control-Allow-Headers'] = 'Authorization, Content-Type'
-                
-            return response
+        if request.query_params.get('raw'):
+            if file_obj.storage_format != File.StorageFormat.CLIENT_ENCRYPTED:
+                return Response(
+                    {'detail': 'Raw download is only available for client-encrypted files'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+        try:
+            if request.query_params.get('raw'):
+                # Hand out the stored ciphertext for the client to decrypt
+                return streaming.ciphertext_response(request, file_obj, as_attachment=True)
+            # Decrypt and stream the stored blob (or the requested ranges of it)
+            return streaming.file_response(request, file_obj, as_attachment=True)
             
         except Exception as e:
             print(f"Download error: {str(e)}")
@@ -205,12 +279,31 @@ class FileViewSet(viewsets.ModelViewSet):
         """
         Get files shared with the current user.
         """
-        shared_files = File.objects.filter(
-            shares__shared_with=request.user,
-            shares__expires_at__gt=timezone.now()
-        ).distinct()
-        serializer = self.get_serializer(shared_files, many=True)
-        return Response(serializer.data)
+        now = timezone.now()
+        # Shares also drop out of the listing by expiring, which bumps no
+        # version but lowers the count
+        active_shares = FileShare.objects.filter(
+            shared_with=request.user, expires_at__gt=now
+        ).count()
+
+        def build():
+            shared_files = File.objects.filter(
+                shares__shared_with=request.user,
+                shares__expires_at__gt=now
+            ).distinct()
+            shared_files = FileSerializer.setup_eager_loading(shared_files, request.user)
+            page = self.paginate_queryset(shared_files)
+            serializer = self.get_serializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+
+        return conditional.conditional_list(
+            request,
+            conditional.list_etag(
+                conditional.user_scope(request.user.pk), active_shares,
+                *conditional.page_key(request)
+            ),
+            build
+        )
 
     @action(detail=False, methods=['get'])
     def all_files(self, request):
@@ -223,9 +316,19 @@ class FileViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_403_FORBIDDEN
             )
 
-        files = File.objects.all()
-        serializer = FileSerializer(files, many=True)
-        return Response(serializer.data)
+        def build():
+            # Without a request in the context there is no share permission
+            # to annotate, only the owners to join
+            files = File.objects.select_related('owner')
+            page = self.paginate_queryset(files)
+            serializer = FileSerializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+
+        return conditional.conditional_list(
+            request,
+            conditional.list_etag(conditional.ALL, *conditional.page_key(request)),
+            build
+        )
 
     @action(detail=False, methods=['get'])
     def statistics(self, request):
@@ -244,34 +347,33 @@ class FileViewSet(viewsets.ModelViewSet):
             expires_at__gt=timezone.now()
         ).count()
 
+        # Decrypted-content cache of the process answering this request
+        cache_info = plaintext_cache.cache_info()
+
         return Response({
             'total_files': total_files,
             'total_size': total_size,
-            'active_shares': total_shares
+            'active_shares': total_shares,
+            'plaintext_cache': cache_info._asdict() if cache_info else None
         })
     
     @action(detail=True, methods=['get'])
     def preview(self, request, pk=None):
-        """Handle file preview without forcing download."""
+        """
+        Handle file preview without forcing download. ``?variant=thumb``
+        sends the file's thumbnail or excerpt instead, if it can have one.
+        """
         file_obj = self.get_object()
         print(file_obj)
-        try:
-            # Server-side decryption
-            fernet = Fernet(file_obj.encryption_key_id.encode())
-            file_path = os.path.join(settings.ENCRYPTED_FILES_DIR, file_obj.name)
-            
-            with default_storage.open(file_path, 'rb') as f:
-                encrypted_content = f.read()
-            
-            decrypted_content = fernet.decrypt(encrypted_content)
-            
-            response = HttpResponse(
-                decrypted_content,
-                content_type=file_obj.mime_type or 'application/octet-stream',
-                headers={'X-Client-Key': file_obj.client_key}
+        variant = request.query_params.get('variant')
+        if variant and variant not in derivatives.VARIANTS:
+            return Response(
+                {'detail': 'Unknown preview variant'},
+                status=status.HTTP_400_BAD_REQUEST
             )
-            # Don't set Content-Disposition as attachment
-            return response
+        try:
+            # Server-side decryption, streamed without forcing download
+            return streaming.preview_response(request, file_obj, variant)
             
         except Exception as e:
             return Response(
@@ -279,6 +381,152 @@ class FileViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+class UploadSessionViewSet(mixins.CreateModelMixin,
+                           mixins.RetrieveModelMixin,
+                           mixins.DestroyModelMixin,
+                           viewsets.GenericViewSet):
+    """
+    ViewSet for resumable uploads. A client creates a session, PUTs numbered
+    chunks in any order (and in parallel), asks which chunks are missing, and
+    finalizes the session into a File. Chunks are encrypted as they arrive and
+    all state lives in the database and storage, so sessions survive restarts.
+    """
+    serializer_class = UploadSessionSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        return UploadSession.objects.filter(owner=self.request.user)
+
+    def perform_destroy(self, instance):
+        """
+        Abort the upload and remove any parts received so far.
+        """
+        part_names = list(instance.chunks.values_list('part_name', flat=True))
+        instance.delete()
+        blobs.delete_parts(part_names)
+
+    @action(detail=True, methods=['put'], url_path=r'chunks/(?P<index>\d+)')
+    def chunk(self, request, pk=None, index=None):
+        """
+        Receive and encrypt one chunk. The request body is the raw chunk.
+        Re-sending a chunk that was already received is a no-op.
+        """
+        session = self.get_object()
+        index = int(index)
+
+        if session.file_id:
+            return Response(
+                {'detail': 'Upload already finalized'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if not session.is_valid():
+            return Response(
+                {'detail': 'Upload session has expired'},
+                status=status.HTTP_410_GONE
+            )
+        if index >= session.total_chunks:
+            return Response(
+                {'detail': 'Invalid chunk index'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        if not session.chunks.filter(index=index).exists():
+            try:
+                part_name = blobs.write_part(session, index, request.stream or io.BytesIO())
+            except ValueError as e:
+                return Response(
+                    {'detail': str(e)},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            try:
+                UploadChunk.objects.create(session=session, index=index, part_name=part_name)
+            except IntegrityError:
+                # A parallel retry of the same chunk was stored first
+                blobs.delete_parts([part_name])
+
+        return Response({'index': index, 'received': True})
+
+    @action(detail=True, methods=['get'])
+    def missing(self, request, pk=None):
+        """
+        List the chunk indexes that still have to be sent.
+        """
+        session = self.get_object()
+        return Response({'missing_chunks': session.missing_chunks()})
+
+    @action(detail=True, methods=['post'])
+    def finalize(self, request, pk=None):
+        """
+        Assemble the received parts into an encrypted blob and create its File.
+
+        The blob is assembled and digested before the session row is locked,
+        so a large upload holds no transaction open while it is read back.
+        """
+        session = self.get_object()
+        if session.file_id:
+            # Finalizing twice returns the file created the first time
+            return self.finalized(session)
+        if not session.is_valid():
+            return Response(
+                {'detail': 'Upload session has expired'},
+                status=status.HTTP_410_GONE
+            )
+        missing = session.missing_chunks()
+        if missing:
+            return Response(
+                {'detail': 'Upload is incomplete', 'missing_chunks': missing},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        part_names = list(session.chunks.values_list('part_name', flat=True))
+        encrypted_filename = blobs.new_blob_name()
+        try:
+            blobs.assemble_parts(encrypted_filename, session.header, part_names)
+            # Chunks arrive out of order, so the digest is taken over the
+            # assembled blob; this also authenticates every segment. Chunks
+            # are encrypted independently and are never compressed.
+            encryption_key = keys.unwrap(session.encryption_key)
+            digest = blobs.digest_blob(encrypted_filename, encryption_key)
+
+            with transaction.atomic():
+                session = self.get_queryset().select_for_update().filter(pk=pk).first()
+                if session is None or session.file_id:
+                    # Aborted, or finalized by a concurrent request meanwhile
+                    blobs.delete_blob(encrypted_filename)
+                    if session is None:
+                        return Response(
+                            {'detail': 'Upload session not found'},
+                            status=status.HTTP_404_NOT_FOUND
+                        )
+                    return self.finalized(session)
+
+                file_instance = File(
+                    original_name=session.original_name,
+                    mime_type=session.mime_type,
+                    size=session.size,
+                    owner=session.owner,
+                    client_key=session.client_key
+                )
+                blobs.attach_blob(
+                    file_instance, encrypted_filename, encryption_key, digest, session.size
+                )
+                file_instance.save()
+                session.file = file_instance
+                session.save(update_fields=['file'])
+                session.chunks.all().delete()
+                transaction.on_commit(lambda: derivatives.schedule(file_instance))
+        except Exception:
+            blobs.delete_blob(encrypted_filename)
+            raise
+
+        blobs.delete_parts(part_names)
+        serializer = FileSerializer(file_instance, context=self.get_serializer_context())
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    def finalized(self, session):
+        serializer = FileSerializer(session.file, context=self.get_serializer_context())
+        return Response(serializer.data)
+
 class FileShareViewSet(viewsets.ModelViewSet):
     """
     ViewSet for managing file sharing functionality.
@@ -341,6 +589,8 @@ class FileShareViewSet(viewsets.ModelViewSet):
             )
             
             # Check if user exists
+            # Exact match: emails aren't unique, and a share sent to one
+            # address must not be claimed by an account differing in case
             user = User.objects.filter(email=email).first()
             
             # If this share was created for a different email
@@ -425,6 +675,7 @@ class FileShareViewSet(viewsets.ModelViewSet):
 
         share.expires_at = timezone.now()
         share.save()
+        plaintext_cache.invalidate(share.file.name)
         
         return Response({'detail': 'Share revoked successfully'})
     
\ No newline at end of file
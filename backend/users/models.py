@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models.functions import Lower
 from django.contrib.auth.models import AbstractUser
 
 class User(AbstractUser):
@@ -39,4 +40,8 @@ class User(AbstractUser):
 
     class Meta:
         verbose_name = 'User'
-        verbose_name_plural = 'Users'
\ No newline at end of file
+        verbose_name_plural = 'Users'
+        indexes = [
+            # Case-insensitive email lookups match on LOWER(email)
+            models.Index(Lower('email'), name='user_email_lower_idx'),
+        ]
\ No newline at end of file
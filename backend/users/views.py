@@ -15,6 +15,8 @@ class UserViewSet(viewsets.ModelViewSet):
     """
     queryset = User.objects.all()
     permission_classes = [permissions.IsAuthenticated]
+    # Newest first, seeking on the primary key
+    cursor_ordering = ('-id',)
     
     def get_serializer_class(self):
         """
@@ -174,6 +176,8 @@ class AdminViewSet(viewsets.ModelViewSet):
     serializer_class = UserSerializer
     permission_classes = [IsAdminUser]
     queryset = User.objects.all()
+    # Newest first, seeking on the primary key
+    cursor_ordering = ('-id',)
 
     def get_queryset(self):
         return User.objects.all().annotate(
@@ -182,8 +186,8 @@ class AdminViewSet(viewsets.ModelViewSet):
 
     @action(detail=False, methods=['get'])
     def users(self, request):
-        """Get all users with their details"""
-        users = self.get_queryset()
+        """Get all users with their details, a page at a time"""
+        users = self.paginate_queryset(self.get_queryset())
         data = []
         
         for user in users:
@@ -201,7 +205,7 @@ class AdminViewSet(viewsets.ModelViewSet):
             }
             data.append(user_data)
         
-        return Response(data)
+        return self.get_paginated_response(data)
 
     @action(detail=True, methods=['patch'])
     def update_role(self, request, pk=None):
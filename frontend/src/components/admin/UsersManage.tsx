@@ -4,10 +4,11 @@ import { fetchAllUsers } from '../../store/slices/adminSlice.ts';
 import { Users, Shield, HardDrive, Activity, Loader, Search } from 'lucide-react';
 import { formatDistanceToNow } from 'date-fns';
 import StatisticsCard from '../layout/StatisticsCardLayout.tsx';
+import LoadMoreButton from '../layout/LoadMoreButton.tsx';
 
 const UsersManage: React.FC = () => {
     const dispatch = useAppDispatch();
-    const { users, loading } = useAppSelector(state => state.admin);
+    const { users, usersCursor, loading, loadingMore } = useAppSelector(state => state.admin);
     const { user: currentUser } = useAppSelector(state => state.auth);
     const [searchTerm, setSearchTerm] = useState('');
 
@@ -165,6 +166,12 @@ const UsersManage: React.FC = () => {
                         </tbody>
                     </table>
                 </div>
+                {usersCursor && !loading && (
+                    <LoadMoreButton
+                        loading={loadingMore}
+                        onClick={() => dispatch(fetchAllUsers(usersCursor))}
+                    />
+                )}
             </div>
         </div>
     );
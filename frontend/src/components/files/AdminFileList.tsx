@@ -8,7 +8,7 @@ import StatisticsCard from '../layout/StatisticsCardLayout.tsx';
 
 const AdminFileList: React.FC = () => {
     const dispatch = useAppDispatch();
-    const { adminFiles, loading, statistics } = useAppSelector(state => state.files);
+    const { adminFiles, adminFilesCursor, loading, loadingMore, statistics } = useAppSelector(state => state.files);
     const [searchTerm, setSearchTerm] = useState('');
     const [sortConfig, setSortConfig] = useState<{
         key: 'name' | 'uploaded_at' | 'size';
@@ -103,6 +103,8 @@ const AdminFileList: React.FC = () => {
                 showUploadedBy={true}
                 sortConfig={sortConfig}
                 onSort={handleSort}
+                onLoadMore={adminFilesCursor ? () => dispatch(fetchAdminFiles(adminFilesCursor)) : undefined}
+                loadingMore={loadingMore}
             />
         </>
     );
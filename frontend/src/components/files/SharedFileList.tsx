@@ -1,5 +1,6 @@
 import React, { useState } from 'react';
-import { useAppSelector } from '../../hooks/redux.ts';
+import { useAppDispatch, useAppSelector } from '../../hooks/redux.ts';
+import { fetchSharedFiles } from '../../store/slices/fileSlice.ts';
 import FileListLayout from '../layout/FileListLayout.tsx';
 import FileDownload from './FileDownload.tsx';
 import FilePreview from './FilePreview.tsx';
@@ -12,7 +13,8 @@ interface SelectedFile {
 }
 
 export const SharedFileList: React.FC = () => {
-    const { sharedFiles, loading } = useAppSelector(state => state.files);
+    const dispatch = useAppDispatch();
+    const { sharedFiles, sharedFilesCursor, loading, loadingMore } = useAppSelector(state => state.files);
     const [searchTerm, setSearchTerm] = useState('');
     const [previewFile, setPreviewFile] = useState<SelectedFile | null>(null);
     const [sortConfig, setSortConfig] = useState<{
@@ -89,6 +91,8 @@ export const SharedFileList: React.FC = () => {
                 showUploadedBy={true}
                 sortConfig={sortConfig}
                 onSort={handleSort}
+                onLoadMore={sharedFilesCursor ? () => dispatch(fetchSharedFiles(sharedFilesCursor)) : undefined}
+                loadingMore={loadingMore}
             />
 
             {/* FilePreview Modal */}
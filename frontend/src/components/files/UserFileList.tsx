@@ -1,5 +1,6 @@
 import React, { useState } from 'react';
-import { useAppSelector } from '../../hooks/redux.ts';
+import { useAppDispatch, useAppSelector } from '../../hooks/redux.ts';
+import { fetchFiles } from '../../store/slices/fileSlice.ts';
 import { Share2, Eye } from 'lucide-react';
 import FileListLayout from '../layout/FileListLayout.tsx';
 import FileDownload from './FileDownload.tsx';
@@ -13,7 +14,8 @@ interface SelectedFile {
 }
 
 export const UserFileList: React.FC = () => {
-    const { files, loading } = useAppSelector(state => state.files);
+    const dispatch = useAppDispatch();
+    const { files, filesCursor, loading, loadingMore } = useAppSelector(state => state.files);
     const [searchTerm, setSearchTerm] = useState('');
     const [isShareModalOpen, setIsShareModalOpen] = useState(false);
     const [selectedFile, setSelectedFile] = useState<SelectedFile | null>(null);
@@ -109,6 +111,8 @@ export const UserFileList: React.FC = () => {
                 showUploadedBy={false}
                 sortConfig={sortConfig}
                 onSort={handleSort}
+                onLoadMore={filesCursor ? () => dispatch(fetchFiles(filesCursor)) : undefined}
+                loadingMore={loadingMore}
             />
 
             {/* ShareModal */}
@@ -1,6 +1,7 @@
 import React, { ReactNode } from 'react';
 import { Search, Loader, FileIcon } from 'lucide-react';
 import { formatDistanceToNow } from 'date-fns';
+import LoadMoreButton from './LoadMoreButton.tsx';
 
 interface FileListLayoutProps {
     title: string;
@@ -16,6 +17,9 @@ interface FileListLayoutProps {
         direction: 'asc' | 'desc';
     };
     onSort: (key: 'name' | 'uploaded_at' | 'size') => void;
+    // Set while the server has more pages of the list
+    onLoadMore?: () => void;
+    loadingMore?: boolean;
 }
 
 const formatFileSize = (bytes: number): string => {
@@ -37,6 +41,8 @@ const FileListLayout: React.FC<FileListLayoutProps> = ({
     showUploadedBy = false,
     sortConfig,
     onSort,
+    onLoadMore,
+    loadingMore = false,
 }) => {
     const renderSortArrow = (key: 'name' | 'uploaded_at' | 'size') => {
         if (sortConfig.key !== key) return null;
@@ -133,6 +139,9 @@ const FileListLayout: React.FC<FileListLayoutProps> = ({
                         )}
                     </div>
                 </div>
+                {onLoadMore && !loading && (
+                    <LoadMoreButton loading={loadingMore} onClick={onLoadMore} />
+                )}
             </div>
         </div>
     );
@@ -0,0 +1,26 @@
+import React from 'react';
+import { Loader } from 'lucide-react';
+
+interface LoadMoreButtonProps {
+    loading: boolean;
+    onClick: () => void;
+}
+
+// Fetches the next page of a list whose cursor is still set
+const LoadMoreButton: React.FC<LoadMoreButtonProps> = ({ loading, onClick }) => (
+    <div className="px-6 py-4 text-center border-t border-gray-200">
+        <button
+            onClick={onClick}
+            disabled={loading}
+            className={`inline-flex items-center px-4 py-2 text-sm font-medium rounded-md
+                ${loading
+                    ? 'text-gray-400 cursor-not-allowed'
+                    : 'text-indigo-600 hover:bg-indigo-50'}`}
+        >
+            {loading && <Loader className="animate-spin h-4 w-4 mr-2" />}
+            {loading ? 'Loading...' : 'Load more'}
+        </button>
+    </div>
+);
+
+export default LoadMoreButton;
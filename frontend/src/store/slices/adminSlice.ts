@@ -1,5 +1,6 @@
 import { createSlice, createAsyncThunk } from '@reduxjs/toolkit';
 import api from '../../api/axios.ts';
+import { Page, nextCursor } from './fileSlice.ts';
 
 interface UserDetails {
     id: string;
@@ -16,23 +17,29 @@ interface UserDetails {
 
 interface AdminState {
     users: UserDetails[];
+    // Cursor of the next page of users, null once all are loaded
+    usersCursor: string | null;
     loading: boolean;
+    loadingMore: boolean;
     error: string | null;
     selectedUser: UserDetails | null;
 }
 
 const initialState: AdminState = {
     users: [],
+    usersCursor: null,
     loading: false,
+    loadingMore: false,
     error: null,
     selectedUser: null
 };
 
-export const fetchAllUsers = createAsyncThunk(
+// Fetch the first page of users, or with a cursor the page after it
+export const fetchAllUsers = createAsyncThunk<Page<UserDetails>, string | undefined>(
     'admin/fetchAllUsers',
-    async (_, { rejectWithValue }) => {
+    async (cursor, { rejectWithValue }) => {
         try {
-            const response = await api.get('/admin/users/');
+            const response = await api.get('/admin/users/', { params: { cursor } });
             return response.data;
         } catch (error: any) {
             return rejectWithValue(error.response?.data?.detail || 'Failed to fetch users');
@@ -62,16 +69,26 @@ const adminSlice = createSlice({
     },
     extraReducers: (builder) => {
         builder
-            .addCase(fetchAllUsers.pending, (state) => {
-                state.loading = true;
+            .addCase(fetchAllUsers.pending, (state, action) => {
+                if (action.meta.arg) {
+                    state.loadingMore = true;
+                } else {
+                    state.loading = true;
+                }
                 state.error = null;
             })
             .addCase(fetchAllUsers.fulfilled, (state, action) => {
                 state.loading = false;
-                state.users = action.payload;
+                state.loadingMore = false;
+                // A cursor appends the next page, otherwise the list starts over
+                state.users = action.meta.arg
+                    ? [...state.users, ...action.payload.results]
+                    : action.payload.results;
+                state.usersCursor = nextCursor(action.payload.next);
             })
             .addCase(fetchAllUsers.rejected, (state, action) => {
                 state.loading = false;
+                state.loadingMore = false;
                 state.error = action.payload as string;
             })
             .addCase(updateUserRole.fulfilled, (state, action) => {
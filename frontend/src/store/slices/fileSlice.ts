@@ -14,12 +14,23 @@ interface File {
     };
 }
 
+// A page of a list endpoint; next is the URL of the following page, if any
+export interface Page<T> {
+    next: string | null;
+    results: T[];
+}
+
 // The FileState interface defines what our file management system keeps track of
 interface FileState {
     files: File[];
     adminFiles: File[];
     sharedFiles: File[];
+    // Cursors of the next pages of each list, null once fully loaded
+    filesCursor: string | null;
+    adminFilesCursor: string | null;
+    sharedFilesCursor: string | null;
     loading: boolean;
+    loadingMore: boolean;
     error: string | null;
     uploadProgress: number | null;
     shareLinks: ShareLink[];
@@ -74,7 +85,11 @@ const initialState: FileState = {
     files: [],
     adminFiles: [],
     sharedFiles: [],
+    filesCursor: null,
+    adminFilesCursor: null,
+    sharedFilesCursor: null,
     loading: false,
+    loadingMore: false,
     error: null,
     uploadProgress: null,
     shareLinks: [],
@@ -83,6 +98,10 @@ const initialState: FileState = {
     statistics: null
 };
 
+// Pull the cursor out of a page's next link
+export const nextCursor = (next: string | null): string | null =>
+    next ? new URL(next).searchParams.get('cursor') : null;
+
 // This action handles file uploads with encryption
 export const uploadFile = createAsyncThunk(
     'files/upload',
@@ -98,7 +117,9 @@ export const uploadFile = createAsyncThunk(
                 formData.append('client_key', clientKey);
             }
 
-            const response = await api.post('/files/', formData, {
+            // Content encrypted here is stored as is, without a server-side layer
+            const url = clientKey ? '/files/?encryption=client' : '/files/';
+            const response = await api.post(url, formData, {
                 headers: {
                     'Content-Type': 'multipart/form-data'
                 },
@@ -117,12 +138,12 @@ export const uploadFile = createAsyncThunk(
     }
 );
 
-// Fetch the list of files of the user
-export const fetchFiles = createAsyncThunk(
+// Fetch the list of files of the user, or with a cursor the page after it
+export const fetchFiles = createAsyncThunk<Page<File>, string | undefined>(
     'files/fetchAll',
-    async (_, { rejectWithValue }) => {
+    async (cursor, { rejectWithValue }) => {
         try {
-            const response = await api.get('/files/');
+            const response = await api.get('/files/', { params: { cursor } });
             return response.data;
         } catch (error: any) {
             return rejectWithValue(error.response?.data?.detail || 'Failed to fetch files');
@@ -220,11 +241,11 @@ export const fetchFileShares = createAsyncThunk(
 );
 
 // Add new async thunk for fetching shared files
-export const fetchSharedFiles = createAsyncThunk(
+export const fetchSharedFiles = createAsyncThunk<Page<File>, string | undefined>(
     'files/fetchShared',
-    async (_, { rejectWithValue }) => {
+    async (cursor, { rejectWithValue }) => {
         try {
-            const response = await api.get('/files/shared/');
+            const response = await api.get('/files/shared/', { params: { cursor } });
             return response.data;
         } catch (error: any) {
             return rejectWithValue(error.response?.data?.detail || 'Failed to fetch shared files');
@@ -232,11 +253,11 @@ export const fetchSharedFiles = createAsyncThunk(
     }
 );
 
-export const fetchAdminFiles = createAsyncThunk(
+export const fetchAdminFiles = createAsyncThunk<Page<File>, string | undefined>(
     'files/fetchAdminFiles',
-    async (_, { rejectWithValue }) => {
+    async (cursor, { rejectWithValue }) => {
         try {
-            const response = await api.get('/files/all_files/');
+            const response = await api.get('/files/all_files/', { params: { cursor } });
             return response.data;
         } catch (error: any) {
             return rejectWithValue(error.response?.data?.detail || 'Failed to fetch files');
@@ -288,16 +309,26 @@ const fileSlice = createSlice({
             })
             
             // Handle fetch states
-            .addCase(fetchFiles.pending, (state) => {
-                state.loading = true;
+            .addCase(fetchFiles.pending, (state, action) => {
+                if (action.meta.arg) {
+                    state.loadingMore = true;
+                } else {
+                    state.loading = true;
+                }
                 state.error = null;
             })
             .addCase(fetchFiles.fulfilled, (state, action) => {
                 state.loading = false;
-                state.files = action.payload;
+                state.loadingMore = false;
+                // A cursor appends the next page, otherwise the list starts over
+                state.files = action.meta.arg
+                    ? [...state.files, ...action.payload.results]
+                    : action.payload.results;
+                state.filesCursor = nextCursor(action.payload.next);
             })
             .addCase(fetchFiles.rejected, (state, action) => {
                 state.loading = false;
+                state.loadingMore = false;
                 state.error = action.payload as string;
             })
 
@@ -321,30 +352,50 @@ const fileSlice = createSlice({
             })
 
             // Handle shared files fetching
-            .addCase(fetchSharedFiles.pending, (state) => {
-                state.loading = true;
+            .addCase(fetchSharedFiles.pending, (state, action) => {
+                if (action.meta.arg) {
+                    state.loadingMore = true;
+                } else {
+                    state.loading = true;
+                }
                 state.error = null;
             })
             .addCase(fetchSharedFiles.fulfilled, (state, action) => {
                 state.loading = false;
-                state.sharedFiles = action.payload;
+                state.loadingMore = false;
+                // A cursor appends the next page, otherwise the list starts over
+                state.sharedFiles = action.meta.arg
+                    ? [...state.sharedFiles, ...action.payload.results]
+                    : action.payload.results;
+                state.sharedFilesCursor = nextCursor(action.payload.next);
             })
             .addCase(fetchSharedFiles.rejected, (state, action) => {
                 state.loading = false;
+                state.loadingMore = false;
                 state.error = action.payload as string;
             })
 
             // Handle admin files fetching
-            .addCase(fetchAdminFiles.pending, (state) => {
-                state.loading = true;
+            .addCase(fetchAdminFiles.pending, (state, action) => {
+                if (action.meta.arg) {
+                    state.loadingMore = true;
+                } else {
+                    state.loading = true;
+                }
                 state.error = null;
             })
             .addCase(fetchAdminFiles.fulfilled, (state, action) => {
                 state.loading = false;
-                state.adminFiles = action.payload;
+                state.loadingMore = false;
+                // A cursor appends the next page, otherwise the list starts over
+                state.adminFiles = action.meta.arg
+                    ? [...state.adminFiles, ...action.payload.results]
+                    : action.payload.results;
+                state.adminFilesCursor = nextCursor(action.payload.next);
             })
             .addCase(fetchAdminFiles.rejected, (state, action) => {
                 state.loading = false;
+                state.loadingMore = false;
                 state.error = action.payload as string;
             })
             .addCase(fetchFileStatistics.fulfilled, (state, action) => {